@@ -1,5 +1,12 @@
-import os, datetime, socket, sqlite3, threading, hashlib, paramiko, traceback, random, string, time, sys
-from functools import wraps
+import time
+# Taken before the other imports so that the startup report includes the time spent importing them
+start_time = time.perf_counter()
+
+import argparse, codecs, errno, gzip, itertools, os, re, datetime, socket, sqlite3, threading, hashlib, hmac, paramiko, traceback, random, string, sys, queue, asyncio, json, atexit, bisect, signal, multiprocessing, select, subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, deque, OrderedDict
+from functools import wraps, lru_cache
 from datetime import datetime
 
 # Please be sure to carefully read through README.md, as it contains
@@ -10,10 +17,93 @@ from datetime import datetime
 
 DEBUG_RAISE_ERRORS = False
 DATABASE_LOCATION  = "database/Data.db"
+DATABASE_POOL_SIZE = 8
+USER_CACHE_SIZE    = 4096
+USER_CACHE_TTL     = 60
+
+DATABASE_BACKEND          = "sqlite"
+DATABASE_DRIVER           = "psycopg"
+DATABASE_CONNECT_ARGS     = {}
+DATABASE_KEY_COLUMN_TYPE  = ""
+DATABASE_RETRIES          = 3
+DATABASE_RETRY_DELAY      = 0.05
 
 SSH_PORT           = 13333
 MAX_CONNECTIONS    = 50
 PUBLIC_SSH_BANNER  = "SSH-2.0-OpenSSH_8.2p1 Ubuntu-4ubuntu0.1"
+CONNECTION_ENGINE  = "threaded"
+THREAD_STACK_SIZE  = 0
+WORKER_PROCESSES   = 1
+WORKER_REUSE_PORT  = False
+
+RELOAD_START_TIMEOUT = 30
+RELOAD_DRAIN_TIMEOUT = 300
+
+HOST_KEY_FILES     = ["keys/private.key"]
+SSH_CIPHERS        = []
+SSH_KEX_ALGORITHMS = []
+
+MAX_CONCURRENT_HANDSHAKES = 32
+MAX_CONCURRENT_SESSIONS   = 200
+PENDING_QUEUE_SIZE        = 128
+PENDING_QUEUE_TIMEOUT     = 5
+HANDSHAKE_TIMEOUT         = 20
+
+CONNECTION_RATE_LIMIT     = 2
+CONNECTION_RATE_BURST     = 20
+RATE_LIMIT_IPV4_PREFIX    = 32
+RATE_LIMIT_IPV6_PREFIX    = 64
+RATE_LIMIT_TABLE_SIZE     = 65536
+LOGIN_PENALTY_AFTER       = 3
+LOGIN_PENALTY_BASE        = 5
+LOGIN_PENALTY_MAX         = 900
+
+PASSWORD_HASH_ALGORITHM   = "scrypt"
+SCRYPT_PARAMETERS         = {"n": 16384, "r": 8, "p": 1}
+PBKDF2_ITERATIONS         = 600000
+LOGIN_VERIFY_WORKERS      = 4
+LOGIN_VERIFY_QUEUE        = 64
+
+COMMAND_WORKERS           = 8
+COMMAND_QUEUE_SIZE        = 32
+MAX_JOBS_PER_SESSION      = 4
+JOB_OUTPUT_LIMIT          = 256 * 1024
+
+LOG_QUEUE_SIZE            = 10000
+LOG_QUEUE_FULL_POLICY     = "drop"
+LOG_FLUSH_INTERVAL        = 1
+LOG_FLUSH_BATCH_SIZE      = 256
+LOG_FILE_FORMAT           = "text"
+LOG_MAX_FILE_SIZE         = 10 * 1024 * 1024
+LOG_BACKUP_COUNT          = 5
+
+SESSION_RECORDING         = "none"
+RECORDING_FOLDER          = "recordings"
+RECORDING_INPUT           = True
+RECORDING_QUEUE_SIZE      = 10000
+RECORDING_FLUSH_INTERVAL  = 5
+RECORDING_MEMBER_SIZE     = 64 * 1024
+
+COMMAND_HISTORY_SIZE      = 500
+PERSIST_COMMAND_HISTORY   = False
+
+WELCOME_MESSAGE_DURATION  = 2
+SESSION_IDLE_TIMEOUT      = 900
+SESSION_MAX_LIFETIME      = 0
+MAX_INPUT_LINE_LENGTH     = 1024
+INPUT_RATE_LIMIT          = 4096
+INPUT_RATE_BURST          = 16384
+ESCAPE_KEY_TIMEOUT        = 0.05
+
+MESSAGE_QUEUE_SIZE        = 64
+MESSAGE_QUEUE_POLICY      = "drop_oldest"
+MESSAGE_POLL_INTERVAL     = 0.5
+
+TABLE_PAGE_SIZE           = 40
+TABLE_CHUNK_ROWS          = 200
+
+METRICS_ADDRESS           = "127.0.0.1"
+METRICS_PORT              = 0
 
 TERMINAL_TITLE_BAR = "Project Name >> [$user] - Connected from [$ip] - Session ID [$sid]"
 WELCOME_MESSAGE    = " Welcome, $user"
@@ -22,115 +112,1223 @@ COMMAND_UNKNOWN    = "\r Command '$command' not found.\r\n"
 COMMAND_PROHIBITED = "\r You do not have permission to execute '$command'. This is reserved for the root user. If you believe this is an error, please contact the system administrator.\r\n"
 COMMAND_FAILED     = "\r There was an error executing your command. Please try again later or contact the system administrator.\r\n"
 FATAL_ERROR        = "\r\n You have been disconnected due to a fatal error. We apologize for any inconvenience.\r\n"
-
+SERVER_FULL        = " The server has reached its maximum number of sessions, please try again later.\r\n"
+LOGIN_BUSY         = " The server is too busy to verify your login right now, please try again later.\r\n"
+SERVER_RELOADING   = "\r\n The server is restarting for an update. Please finish what you are doing, you will be disconnected in $seconds seconds.\r\n"
+SESSION_IDLE       = "\r\n You have been disconnected for being idle for too long.\r\n"
+SESSION_EXPIRED    = "\r\n Your session has reached its maximum length, please connect again.\r\n"
+TABLE_PAGER_PROMPT = "\r\n\033[7m -- More -- (space: next page, enter: next row, q: stop) \033[0m"
+COMMAND_CANCELLED  = "\r Command cancelled.\r\n"
+JOB_LIMIT_REACHED  = "\r You already have $count background commands. Wait for one to finish or cancel it first.\r\n"
+COMMANDS_BUSY      = "\r The server is too busy to start another background command, please try again later.\r\n"
+BROADCAST_MESSAGE  = "\r\n [ Message from $user ] $message\r\n"
+MESSAGES_DROPPED   = "\r\n [ $count older messages were dropped because they were not read in time ]\r\n"
+
+# A statement can also be a dictionary with one statement for each DATABASE_BACKEND. The "dbapi" statements name their
+# key column rowid, so that the same queries work as with the rowid of SQLite, and $key_column is replaced with a column
+# type that the database fills in on every INSERT (see DATABASE_KEY_COLUMN_TYPE).
 database_schemas   = {
-	"users": "CREATE TABLE users (username VARCHAR(255), password VARCHAR(255))"
+	"users": {
+		"sqlite": "CREATE TABLE users (username VARCHAR(255), password VARCHAR(255))",
+		"dbapi": "CREATE TABLE users (rowid $key_column, username VARCHAR(255), password VARCHAR(255))"
+	},
+	"command_history": {
+		"sqlite": "CREATE TABLE command_history (username VARCHAR(255), command TEXT)",
+		"dbapi": "CREATE TABLE command_history (rowid $key_column, username VARCHAR(255), command TEXT)"
+	}
+}
+# Tables of node_storage, which is always SQLite
+node_database_schemas = {
+	"active_sessions": "CREATE TABLE active_sessions (session_id INTEGER PRIMARY KEY, pid INTEGER, username VARCHAR(255), ip VARCHAR(255), login_time REAL, kick_requested INTEGER DEFAULT 0)",
+	"broadcasts": "CREATE TABLE broadcasts (broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER, message TEXT, created REAL)"
 }
+# Applied in order, once each, to new and existing databases. Only ever add to the end of this list, because the
+# database stores how many of them it has received in PRAGMA user_version.
+database_migrations = [
+	"DELETE FROM users WHERE rowid NOT IN (SELECT max(rowid) FROM users GROUP BY username)",
+	"CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username)",
+	"CREATE INDEX IF NOT EXISTS command_history_username ON command_history (username)",
+]
 needed_folders     = []
 
 # -----  END OF CONFIGURATION  ----- #
 
-start_time = time.perf_counter()
+# asyncssh takes about as long to import as everything else together, so it is only imported for the engine that uses it
+asyncssh = None
+if CONNECTION_ENGINE == "asyncio":
+	try:
+		import asyncssh
+	except ImportError:
+		pass
 
 class LogType:
 	INFO	= "\033[0m", 		  "INFO"
 	WARNING = "\033[1;38;5;220m", "WARNING"
 	ERROR   = "\033[1;38;5;160m", "ERROR"
 
+class LogWriter:
+	# A single background thread owns the console and every file inside of logs/. log() and log_to_file() only put a
+	# record on a bounded queue; the thread formats them, keeps the files open, flushes in batches and rotates by size.
+
+	def __init__(self, queue_size, drop_when_full, flush_interval, flush_batch_size, json_format, max_file_size, backup_count):
+		self.records = queue.Queue(queue_size)
+		self.drop_when_full = drop_when_full
+		self.flush_interval = flush_interval
+		self.flush_batch_size = flush_batch_size
+		self.json_format = json_format
+		self.max_file_size = max_file_size
+		self.backup_count = backup_count
+		self.files = {}
+		self.file_sizes = {}
+		self.dropped = 0
+		self.write_errors = 0
+		self.counter_lock = threading.Lock()
+		self.thread = None
+		self.thread_lock = threading.Lock()
+		self.cached_second, self.cached_console_time = None, None
+
+	def put(self, record, block=False):
+		if self.thread == None:
+			self.start()
+		try:
+			self.records.put(record, block=block or not self.drop_when_full)
+		except queue.Full:
+			with self.counter_lock:
+				self.dropped += 1
+
+	def start(self):
+		with self.thread_lock:
+			if self.thread == None:
+				self.thread = threading.Thread(target=self.run, name="LogWriter", daemon=True)
+				self.thread.start()
+
+	def close(self):
+		if not self.thread == None:
+			self.records.put(None)
+			self.thread.join(5)
+
+	def sync(self, timeout=5):
+		# Waits until every record queued so far has been written and flushed
+		if not self.thread == None:
+			written = threading.Event()
+			self.records.put(("sync", written))
+			written.wait(timeout)
+
+	def after_fork(self):
+		# The writer thread does not exist in a forked child and its locks may have been held at the time of the fork.
+		# The inherited files are dropped rather than closed; sync() was called before forking, so their buffers are empty.
+		self.records = queue.Queue(self.records.maxsize)
+		self.counter_lock = threading.Lock()
+		self.thread = None
+		self.thread_lock = threading.Lock()
+		self.files = {}
+		self.file_sizes = {}
+
+	def run(self):
+		unflushed, next_flush = 0, time.monotonic() + self.flush_interval
+		while True:
+			batch = []
+			try:
+				batch.append(self.records.get(timeout=max(next_flush - time.monotonic(), 0) if unflushed else None))
+				while len(batch) < self.flush_batch_size:
+					batch.append(self.records.get_nowait())
+			except queue.Empty:
+				pass
+			stopping = None in batch
+			flush_now = stopping
+			console_lines = []
+			for record in batch:
+				if record == None:
+					continue
+				try:
+					if record[0] == "console":
+						console_lines.append(self.format_console(record[1], *record[2]))
+					elif record[0] == "sync":
+						flush_now = True
+					else:
+						self.write_file(record[2], self.format_file(record[1], record[3]))
+						unflushed += 1
+						flush_now = flush_now or record[4]
+				except:
+					with self.counter_lock:
+						self.write_errors += 1
+			if console_lines:
+				sys.stdout.write("\n".join(console_lines) + "\n")
+				sys.stdout.flush()
+			if flush_now or unflushed >= self.flush_batch_size or (unflushed and time.monotonic() >= next_flush):
+				self.flush_files()
+				unflushed, next_flush = 0, time.monotonic() + self.flush_interval
+			for record in batch:
+				if not record == None and record[0] == "sync":
+					record[1].set()
+			if stopping:
+				return
+
+	def format_console(self, timestamp, message, user, ip, type):
+		if not int(timestamp) == self.cached_second:
+			self.cached_second = int(timestamp)
+			self.cached_console_time = datetime.fromtimestamp(timestamp).strftime("\033[0m(%I:%M:%S %p - %m/%d/%Y) ")
+		if not user == None and not ip == None:
+			return self.cached_console_time + f"[ {type[0] + type[1]}\033[0m - " + type[0] + user + "@" + ip + "\033[0m ] [" + type[0] + message + "\033[0m]"
+		return self.cached_console_time + f"[ {type[0] + type[1]}\033[0m ] [" + type[0] + message + "\033[0m]"
+
+	def format_file(self, timestamp, text):
+		if self.json_format:
+			return json.dumps({"time": datetime.fromtimestamp(timestamp).isoformat(timespec="seconds"), "message": text}) + "\n"
+		return format_time(int(timestamp)) + text + "\n"
+
+	def write_file(self, path, line):
+		if not path in self.files:
+			self.files[path] = open(f"logs/{path}", "ab")
+			self.file_sizes[path] = self.files[path].tell()
+		data = line.encode(ENCODING)
+		self.files[path].write(data)
+		self.file_sizes[path] += len(data)
+		if self.max_file_size and self.file_sizes[path] >= self.max_file_size:
+			if self.rotated_elsewhere(path):
+				self.files.pop(path).close()
+			else:
+				self.rotate(path)
+
+	def rotated_elsewhere(self, path):
+		# With WORKER_PROCESSES, another worker may already have rotated the file that this process still has open
+		try:
+			return not os.stat(f"logs/{path}").st_ino == os.fstat(self.files[path].fileno()).st_ino
+		except FileNotFoundError:
+			return True
+
+	def rotate(self, path):
+		self.files.pop(path).close()
+		for index in range(self.backup_count - 1, 0, -1):
+			if os.path.exists(f"logs/{path}.{index}"):
+				os.replace(f"logs/{path}.{index}", f"logs/{path}.{index + 1}")
+		if self.backup_count > 0:
+			os.replace(f"logs/{path}", f"logs/{path}.1")
+		else:
+			os.remove(f"logs/{path}")
+
+	def flush_files(self):
+		for handle in self.files.values():
+			try:
+				handle.flush()
+			except:
+				with self.counter_lock:
+					self.write_errors += 1
+
+log_writer = LogWriter(
+	LOG_QUEUE_SIZE, LOG_QUEUE_FULL_POLICY == "drop", LOG_FLUSH_INTERVAL, LOG_FLUSH_BATCH_SIZE,
+	LOG_FILE_FORMAT == "json", LOG_MAX_FILE_SIZE, LOG_BACKUP_COUNT
+)
+atexit.register(log_writer.close)
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=log_writer.after_fork)
+
 def log(message, user=None, ip=None, type=LogType.INFO):
-	current_time = datetime.now().strftime("\033[0m(%I:%M:%S %p - %m/%d/%Y) ")
-	if not user == None and not ip == None:
-		print(current_time + f"[ {type[0] + type[1]}\033[0m - " + type[0] + user + "@" + ip + "\033[0m ] [" + type[0] + message + "\033[0m]")
-	else:
-		print(current_time + f"[ {type[0] + type[1]}\033[0m ] [" + type[0] + message + "\033[0m]")
+	log_writer.put(("console", time.time(), (message, user, ip, type)))
+
+class Recording:
+	# The handle a session uses to add events to its recording. Adding an event never blocks; events that do not fit
+	# in the queue of the SessionRecorder are counted and replaced by a marker event once there is room again.
+
+	def __init__(self, recorder, name):
+		self.recorder = recorder
+		self.name = name
+		self.started = time.monotonic()
+		self.lost = 0
+
+	def event(self, kind, data):
+		elapsed = time.monotonic() - self.started
+		if self.lost and self.recorder.put(("event", self.name, elapsed, "m", f"{self.lost} events were not recorded")):
+			self.lost = 0
+		if not self.recorder.put(("event", self.name, elapsed, kind, data)):
+			self.lost += 1
+
+	def output(self, data):
+		self.event("o", data)
+
+	def input(self, data):
+		self.event("i", data)
+
+	def resize(self, width, height):
+		self.event("r", f"{width}x{height}")
+
+	def close(self):
+		self.recorder.put(("close", self.name), block=True)
+
+class RecordingFile:
+	# State of one open recording, owned by the thread of the SessionRecorder
+
+	def __init__(self, path):
+		# Recordings hold everything a user typed, so only the server's own account may read them
+		self.file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "ab")
+		self.index = os.fdopen(os.open(recording_index_path(path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), "a")
+		self.size = self.file.tell()
+		self.pending = []
+		self.pending_size = 0
+		self.pending_time = None
+		self.last_time = 0
+		self.decoders = {}
+
+	def add(self, elapsed, kind, data):
+		if isinstance(data, bytes):
+			if not kind in self.decoders:
+				self.decoders[kind] = codecs.getincrementaldecoder(ENCODING)(errors="replace")
+			data = self.decoders[kind].decode(data)
+		# Events from other threads, such as a command brought to the foreground with 'fg', may be queued slightly out of order
+		self.last_time = max(self.last_time, elapsed)
+		line = (json.dumps([round(self.last_time, 6), kind, data], ensure_ascii=False) + "\n").encode(ENCODING)
+		if self.pending_time == None:
+			self.pending_time = self.last_time
+		self.pending.append(line)
+		self.pending_size += len(line)
+
+	def write_member(self, index_entry=True):
+		# Compresses the pending events into one gzip member. Only complete members are listed in the index, which is
+		# written after the member, so a recording cut short by a crash can still be read up to its last member.
+		if not self.pending:
+			return 0
+		member = gzip.compress(b"".join(self.pending), mtime=0)
+		self.file.write(member)
+		self.file.flush()
+		if index_entry:
+			self.index.write(f"{self.size} {self.pending_time:.6f}\n")
+			self.index.flush()
+		self.size += len(member)
+		self.pending, self.pending_size, self.pending_time = [], 0, None
+		return len(member)
+
+	def close(self):
+		try:
+			return self.write_member()
+		finally:
+			self.file.close()
+			self.index.close()
+
+class SessionRecorder:
+	# Records sessions as asciicast v2 files from a single background thread, so that sessions never wait for
+	# compression or the disk. A recording is stored in RECORDING_FOLDER as a series of gzip members, each holding the
+	# events of up to RECORDING_FLUSH_INTERVAL seconds or RECORDING_MEMBER_SIZE bytes, and is only ever appended to.
+	# The .idx file next to it lists where every member starts and the time of its first event, so that a replay can
+	# start anywhere by decompressing a single member first. `zcat` turns a recording into a plain .cast file.
+
+	def __init__(self, folder, queue_size, flush_interval, member_size):
+		self.folder = folder
+		self.records = queue.Queue(queue_size)
+		self.flush_interval = flush_interval
+		self.member_size = member_size
+		self.files = {}
+		self.dropped = 0
+		self.bytes_written = 0
+		self.write_errors = 0
+		self.counter_lock = threading.Lock()
+		self.thread = None
+		self.thread_lock = threading.Lock()
+
+	def open(self, session_id, username, ip, width, height, term=None):
+		safe_username = re.sub(r"[^\w.-]", "_", username)
+		name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{session_id}-{safe_username}"
+		header = {"version": 2, "width": width, "height": height, "timestamp": int(time.time()), "title": f"{username}@{ip} (Session ID {session_id})"}
+		if term:
+			header["env"] = {"TERM": term}
+		self.put(("open", name, header), block=True)
+		return Recording(self, name)
+
+	def put(self, record, block=False):
+		if self.thread == None:
+			self.start()
+		try:
+			self.records.put(record, block=block)
+			return True
+		except queue.Full:
+			with self.counter_lock:
+				self.dropped += 1
+			return False
 
-os.system("cls" if os.name == "nt" else "clear")
+	def start(self):
+		with self.thread_lock:
+			if self.thread == None:
+				self.thread = threading.Thread(target=self.run, name="SessionRecorder", daemon=True)
+				self.thread.start()
+
+	def close(self):
+		if not self.thread == None:
+			self.records.put(None)
+			self.thread.join(5)
+
+	def after_fork(self):
+		# Forked workers start with no recordings of their own, see LogWriter.after_fork()
+		self.records = queue.Queue(self.records.maxsize)
+		self.counter_lock = threading.Lock()
+		self.thread = None
+		self.thread_lock = threading.Lock()
+		self.files = {}
 
-if DEBUG_RAISE_ERRORS:
-	log("!!! Working in development mode, raising errors when they come up !!!", type=LogType.WARNING)
-	log("!!!        > Do not use this in a production environment. <       !!!", type=LogType.WARNING)
+	def run(self):
+		next_flush = time.monotonic() + self.flush_interval
+		while True:
+			try:
+				record = self.records.get(timeout=max(next_flush - time.monotonic(), 0) if self.files else None)
+			except queue.Empty:
+				record = False
+			try:
+				if record == None:
+					for recording in self.files.values():
+						self.write(recording.close)
+					return
+				if record:
+					self.handle(record)
+			except:
+				with self.counter_lock:
+					self.write_errors += 1
+			if time.monotonic() >= next_flush:
+				for recording in self.files.values():
+					self.write(recording.write_member)
+				next_flush = time.monotonic() + self.flush_interval
+
+	def handle(self, record):
+		if record[0] == "event":
+			recording = self.files.get(record[1])
+			if not recording == None:
+				recording.add(*record[2:])
+				if recording.pending_size >= self.member_size:
+					self.write(recording.write_member)
+		elif record[0] == "open":
+			os.makedirs(self.folder, exist_ok=True)
+			recording = RecordingFile(os.path.join(self.folder, record[1] + ".cast.gz"))
+			recording.pending.append((json.dumps(record[2]) + "\n").encode(ENCODING))
+			# The header is a member of its own and is not listed in the index
+			recording.pending_time = 0
+			self.write(lambda: recording.write_member(index_entry=False))
+			self.files[record[1]] = recording
+		elif record[0] == "close":
+			recording = self.files.pop(record[1], None)
+			if not recording == None:
+				self.write(recording.close)
+
+	def write(self, function):
+		try:
+			self.bytes_written += function() or 0
+		except:
+			with self.counter_lock:
+				self.write_errors += 1
 
-HOST_KEY = None
-ENCODING = "UTF-8"
-session_id = 0
-connected_clients = []
+session_recorder = SessionRecorder(RECORDING_FOLDER, RECORDING_QUEUE_SIZE, RECORDING_FLUSH_INTERVAL, RECORDING_MEMBER_SIZE)
+atexit.register(session_recorder.close)
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=session_recorder.after_fork)
 
-if not os.name == "nt":
-	for _ in range(5):
+def recording_index_path(path):
+	return (path[:-len(".gz")] if path.endswith(".gz") else path) + ".idx"
+
+def read_recording_index(path):
+	# Returns (offset, time) of every complete gzip member of a recording, or an empty list without an index
+	entries = []
+	try:
+		with open(recording_index_path(path)) as index_file:
+			for line in index_file:
+				offset, entry_time = line.split()
+				entries.append((int(offset), float(entry_time)))
+	except (OSError, ValueError):
+		pass
+	return entries
+
+def read_recording(path, start=0):
+	# Returns the header of a recording and an iterator of its (time, kind, data) events. With `start`, decompression
+	# begins at the last member that starts at or before `start` seconds, so the first events may be slightly earlier.
+	recording_file = open(path, "rb")
+	header = json.loads(gzip.GzipFile(fileobj=recording_file).readline())
+	# A recording cut short may be missing members that were listed in its index
+	entries = [entry for entry in read_recording_index(path) if entry[0] < os.fstat(recording_file.fileno()).st_size]
+	position = bisect.bisect_right([entry_time for offset, entry_time in entries], start) - 1
+	recording_file.seek(entries[max(position, 0)][0] if entries else 0)
+
+	def events():
+		with recording_file:
+			try:
+				for line in gzip.GzipFile(fileobj=recording_file):
+					event = json.loads(line)
+					if isinstance(event, list):
+						yield event
+			except (EOFError, gzip.BadGzipFile, ValueError):
+				# The last member of a recording that was cut short is incomplete
+				return
+	return header, events()
+
+def replay_recording(path, start=0, speed=1, max_idle=2, output=None):
+	# Writes the output of a recording to `output` with its original timing, starting at `start` seconds. Output from
+	# before `start` in the same member is written at once, so the screen is rebuilt as far as that member allows.
+	output = output or sys.stdout.buffer
+	header, events = read_recording(path, start)
+	print(f"Replaying {header.get('title', path)}, recorded at {header['width']}x{header['height']} on {datetime.fromtimestamp(header['timestamp']).strftime('%m/%d/%Y %I:%M:%S %p')}", file=sys.stderr)
+	position = start
+	for event_time, kind, data in events:
+		if not kind == "o":
+			continue
+		if event_time > position and speed > 0:
+			time.sleep(min(event_time - position, max_idle or float("inf")) / speed)
+		position = max(position, event_time)
+		output.write(data.encode(ENCODING))
+		output.flush()
+
+class Metric:
+	# A counter, gauge or histogram in the Prometheus text format. Values are kept per tuple of label values.
+	# Metrics created with a function read their values from it when rendered instead of being updated directly.
+
+	def __init__(self, kind, name, description, label_names=(), function=None):
+		self.kind = kind
+		self.name = name
+		self.description = description
+		self.label_names = label_names
+		self.function = function
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def inc(self, amount=1, labels=()):
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+	def set(self, value, labels=()):
+		with self.lock:
+			self.values[labels] = value
+
+	def samples(self):
+		if self.function == None:
+			with self.lock:
+				return list(self.values.items())
+		values = self.function()
+		return list(values.items()) if isinstance(values, dict) else [((), values)]
+
+	def format_labels(self, labels, extra=""):
+		pairs = [f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for name, value in zip(self.label_names, labels)]
+		if extra:
+			pairs.append(extra)
+		return "{" + ",".join(pairs) + "}" if pairs else ""
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+		for labels, value in sorted(self.samples()):
+			lines.append(f"{self.name}{self.format_labels(labels)} {value}")
+		return lines
+
+class Histogram(Metric):
+
+	def __init__(self, name, description, label_names=(), buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)):
+		Metric.__init__(self, "histogram", name, description, label_names)
+		self.buckets = buckets
+
+	def observe(self, value, labels=()):
+		index = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			if not labels in self.values:
+				self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+			counts = self.values[labels]
+			counts[0][index] += 1
+			counts[1] += value
+			counts[2] += 1
+
+	def samples(self):
+		with self.lock:
+			return [(labels, ([*bucket_counts], total, count)) for labels, (bucket_counts, total, count) in self.values.items()]
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+		for labels, (bucket_counts, total, count) in sorted(self.samples()):
+			cumulative = 0
+			for bound, bucket_count in zip([*self.buckets, "+Inf"], bucket_counts):
+				cumulative += bucket_count
+				bound_label = 'le="' + str(bound) + '"'
+				lines.append(f"{self.name}_bucket{self.format_labels(labels, bound_label)} {cumulative}")
+			lines.append(f"{self.name}_sum{self.format_labels(labels)} {round(total, 6)}")
+			lines.append(f"{self.name}_count{self.format_labels(labels)} {count}")
+		return lines
+
+class MetricsRegistry:
+
+	def __init__(self):
+		self.metrics = []
+
+	def counter(self, name, description, label_names=(), function=None):
+		return self.add(Metric("counter", name, description, label_names, function))
+
+	def gauge(self, name, description, label_names=(), function=None):
+		return self.add(Metric("gauge", name, description, label_names, function))
+
+	def histogram(self, name, description, label_names=(), **kwargs):
+		return self.add(Histogram(name, description, label_names, **kwargs))
+
+	def add(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def render(self):
+		lines = []
+		for metric in self.metrics:
+			try:
+				lines += metric.render()
+			except:
+				pass
+		return "\n".join(lines) + "\n"
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		body = metrics.render().encode("utf-8")
+		self.send_response(200 if self.path in ("/", "/metrics") else 404)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+metrics = MetricsRegistry()
+handshake_seconds       = metrics.histogram("controlpanel_handshake_seconds", "Time from accepting a connection until its shell was requested")
+login_verify_seconds    = metrics.histogram("controlpanel_login_verify_seconds", "Time spent verifying login credentials, including waiting for a verifier thread")
+db_pool_wait_seconds    = metrics.histogram("controlpanel_db_pool_wait_seconds", "Time spent waiting to borrow a database connection")
+db_lock_wait_seconds    = metrics.histogram("controlpanel_db_write_lock_wait_seconds", "Time spent waiting for the database write lock")
+db_lock_hold_seconds    = metrics.histogram("controlpanel_db_write_lock_hold_seconds", "Time the database write lock was held")
+db_retries_total        = metrics.counter("controlpanel_db_retries_total", "Database functions run again after a transient error")
+command_seconds         = metrics.histogram("controlpanel_command_seconds", "Command execution time", ("command",))
+session_bytes_sent      = metrics.histogram("controlpanel_session_bytes_sent", "Bytes sent to each session over its lifetime", buckets=(1024, 8192, 65536, 524288, 4194304, 33554432))
+session_writes_sent     = metrics.histogram("controlpanel_session_writes_sent", "Channel writes made to each session over its lifetime", buckets=(10, 100, 1000, 10000, 100000))
+bytes_sent_total        = metrics.counter("controlpanel_bytes_sent_total", "Bytes sent to clients")
+writes_sent_total       = metrics.counter("controlpanel_writes_sent_total", "Channel writes made to clients")
+logins_total            = metrics.counter("controlpanel_logins_total", "Login attempts by result", ("result",))
+messages_queued_total   = metrics.counter("controlpanel_messages_queued_total", "Messages queued for sessions with notify()")
+messages_dropped_total  = metrics.counter("controlpanel_messages_dropped_total", "Queued messages dropped by MESSAGE_QUEUE_POLICY", ("reason",))
+
+# Set by start_next_generation() for the server process that takes over after a reload
+inherited_listen_fd = os.environ.pop("CONTROLPANEL_LISTEN_FD", None)
+# "port:fd" pairs of the metrics sockets, separated by commas
+inherited_metrics_fds = os.environ.pop("CONTROLPANEL_METRICS_FDS", None)
+ready_fd = os.environ.pop("CONTROLPANEL_READY_FD", None)
+first_session_id = os.environ.pop("CONTROLPANEL_FIRST_SESSION_ID", None)
+reloaded = not first_session_id == None
+
+HOST_KEYS = []
+HOST_KEY_TYPES = []
+ENCODING = "UTF-8"
+# Shared memory, so that worker processes forked by run_workers() never hand out the same Session ID
+session_id = multiprocessing.Value("Q", int(first_session_id or 0))
+worker_index = None
+s = None
+# Bound by open_metrics_sockets() before the previous generation drains, by port
+metrics_sockets = {}
+metrics_server = None
+reload_requested = threading.Event()
+# Created by serve(), so that importing this module opens no sockets
+reload_wakeup = None
+draining_deadline = None
+
+def kill_previous_server():
+	if not os.name == "nt":
 		os.system(f"lsof -t -i tcp:{SSH_PORT} | xargs kill")
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-s.bind(("", SSH_PORT))
-s.listen(MAX_CONNECTIONS)
+def bind_listen_socket(reuse_port=False, listen=True):
+	# Binds SSH_PORT, and only if another process already holds it, kills that process and tries again
+	for attempt in range(5):
+		try:
+			return open_listen_socket(reuse_port, listen)
+		except OSError as e:
+			if not e.errno == errno.EADDRINUSE or os.name == "nt" or attempt == 4:
+				raise
+		if attempt == 0:
+			log(f"Port {SSH_PORT} is in use, stopping the process that holds it", type=LogType.WARNING)
+		kill_previous_server()
+		time.sleep(0.2)
 
+def port_available():
+	try:
+		open_listen_socket(listen=False).close()
+		return True
+	except OSError:
+		return False
+
+def open_listen_socket(reuse_port=False, listen=True):
+	listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reuse_port:
+		listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	listen_socket.bind(("", SSH_PORT))
+	if listen:
+		listen_socket.listen(MAX_CONNECTIONS)
+	return listen_socket
+
+# Hashes are stored as "algorithm$parameters...$salt$hash". Unsalted SHA-512 hashes from older databases
+# are still accepted and are replaced with a hash from create_password_hash() the next time that user logs in.
 def create_password_hash(password):
-	return hashlib.sha512(password.encode("utf-8")).hexdigest()
+	salt = os.urandom(16)
+	if PASSWORD_HASH_ALGORITHM == "pbkdf2_sha256":
+		digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PBKDF2_ITERATIONS)
+		return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+	n, r, p = SCRYPT_PARAMETERS["n"], SCRYPT_PARAMETERS["r"], SCRYPT_PARAMETERS["p"]
+	digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20)
+	return f"scrypt${n}${r}${p}${salt.hex()}${digest.hex()}"
+
+def verify_password_hash(password, password_hash):
+	# Returns a tuple of whether the password matches and whether the stored hash should be regenerated
+	parts = password_hash.split("$")
+	if parts[0] == "scrypt" and len(parts) == 6:
+		n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+		digest = hashlib.scrypt(password.encode("utf-8"), salt=bytes.fromhex(parts[4]), n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20)
+		outdated = not (PASSWORD_HASH_ALGORITHM == "scrypt" and {"n": n, "r": r, "p": p} == SCRYPT_PARAMETERS)
+		return hmac.compare_digest(digest.hex(), parts[5]), outdated
+	if parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+		iterations = int(parts[1])
+		digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(parts[2]), iterations)
+		outdated = not (PASSWORD_HASH_ALGORITHM == "pbkdf2_sha256" and iterations == PBKDF2_ITERATIONS)
+		return hmac.compare_digest(digest.hex(), parts[3]), outdated
+	legacy_digest = hashlib.sha512(password.encode("utf-8")).hexdigest()
+	return hmac.compare_digest(legacy_digest, password_hash), True
+
+class LoginVerifier:
+	# Runs password verification on a fixed number of worker threads. At most `queue_size` verifications may wait
+	# for a worker, so a burst of login attempts is refused instead of piling up behind the key derivation function.
+
+	def __init__(self, workers, queue_size):
+		self.workers = workers
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="LoginVerifier")
+		self.slots = threading.BoundedSemaphore(workers + queue_size)
+		self.rejected = 0
+		self.counter_lock = threading.Lock()
+		self.dummy_hash = None
+
+	def verify(self, password, password_hash):
+		# Returns (matches, new_hash) where new_hash is set if the stored hash should be upgraded, or None when overloaded
+		if not self.slots.acquire(blocking=False):
+			with self.counter_lock:
+				self.rejected += 1
+			return None
+		try:
+			return self.executor.submit(self.verify_and_upgrade, password, password_hash).result()
+		finally:
+			self.slots.release()
+
+	def verify_and_upgrade(self, password, password_hash):
+		if password_hash == None:
+			# Unknown usernames still pay for a full verification so that they cannot be told apart by timing
+			verify_password_hash(password, self.get_dummy_hash())
+			return False, None
+		matches, outdated = verify_password_hash(password, password_hash)
+		return matches, create_password_hash(password) if matches and outdated else None
+
+	def get_dummy_hash(self):
+		if self.dummy_hash == None:
+			self.dummy_hash = create_password_hash("")
+		return self.dummy_hash
+
+	def warm_up(self):
+		# Runs one verification on a worker thread, so the first login does not pay for starting it or for the dummy hash
+		self.executor.submit(self.verify_and_upgrade, "", None).result()
+
+	def after_fork(self):
+		# The worker threads do not exist in a forked child, but the executor would still count them as idle and
+		# wait for them instead of starting new ones
+		self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="LoginVerifier")
+		self.counter_lock = threading.Lock()
+
+login_verifier = LoginVerifier(LOGIN_VERIFY_WORKERS, LOGIN_VERIFY_QUEUE)
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=login_verifier.after_fork)
+
+class CommandExecutor:
+	# Runs the background commands of every session on a fixed number of worker threads. At most `queue_size` more
+	# may wait for a worker, beyond that starting a background command is refused.
+
+	def __init__(self, workers, queue_size):
+		self.workers = workers
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Command")
+		self.slots = threading.BoundedSemaphore(workers + queue_size)
+		self.active = 0
+		self.rejected = 0
+		self.counter_lock = threading.Lock()
+
+	def submit(self, function, *args):
+		# Returns a Future, or None when every worker is busy and the queue is full
+		if not self.slots.acquire(blocking=False):
+			with self.counter_lock:
+				self.rejected += 1
+			return None
+		with self.counter_lock:
+			self.active += 1
+		return self.executor.submit(self.run, function, args)
+
+	def run(self, function, args):
+		try:
+			return function(*args)
+		finally:
+			with self.counter_lock:
+				self.active -= 1
+			self.slots.release()
+
+	def after_fork(self):
+		# See LoginVerifier.after_fork()
+		self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Command")
+		self.counter_lock = threading.Lock()
+
+command_executor = CommandExecutor(COMMAND_WORKERS, COMMAND_QUEUE_SIZE)
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=command_executor.after_fork)
+
+class StorageBackend:
+	# A bounded pool of DB-API connections to the database that @database_access() functions use. Subclasses open the
+	# connections and know how their database reports its tables and schema version. Statements are always written
+	# with "?" placeholders, and cursor() returns a cursor that runs them on the connection.
+
+	name = None
+	write_lock = None
+
+	def __init__(self, size):
+		self.idle_connections = queue.LifoQueue()
+		self.slots = threading.BoundedSemaphore(size)
+		self.all_connections = []
+		self.connections_lock = threading.Lock()
+
+	def connect(self):
+		raise NotImplementedError
+
+	def cursor(self, conn):
+		return conn.cursor()
+
+	def is_transient(self, error):
+		# Whether a function that raised `error` may succeed if it is run again
+		return False
+
+	def table_exists(self, cursor, table):
+		raise NotImplementedError
+
+	def get_schema_version(self, cursor):
+		raise NotImplementedError
+
+	def set_schema_version(self, cursor, version):
+		raise NotImplementedError
+
+	def open_connection(self):
+		conn = self.connect()
+		with self.connections_lock:
+			self.all_connections.append(conn)
+		return conn
+
+	def acquire(self):
+		self.slots.acquire()
+		try:
+			return self.idle_connections.get_nowait()
+		except queue.Empty:
+			pass
+		try:
+			return self.open_connection()
+		except:
+			self.slots.release()
+			raise
+
+	def release(self, conn, error=None):
+		# A connection that failed with a transient error may be broken, so it is closed instead of being reused
+		if not error == None and self.discards_connection(error):
+			with self.connections_lock:
+				if conn in self.all_connections:
+					self.all_connections.remove(conn)
+			try:
+				conn.close()
+			except Exception:
+				pass
+		else:
+			self.idle_connections.put(conn)
+		self.slots.release()
+
+	def discards_connection(self, error):
+		return False
+
+	def warm_up(self, count):
+		# Opens up to `count` connections ahead of the first clients that need them
+		connections = [self.acquire() for _ in range(count)]
+		for conn in connections:
+			self.release(conn)
+
+	def close(self):
+		# The pool reconnects if it is used again, which is how the supervisor process avoids sharing connections with its workers
+		with self.connections_lock:
+			for conn in self.all_connections:
+				conn.close()
+			self.all_connections = []
+			self.idle_connections = queue.LifoQueue()
+
+class SQLiteBackend(StorageBackend):
+	# The SQLite database file at `location`. The database runs in WAL mode so readers never wait for the writer, and
+	# writes are serialized by write_lock instead of every database call sharing a single global lock. sqlite3 keeps
+	# the prepared statements of every connection, so repeated statements are only compiled once.
+
+	name = "sqlite"
+
+	def __init__(self, location, size):
+		StorageBackend.__init__(self, size)
+		self.location = location
+		self.write_lock = threading.Lock()
+
+	def __str__(self):
+		return self.location
+
+	def connect(self):
+		if os.path.dirname(self.location):
+			os.makedirs(os.path.dirname(self.location), exist_ok=True)
+		conn = sqlite3.connect(self.location, check_same_thread=False, timeout=30)
+		conn.execute("PRAGMA journal_mode=WAL")
+		# In WAL mode, NORMAL only syncs at checkpoints, so a commit no longer costs an fsync of its own
+		conn.execute("PRAGMA synchronous=NORMAL")
+		return conn
+
+	def is_transient(self, error):
+		# Only raised once the 30 second busy timeout has run out, such as while another process holds a long write
+		return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+	def table_exists(self, cursor, table):
+		return cursor.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0] == 1
+
+	def get_schema_version(self, cursor):
+		return cursor.execute("PRAGMA user_version").fetchone()[0]
+
+	def set_schema_version(self, cursor, version):
+		# PRAGMA statements cannot take parameters; the value is always an integer
+		cursor.execute(f"PRAGMA user_version = {int(version)}")
+
+class StatementCursor:
+	# A DB-API cursor that translates the "?" placeholders of every statement to the paramstyle of its driver
+
+	def __init__(self, cursor, translate):
+		self.cursor = cursor
+		self.translate = translate
+
+	def execute(self, statement, parameters=()):
+		self.cursor.execute(self.translate(statement), parameters)
+		return self
+
+	def executemany(self, statement, parameters):
+		self.cursor.executemany(self.translate(statement), parameters)
+		return self
+
+	def __iter__(self):
+		return iter(self.cursor)
+
+	def __getattr__(self, name):
+		return getattr(self.cursor, name)
+
+class DBAPIBackend(StorageBackend):
+	# A networked SQL database, such as PostgreSQL, reached through the DB-API 2 driver module `driver` with
+	# `driver.connect(**connect_args)`, so that several servers can share their users. The server orders its own
+	# writes, so there is no write lock. Statements keep their "?" placeholders in the code and are translated once
+	# for the driver's paramstyle; drivers such as psycopg then prepare statements that are run repeatedly.
+
+	name = "dbapi"
+	PLACEHOLDER_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\?")
+	# Key column types that the database fills in by itself, by driver. Other drivers get the PostgreSQL type.
+	KEY_COLUMN_TYPES = {
+		"sqlite3": "INTEGER PRIMARY KEY",
+		"pymysql": "INTEGER PRIMARY KEY AUTO_INCREMENT", "MySQLdb": "INTEGER PRIMARY KEY AUTO_INCREMENT", "mysql.connector": "INTEGER PRIMARY KEY AUTO_INCREMENT",
+	}
+
+	def __init__(self, driver, connect_args, size, key_column_type=""):
+		StorageBackend.__init__(self, size)
+		self.driver_name = driver
+		self.driver = __import__(driver, fromlist=["connect"])
+		self.connect_args = connect_args
+		self.key_column_type = key_column_type or self.KEY_COLUMN_TYPES.get(driver, "SERIAL PRIMARY KEY")
+		self.translate = lru_cache(maxsize=512)(self.translate_statement)
+
+	def __str__(self):
+		return f"the {self.driver_name} database"
+
+	def connect(self):
+		return self.driver.connect(**self.connect_args)
+
+	def cursor(self, conn):
+		return StatementCursor(conn.cursor(), self.translate)
+
+	def translate_statement(self, statement):
+		style = self.driver.paramstyle
+		if style == "qmark":
+			return statement
+		if style in ["format", "pyformat"]:
+			statement = statement.replace("%", "%%")
+		numbers = itertools.count(1)
+		# Question marks inside of quoted strings and identifiers are left alone
+		return self.PLACEHOLDER_PATTERN.sub(lambda match: match.group() if not match.group() == "?" else "%s" if style in ["format", "pyformat"] else f":{next(numbers)}", statement)
+
+	def is_transient(self, error):
+		# Lost connections, failovers and serialization failures are reported as OperationalError or InterfaceError
+		return isinstance(error, (self.driver.OperationalError, self.driver.InterfaceError))
+
+	def discards_connection(self, error):
+		return self.is_transient(error)
+
+	def table_exists(self, cursor, table):
+		# There is no portable catalog query, so the table is read inside of a savepoint that is rolled back if it is missing
+		cursor.execute("SAVEPOINT table_exists")
+		try:
+			cursor.execute(f"SELECT 1 FROM {table} WHERE 1=0").fetchall()
+			exists = True
+		except self.driver.DatabaseError:
+			cursor.execute("ROLLBACK TO SAVEPOINT table_exists")
+			exists = False
+		cursor.execute("RELEASE SAVEPOINT table_exists")
+		return exists
+
+	def get_schema_version(self, cursor):
+		if not self.table_exists(cursor, "schema_version"):
+			cursor.execute("CREATE TABLE schema_version (version INTEGER)")
+			cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (0,))
+		return cursor.execute("SELECT version FROM schema_version").fetchone()[0]
+
+	def set_schema_version(self, cursor, version):
+		cursor.execute("UPDATE schema_version SET version=?", (version,))
+
+class ThreadCursor:
+	# Stands in for the cursor of the connection that the current thread borrowed inside of a @database_access() function
+
+	def __getattr__(self, name):
+		return getattr(database_local.cursor, name)
+
+# Worker processes of one server coordinate through node_storage, which is always the SQLite database at
+# DATABASE_LOCATION. Everything else is kept in storage, which is the same database unless DATABASE_BACKEND is "dbapi".
+node_storage = SQLiteBackend(DATABASE_LOCATION, DATABASE_POOL_SIZE)
+storage = node_storage
+if DATABASE_BACKEND == "dbapi":
+	try:
+		storage = DBAPIBackend(DATABASE_DRIVER, DATABASE_CONNECT_ARGS, DATABASE_POOL_SIZE, DATABASE_KEY_COLUMN_TYPE)
+	except ImportError:
+		storage = None
+
+def close_database_connections():
+	for backend in set([storage, node_storage]):
+		if not backend == None:
+			backend.close()
 
-if not "database" in os.listdir():
-	os.mkdir("database")
-connection = sqlite3.connect(DATABASE_LOCATION, check_same_thread=False)
-db_access_lock = threading.Lock()
-cursor = None
+database_local = threading.local()
+cursor = ThreadCursor()
 
 format_time_no_brackets = lambda time_int: datetime.fromtimestamp(time_int).strftime("%I:%M:%S %p - %m/%d/%Y")
 format_time = lambda time_int: " [" + format_time_no_brackets(time_int) + "] "
 ctime = lambda: int(datetime.now().timestamp())
 
-def log_to_file(text, path):
-	with open(f"logs/{path}", "a+", encoding=ENCODING) as f:
-		f.write(format_time(ctime()) + text + "\n")
+def log_to_file(text, path, block=False):
+	# Records passed with block=True are never dropped, even when LOG_QUEUE_FULL_POLICY is "drop", and are flushed right away
+	log_writer.put(("file", time.time(), path, text, block), block)
 
-def database_access():
+def database_access(read_only=False, node=False):
+	# Functions with node=True use node_storage instead of storage
 	def outer(func):
 		@wraps(func)
 		def inner(*args, **kwargs):
-			db_access_lock.acquire()
-			global cursor
-			cursor = connection.cursor()
-			result = func(*args, **kwargs)
-			connection.commit()
-			db_access_lock.release()
-			return result
+			backend = node_storage if node else storage
+			# Database functions that call each other share the outer function's connection and transaction
+			if getattr(database_local, "cursor", None) is not None and database_local.backend is backend:
+				if read_only or not database_local.read_only:
+					return func(*args, **kwargs)
+				return run_nested_write(backend, func, args, kwargs)
+			# Only the outermost function is run again after a transient error, because its transaction was rolled back
+			for attempt in itertools.count():
+				try:
+					return run_transaction(backend, read_only, func, args, kwargs)
+				except Exception as error:
+					if attempt >= DATABASE_RETRIES or not backend.is_transient(error):
+						raise
+				db_retries_total.inc()
+				time.sleep(DATABASE_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1))
 		return inner
 	return outer
 
+def run_transaction(backend, read_only, func, args, kwargs):
+	wait_start = time.perf_counter()
+	conn = backend.acquire()
+	db_pool_wait_seconds.observe(time.perf_counter() - wait_start)
+	write_lock = backend.write_lock if not read_only else None
+	if not write_lock == None:
+		wait_start = time.perf_counter()
+		write_lock.acquire()
+		lock_acquired = time.perf_counter()
+		db_lock_wait_seconds.observe(lock_acquired - wait_start)
+	# A function of the other backend may be running further up on this thread
+	outer_state = [getattr(database_local, name, None) for name in ["cursor", "connection", "backend", "read_only", "after_commit"]]
+	database_local.cursor = backend.cursor(conn)
+	database_local.connection = conn
+	database_local.backend = backend
+	database_local.read_only = read_only
+	database_local.after_commit = []
+	failure = None
+	try:
+		result = func(*args, **kwargs)
+		if not read_only:
+			conn.commit()
+		else:
+			# DB-API drivers such as psycopg begin a transaction with the first SELECT, which would otherwise stay open
+			# (and keep its snapshot and locks) while the connection waits in the pool
+			conn.rollback()
+		return result
+	except BaseException as error:
+		failure = error
+		try:
+			conn.rollback()
+		except Exception:
+			pass
+		raise
+	finally:
+		callbacks = database_local.after_commit
+		database_local.cursor, database_local.connection, database_local.backend, database_local.read_only, database_local.after_commit = outer_state
+		if not write_lock == None:
+			write_lock.release()
+			db_lock_hold_seconds.observe(time.perf_counter() - lock_acquired)
+		backend.release(conn, failure)
+		for callback in callbacks:
+			callback()
+
+def run_nested_write(backend, func, args, kwargs):
+	# A write function called by a read-only one shares its connection, but takes the write lock and commits on its own.
+	# Write functions that it calls in turn see a write transaction and simply share it.
+	write_lock = backend.write_lock
+	if not write_lock == None:
+		wait_start = time.perf_counter()
+		write_lock.acquire()
+		lock_acquired = time.perf_counter()
+		db_lock_wait_seconds.observe(lock_acquired - wait_start)
+	database_local.read_only = False
+	try:
+		result = func(*args, **kwargs)
+		database_local.connection.commit()
+		return result
+	except BaseException:
+		try:
+			database_local.connection.rollback()
+		except Exception:
+			pass
+		raise
+	finally:
+		database_local.read_only = True
+		if not write_lock == None:
+			write_lock.release()
+			db_lock_hold_seconds.observe(time.perf_counter() - lock_acquired)
+
+def run_after_commit(callback):
+	# Runs `callback` once the transaction of the current @database_access() function has ended, or right away outside of one
+	if getattr(database_local, "cursor", None) is None:
+		callback()
+	else:
+		database_local.after_commit.append(callback)
+
 needed_folders = list(set(needed_folders + ["logs", "keys"]))
 
-@database_access()
 def check_and_create_files():
-
-	def table_exists(table_name, conn):
-		return conn.cursor().execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone()[0] == 1
-
 	for folder in needed_folders:
 		if not folder in os.listdir():
 			os.mkdir(folder)
+	create_tables()
+	create_node_tables()
 
+@database_access()
+def create_tables():
 	for table, statement in database_schemas.items():
-		if not table_exists(table, connection):
-			log(f"Created table '{table}' in {DATABASE_LOCATION}")
-			cursor.execute(statement)
+		if isinstance(statement, dict):
+			statement = statement[storage.name]
+		if not storage.table_exists(cursor, table):
+			log(f"Created table '{table}' in {storage}")
+			cursor.execute(statement.replace("$key_column", getattr(storage, "key_column_type", "")))
 
 			if table == "users":
 				root_password = "".join(random.choices(string.ascii_letters + string.digits, k=16))
 				log("Generated new root credentials")
 				log("A copy of the current root credentials can be found inside of logs/root_passwords.log")
-				log_to_file(f"Updated root credentials: root:{root_password}", "root_passwords.log")
-				cursor.execute("INSERT INTO users VALUES (?, ?)", ("root", create_password_hash(root_password)))
+				log_to_file(f"Updated root credentials: root:{root_password}", "root_passwords.log", block=True)
+				cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", ("root", create_password_hash(root_password)))
+
+	schema_version = storage.get_schema_version(cursor)
+	for index, statement in enumerate(database_migrations[schema_version:], schema_version):
+		if isinstance(statement, dict):
+			statement = statement[storage.name]
+		changed = cursor.execute(statement).rowcount
+		log(f"Applied database migration {index + 1}: {statement}" + (f" ({changed} rows changed)" if changed > 0 else ""))
+	if len(database_migrations) > schema_version:
+		storage.set_schema_version(cursor, len(database_migrations))
+	if storage.name == "dbapi":
+		check_key_columns()
+
+def check_key_columns():
+	# Paging through users and trimming the command history rely on every row having a rowid. A key column that the
+	# database does not fill in would leave them empty and the history growing without bound, so the server stops instead.
+	probe = f"key column check {random.getrandbits(64)}"
+	cursor.execute("SAVEPOINT key_column_check")
+	try:
+		missing = []
+		for table, column in [("users", "password"), ("command_history", "command")]:
+			cursor.execute(f"INSERT INTO {table} (username, {column}) VALUES (?, ?)", (probe, ""))
+			if cursor.execute(f"SELECT rowid FROM {table} WHERE username=?", (probe,)).fetchone()[0] == None:
+				missing.append(table)
+	finally:
+		cursor.execute("ROLLBACK TO SAVEPOINT key_column_check")
+		cursor.execute("RELEASE SAVEPOINT key_column_check")
+	if missing:
+		log(f"The rowid column of {', '.join(missing)} in {storage} is not filled in by the database. Set DATABASE_KEY_COLUMN_TYPE "
+			f"to a key column type that it fills in by itself, and create the table again with it.", type=LogType.ERROR)
+		raise KeyboardInterrupt
+
+@database_access(node=True)
+def create_node_tables():
+	for table, statement in node_database_schemas.items():
+		if not node_storage.table_exists(cursor, table):
+			log(f"Created table '{table}' in {node_storage}")
+			cursor.execute(statement)
 
 # These two functions are not used in any sample code but are explained in README.md and can be used to create nice looking tables
 def get_display_table(headings: list, data: list) -> str:
-	column_max_lens = [len(format_to_string(title)) for title in headings]
-	for data_set in data:
-		for index, column in enumerate(data_set):
-			col_length = len(format_to_string(column))
-			if col_length > column_max_lens[index]:
-				column_max_lens[index] = col_length
-	buffer = " \033[107;30m  " + "     ".join(title.ljust(column_max_lens[index]) for index, title in enumerate(headings)) + "  \033[0m"
-	for data_set in data:
-		buffer += "\n   " + "     ".join(format_to_string(value).ljust(column_max_lens[index]) for index, value in enumerate(data_set)) + "   "
-	return "\033[0m" + buffer + "\033[0m"
+	# Every value is converted to a string once, and the same string is used to measure and to pad the column
+	headings = [format_to_string(title) for title in headings]
+	rows = [[format_to_string(value) for value in data_set] for data_set in data]
+	column_max_lens = [len(title) for title in headings]
+	widen_table_columns(column_max_lens, rows)
+	return "\033[0m" + format_table_heading(headings, column_max_lens) + "".join([format_table_row(cells, column_max_lens) for cells in rows]) + "\033[0m"
+
+def widen_table_columns(column_max_lens, rows):
+	for index, column in enumerate(zip(*rows)):
+		column_max_lens[index] = max(column_max_lens[index], max(map(len, column)))
+
+def format_table_heading(headings, column_max_lens):
+	return " \033[107;30m  " + "     ".join([title.ljust(width) for title, width in zip(headings, column_max_lens)]) + "  \033[0m"
+
+def format_table_row(cells, column_max_lens):
+	return "\n   " + "     ".join([cell.ljust(width) for cell, width in zip(cells, column_max_lens)]) + "   "
+
+class TableStream:
+	# Renders a table a few rows at a time from any iterable of rows, or from a DB-API cursor through fetchmany(), so that
+	# rows are only read and formatted when they are about to be sent. Columns are as wide as width_hint and the rows seen
+	# so far. A later row that is wider widens its column, and the heading is repeated above it, so nothing is cut off.
+
+	def __init__(self, headings, rows, width_hint=None):
+		self.headings = [format_to_string(title) for title in headings]
+		self.column_max_lens = [max(len(title), width_hint[index] if width_hint and index < len(width_hint) else 0) for index, title in enumerate(self.headings)]
+		if hasattr(rows, "fetchmany"):
+			self.fetch = rows.fetchmany
+		else:
+			rows = iter(rows)
+			self.fetch = lambda count: list(itertools.islice(rows, count))
+		self.look_ahead = []
+		self.heading_lens = None
+		self.rows_rendered = 0
+
+	def has_more(self):
+		if not self.look_ahead:
+			self.look_ahead = list(self.fetch(1))
+		return len(self.look_ahead) > 0
+
+	def render(self, count):
+		# Returns the next `count` rows, preceded by the heading if it has not yet been sent with the current column widths
+		rows, self.look_ahead = self.look_ahead[:count], self.look_ahead[count:]
+		if len(rows) < count:
+			rows.extend(self.fetch(count - len(rows)))
+		rows = [[format_to_string(value) for value in row] for row in rows]
+		widen_table_columns(self.column_max_lens, rows)
+		buffer = ""
+		if not self.heading_lens == self.column_max_lens:
+			buffer = ("\n" if self.heading_lens else "") + format_table_heading(self.headings, self.column_max_lens)
+			self.heading_lens = list(self.column_max_lens)
+		self.rows_rendered += len(rows)
+		return buffer + "".join([format_table_row(cells, self.column_max_lens) for cells in rows])
 
 def format_to_string(item) -> str:
 	# Here you can definie custom rules for how table items are converted into strings
@@ -156,49 +1354,597 @@ def format_seconds_to_time(time_int):
 class CommandReturnAction:
 	BREAK = 0
 
+class SessionReaped(Exception):
+	# Raised while waiting for input when a session has been idle for too long or has outlived SESSION_MAX_LIFETIME
+
+	def __init__(self, reason):
+		Exception.__init__(self, reason)
+		self.reason = reason
+
+class CommandCancelled(BaseException):
+	# Raised inside of a command once it has been cancelled with Ctrl-C or the 'cancel' command. Like KeyboardInterrupt,
+	# it is not an Exception, so that `except Exception` in a command does not keep it from stopping.
+	pass
+
+# The Job of the command that the current thread is running, if any
+job_local = threading.local()
+
+class Job:
+	# A command run by a session. Foreground commands run on the session thread. Commands started with "&" are
+	# detached and run on command_executor, collecting their output until they are brought to the foreground.
+	# Cancellation is cooperative: a command stops with CommandCancelled the next time it sends output, waits for
+	# input or calls check_cancelled().
+
+	def __init__(self, job_id, client, line, entry, arguments, detached=False):
+		self.job_id = job_id
+		self.client = client
+		self.line = line
+		self.entry = entry
+		self.arguments = arguments
+		self.detached = detached
+		self.foreground = not detached
+		self.started = time.monotonic()
+		self.cancelled = threading.Event()
+		self.done = threading.Event()
+		self.status = "Running"
+		self.action = None
+		self.waiting_for_input = False
+		# Keys handed over by the session thread while a detached job is in the foreground
+		self.keys = queue.Queue()
+		self.output = deque()
+		self.output_size = 0
+		self.output_dropped = 0
+		self.output_lock = threading.Lock()
+
+	def capture(self, data):
+		# Keeps the last JOB_OUTPUT_LIMIT bytes of output written while in the background
+		with self.output_lock:
+			self.output.append(data)
+			self.output_size += len(data)
+			while self.output_size > JOB_OUTPUT_LIMIT and len(self.output) > 1:
+				dropped = self.output.popleft()
+				self.output_size -= len(dropped)
+				self.output_dropped += len(dropped)
+
+	def take_output(self):
+		with self.output_lock:
+			data, dropped = b"".join(self.output), self.output_dropped
+			self.output.clear()
+			self.output_size, self.output_dropped = 0, 0
+		return data, dropped
+
+	def describe(self):
+		if self.done.is_set():
+			return self.status
+		if self.cancelled.is_set():
+			return "Cancelling"
+		return "Waiting for input" if self.waiting_for_input else "Running"
+
 class PermissionsLevel:
 	NORMAL, ROOT = 0, 1
 
+class CompletionIndex:
+	# Sorted list of autocomplete options. All options starting with a prefix are found with two binary searches.
+
+	def __init__(self, options=()):
+		self.options = sorted(set(options))
+
+	def add(self, option):
+		index = bisect.bisect_left(self.options, option)
+		if index == len(self.options) or not self.options[index] == option:
+			self.options.insert(index, option)
+
+	def remove(self, option):
+		index = bisect.bisect_left(self.options, option)
+		if index < len(self.options) and self.options[index] == option:
+			del self.options[index]
+
+	def matches(self, prefix):
+		start = bisect.bisect_left(self.options, prefix)
+		end = bisect.bisect_left(self.options, prefix + "\U0010ffff", start)
+		return self.options[start:end]
+
+CommandEntry = namedtuple("CommandEntry", ["name", "func", "description", "permissions_level", "completer"])
+
+class CommandRegistry:
+	# Built once when the module is loaded; every session dispatches and completes against the same registry
+
+	def __init__(self):
+		self.commands = {}
+		self.index = CompletionIndex()
+
+	def command(self, description, names, permissions_level=PermissionsLevel.NORMAL, completer=None):
+		def command_func_inner(func):
+			for name in names:
+				self.commands[name] = CommandEntry(names[0], func, description, permissions_level, completer)
+				self.index.add(name)
+			return func
+		return command_func_inner
+
+command_registry = CommandRegistry()
+command = command_registry.command
+
+class CommandHistory:
+	# Fixed size ring buffer of commands where index 0 is the most recent one. Consecutive duplicates are only stored
+	# once. If a loader is given, it is only called once the history is first used and must return the older
+	# commands, oldest first.
+
+	def __init__(self, capacity, loader=None):
+		self.capacity = capacity
+		self.entries = [None] * capacity
+		self.start = 0
+		self.size = 0
+		self.loader = loader
+
+	def append(self, command):
+		if not self.loader == None:
+			self.load()
+		if self.capacity == 0 or not command or (self.size > 0 and self.entries[(self.start + self.size - 1) % self.capacity] == command):
+			return False
+		self.entries[(self.start + self.size) % self.capacity] = command
+		if self.size < self.capacity:
+			self.size += 1
+		else:
+			self.start = (self.start + 1) % self.capacity
+		return True
+
+	def load(self):
+		loader, self.loader = self.loader, None
+		for command in loader():
+			self.append(command)
+
+	def __len__(self):
+		if not self.loader == None:
+			self.load()
+		return self.size
+
+	def __getitem__(self, index):
+		if not self.loader == None:
+			self.load()
+		if not 0 <= index < self.size:
+			raise IndexError("history index out of range")
+		return self.entries[(self.start + self.size - 1 - index) % self.capacity]
+
+class HistoryView:
+	# The lines that get_input() scrolls through: index 0 is the line being typed and index N is the Nth most recent
+	# history entry. Edits made while scrolling are kept in the view and never change the history itself.
+
+	def __init__(self, history):
+		self.history = history
+		self.edits = {0: ""}
+
+	def __len__(self):
+		return len(self.history) + 1
+
+	def __getitem__(self, index):
+		return self.edits[index] if index in self.edits else self.history[index - 1]
+
+	def __setitem__(self, index, value):
+		self.edits[index] = value
+
+class CompletionCache:
+	# Completion results for the prefixes typed so far on one line. A prefix that extends a cached one is answered by
+	# filtering that prefix's results, and going back to a shorter prefix reuses the results it had before. Typing a
+	# space always asks `lookup` again, because a completer offers arguments instead of command names after one.
+
+	def __init__(self, lookup):
+		self.lookup = lookup
+		self.results = []
+
+	def matches(self, prefix):
+		while self.results and not prefix.startswith(self.results[-1][0]):
+			self.results.pop()
+		if self.results and self.results[-1][0] == prefix:
+			return self.results[-1][1]
+		if self.results and not " " in prefix[len(self.results[-1][0]):]:
+			matches = [option for option in self.results[-1][1] if option.startswith(prefix)]
+		else:
+			matches = self.lookup(prefix)
+		self.results.append((prefix, matches))
+		return matches
+
+class InputDecoder:
+	# Turns the bytes read from a client into keys, whatever way they were split into reads. Text comes out as str, with a
+	# run of characters (such as a paste) as one string, and other keys as bytes: a control character such as b"\r", or a
+	# whole escape sequence such as b"\x1b[A". Incomplete escape sequences and UTF-8 characters wait for the next read,
+	# and bytes that are not valid UTF-8 become U+FFFD instead of an error.
+
+	MAX_SEQUENCE_LENGTH = 32
+
+	def __init__(self):
+		self.text_decoder = codecs.getincrementaldecoder(ENCODING)(errors="replace")
+		self.sequence = b""
+
+	def pending(self):
+		# True while a lone escape byte is held back, because it may be the start of a sequence that has not arrived yet
+		return len(self.sequence) > 0
+
+	def flush(self):
+		# Called when no more bytes followed an escape byte in time, so it was the escape key after all
+		keys, self.sequence = [self.sequence] if self.sequence else [], b""
+		return keys
+
+	def feed(self, data):
+		keys, text, index = [], "", 0
+		data, self.sequence = self.sequence + data, b""
+		while index < len(data):
+			byte = data[index]
+			if byte >= 0x20 and not byte == 0x7f:
+				end = index + 1
+				while end < len(data) and data[end] >= 0x20 and not data[end] == 0x7f:
+					end += 1
+				text += self.text_decoder.decode(data[index:end])
+				index = end
+				continue
+			# An escape or control byte ends a UTF-8 character that is still missing bytes
+			text += self.text_decoder.decode(b"", final=True)
+			if text:
+				keys.append(text)
+				text = ""
+			if byte == 0x1b:
+				length = self.escape_sequence_length(data, index)
+				if length == None:
+					self.sequence = data[index:]
+					return keys
+				keys.append(data[index:index + length])
+				index += length
+			else:
+				if not byte == 0x00:
+					keys.append(data[index:index + 1])
+				index += 1
+		if text:
+			keys.append(text)
+		return keys
+
+	def escape_sequence_length(self, data, start):
+		# Length of the escape sequence at data[start], or None if more bytes are needed to know where it ends
+		if start + 1 >= len(data):
+			return None
+		introducer = data[start + 1]
+		if introducer == 0x1b:
+			return 1
+		if introducer == ord("O"):
+			return 3 if start + 2 < len(data) else None
+		if not introducer == ord("["):
+			# Alt held down with a key, such as b"\x1bb"
+			return 2
+		# A CSI sequence: parameter and intermediate bytes followed by one final byte from 0x40 to 0x7e
+		end = start + 2
+		while end < len(data) and 0x20 <= data[end] <= 0x3f and end - start < self.MAX_SEQUENCE_LENGTH:
+			end += 1
+		if end == len(data):
+			return None
+		# A byte that cannot end the sequence, such as the enter key, is left to be read as a key of its own
+		return end - start + 1 if 0x40 <= data[end] <= 0x7e else end - start
+
+def cursor_motion(offset):
+	if offset == -1:
+		return "\b"
+	if offset < 0:
+		return f"\x1b[{-offset}D"
+	if offset > 0:
+		return f"\x1b[{offset}C"
+	return ""
+
+class LineEditor:
+	# The state of the line being typed in get_input(). handle_key() only changes the state, and render() returns the
+	# fewest escape sequences that turn what the terminal currently shows into the new state.
+
+	KEY_ACTIONS = {
+		b"\x7f": "backspace", b"\x08": "backspace", b"\x1b[3~": "delete",
+		b"\t": "complete", b"\r": "submit", b"\x1b": "escape",
+		b"\x1b[A": "history_back", b"\x1bOA": "history_back", b"\x10": "history_back",
+		b"\x1b[B": "history_forward", b"\x1bOB": "history_forward", b"\x0e": "history_forward",
+		b"\x1b[D": "left", b"\x1bOD": "left", b"\x02": "left",
+		b"\x1b[C": "right", b"\x1bOC": "right", b"\x06": "right",
+		b"\x1b[H": "home", b"\x1bOH": "home", b"\x1b[1~": "home", b"\x1b[7~": "home", b"\x01": "home",
+		b"\x1b[F": "end", b"\x1bOF": "end", b"\x1b[4~": "end", b"\x1b[8~": "end", b"\x05": "end",
+		b"\x1b[1;5D": "word_left", b"\x1b[1;3D": "word_left", b"\x1bb": "word_left",
+		b"\x1b[1;5C": "word_right", b"\x1b[1;3C": "word_right", b"\x1bf": "word_right",
+		b"\x15": "kill_to_start", b"\x0b": "kill_to_end", b"\x17": "kill_word",
+	}
+
+	def __init__(self, history, lookup, empty_response_allowed=False):
+		# Index 0 of `lines` is the new line and index N is the Nth most recent history entry
+		self.lines = HistoryView(history)
+		self.history_pos = 0
+		self.cursor = 0
+		self.completions = CompletionCache(lookup)
+		self.empty_response_allowed = empty_response_allowed
+		# (line before Tab was first pressed, its completions, index of the one shown) while Tab is cycling
+		self.cycle = None
+		self.submitted = False
+		self.bell = False
+		self.shown_text, self.shown_preview, self.shown_cursor = "", "", 0
+
+	@property
+	def line(self):
+		return self.lines[self.history_pos]
+
+	def set_line(self, line, cursor=None):
+		self.lines[self.history_pos] = line
+		self.cursor = len(line) if cursor == None else cursor
+
+	def handle_key(self, key):
+		# `key` comes from an InputDecoder: typed text as str, or a control key or escape sequence as bytes
+		if isinstance(key, str):
+			self.cycle = None
+			self.insert(key)
+			return
+		action = self.KEY_ACTIONS.get(key)
+		if not action == "complete":
+			self.cycle = None
+		if not action == None:
+			getattr(self, "key_" + action)()
+
+	def insert(self, text):
+		room = MAX_INPUT_LINE_LENGTH - len(self.line)
+		if len(text) > room:
+			text = text[:max(room, 0)]
+			self.bell = True
+		if text:
+			self.set_line(self.line[:self.cursor] + text + self.line[self.cursor:], self.cursor + len(text))
+
+	def key_backspace(self):
+		if self.cursor > 0:
+			self.set_line(self.line[:self.cursor - 1] + self.line[self.cursor:], self.cursor - 1)
+
+	def key_delete(self):
+		if self.cursor < len(self.line):
+			self.set_line(self.line[:self.cursor] + self.line[self.cursor + 1:], self.cursor)
+
+	def key_complete(self):
+		# The first Tab completes the line to its first match and every further Tab moves on to the next one
+		if self.cycle == None:
+			self.cycle = (self.line, self.completions.matches(self.line), -1)
+		start, options, index = self.cycle
+		if len(options) == 0:
+			return
+		index = (index + 1) % len(options)
+		self.cycle = (start, options, index)
+		self.set_line(options[index])
+
+	def key_submit(self):
+		if len(self.line) > 0 or self.empty_response_allowed:
+			self.submitted = True
+
+	def key_escape(self):
+		# Returns from the history to the new line, or clears the new line if it is already shown
+		if self.history_pos == 0:
+			self.set_line("")
+		else:
+			self.history_pos = 0
+			self.cursor = len(self.line)
+
+	def key_history_back(self):
+		if self.history_pos + 1 < len(self.lines):
+			self.history_pos += 1
+			self.cursor = len(self.line)
+
+	def key_history_forward(self):
+		if self.history_pos > 0:
+			self.history_pos -= 1
+			self.cursor = len(self.line)
+
+	def key_left(self):
+		self.cursor = max(self.cursor - 1, 0)
+
+	def key_right(self):
+		# At the end of the line, accepts the completion that is previewed
+		if self.cursor == len(self.line):
+			self.insert(self.get_preview())
+		else:
+			self.cursor += 1
+
+	def key_home(self):
+		self.cursor = 0
+
+	def key_end(self):
+		self.cursor = len(self.line)
+
+	def key_word_left(self):
+		self.cursor = self.line[:self.cursor].rstrip(" ").rfind(" ") + 1
+
+	def key_word_right(self):
+		stripped = self.line[self.cursor:].lstrip(" ")
+		next_space = stripped.find(" ")
+		self.cursor = len(self.line) - len(stripped) + (next_space if next_space >= 0 else len(stripped))
+
+	def key_kill_to_start(self):
+		self.set_line(self.line[self.cursor:], 0)
+
+	def key_kill_to_end(self):
+		self.set_line(self.line[:self.cursor], self.cursor)
+
+	def key_kill_word(self):
+		start = self.cursor
+		self.key_word_left()
+		self.set_line(self.line[:self.cursor] + self.line[start:], self.cursor)
+
+	def get_preview(self):
+		# The rest of the first completion that is longer than the line, shown in grey while the cursor is at the end
+		if self.submitted or len(self.line) == 0 or not self.cursor == len(self.line):
+			return ""
+		matches = self.completions.matches(self.line)
+		index = 1 if len(matches) > 0 and matches[0] == self.line else 0
+		return matches[index][len(self.line):] if len(matches) > index else ""
+
+	def reset_display(self):
+		# Called once the line has been erased from the terminal, so that the next render() draws all of it again
+		self.shown_text, self.shown_preview, self.shown_cursor = "", "", 0
+
+	def render(self):
+		text, preview = self.line, self.get_preview()
+		old, new = self.shown_text + self.shown_preview, text + preview
+		# A character on screen can stay if it is the same and has the same colour
+		same = 0
+		while same < len(old) and same < len(new) and old[same] == new[same] and (same < len(self.shown_text)) == (same < len(text)):
+			same += 1
+		end = len(new)
+		if len(old) == len(new):
+			# Only the changed span is rewritten when the length stays the same, such as when a completion is cycled
+			while end > same and old[end - 1] == new[end - 1] and (end - 1 < len(self.shown_text)) == (end - 1 < len(text)):
+				end -= 1
+		output = ""
+		if same < end or len(old) > len(new):
+			output += cursor_motion(same - self.shown_cursor)
+			if same < len(text):
+				output += text[same:min(end, len(text))]
+			if max(same, len(text)) < end:
+				output += "\x1b[90m" + new[max(same, len(text)):end] + "\x1b[0m"
+			if len(old) > len(new):
+				output += "\x1b[0K"
+			output += cursor_motion(self.cursor - end)
+		else:
+			output += cursor_motion(self.cursor - self.shown_cursor)
+		if self.bell:
+			output += "\x07"
+			self.bell = False
+		self.shown_text, self.shown_preview, self.shown_cursor = text, preview, self.cursor
+		return output
+
+class UserCache:
+	# A least recently used cache of password hashes by username, where None records that a username does not exist.
+	# Every change to the users table calls invalidate() once it is committed, which empties the caches of all worker
+	# processes through a counter in shared memory. Entries also expire after `ttl` seconds, which bounds how long a
+	# change made by another server generation or outside of the server goes unnoticed.
+
+	def __init__(self, size, ttl):
+		self.size = size
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+		self.generation = multiprocessing.Value("Q", 0)
+		self.seen_generation = 0
+		self.hits, self.misses = 0, 0
+
+	def get(self, username, load):
+		with self.lock:
+			generation = self.generation.value
+			if not generation == self.seen_generation:
+				self.entries.clear()
+				self.seen_generation = generation
+			entry = self.entries.get(username)
+			if not entry == None and entry[1] > time.monotonic():
+				self.entries.move_to_end(username)
+				self.hits += 1
+				return entry[0]
+			self.misses += 1
+		password_hash = load(username)
+		with self.lock:
+			# A value loaded while the users table changed may already be outdated, so it is not kept
+			if generation == self.generation.value and self.size > 0:
+				self.entries[username] = (password_hash, time.monotonic() + self.ttl)
+				self.entries.move_to_end(username)
+				if len(self.entries) > self.size:
+					self.entries.popitem(last=False)
+		return password_hash
+
+	def invalidate(self):
+		with self.generation.get_lock():
+			self.generation.value += 1
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
 class SSHPanelDatabase:
 
 	def __init__(self, user):
 		self.user = user
 
-	@database_access()
+	# Passwords are hashed before any of the database functions below are entered, so that no connection
+	# or write lock is held while the key derivation function runs.
 	def check_login_credentials(self, username, password):
-		result = cursor.execute("SELECT password FROM users WHERE username=?", (username,)).fetchone()
-		if not result or not result[0] == create_password_hash(password):
-			return False
-		return True
+		verify_start = time.perf_counter()
+		result = login_verifier.verify(password, self.get_password_hash(username))
+		login_verify_seconds.observe(time.perf_counter() - verify_start)
+		if result == None:
+			logins_total.inc(labels=("busy",))
+			return None
+		matches, new_password_hash = result
+		logins_total.inc(labels=("success" if matches else "failure",))
+		if new_password_hash:
+			self.__set_password_hash(username, new_password_hash)
+		return matches
 
-	@database_access()
 	def regenerate_root_password(self):
 		root_password = "".join(random.choices(string.ascii_letters + string.digits, k=16))
+		self.__replace_root_password_hash(create_password_hash(root_password))
 		log("Generated new root credentials")
 		log("A copy of the current root credentials can be found inside of logs/root_passwords.log")
-		log_to_file(f"Updated root credentials: root:{root_password}", "root_passwords.log")
-		cursor.execute("DELETE FROM users WHERE username=?", ("root",))
-		cursor.execute("INSERT INTO users VALUES (?, ?)", ("root", create_password_hash(root_password)))
+		log_to_file(f"Updated root credentials: root:{root_password}", "root_passwords.log", block=True)
 
-	@database_access()
 	def set_user_password(self, username, password):
-		cursor.execute("UPDATE users SET password=? WHERE username=?", (create_password_hash(password), username))
+		self.__set_password_hash(username, create_password_hash(password))
 
-	@database_access()
 	def add_new_user(self, username, password):
-		cursor.execute("INSERT INTO users VALUES (?, ?)", (username, create_password_hash(password)))
+		self.__insert_user(username, create_password_hash(password))
+
+	# Returns the stored password hash of a user, or None if the user does not exist, from user_cache when possible
+	def get_password_hash(self, username):
+		return user_cache.get(username, self.__get_password_hash)
+
+	@database_access(read_only=True)
+	def __get_password_hash(self, username):
+		result = cursor.execute("SELECT password FROM users WHERE username=?", (username,)).fetchone()
+		return result[0] if result else None
+
+	@database_access()
+	def __set_password_hash(self, username, password_hash):
+		cursor.execute("UPDATE users SET password=? WHERE username=?", (password_hash, username))
+		run_after_commit(user_cache.invalidate)
+
+	@database_access()
+	def __insert_user(self, username, password_hash):
+		cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password_hash))
+		run_after_commit(user_cache.invalidate)
+
+	@database_access()
+	def __replace_root_password_hash(self, password_hash):
+		cursor.execute("DELETE FROM users WHERE username=?", ("root",))
+		cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", ("root", password_hash))
+		run_after_commit(user_cache.invalidate)
 
 	@database_access()
 	def remove_user(self, username):
 		cursor.execute("DELETE FROM users WHERE username=?", (username,))
+		run_after_commit(user_cache.invalidate)
+
+	@database_access(read_only=True)
+	def load_command_history(self, username, limit):
+		# Returns the newest `limit` commands oldest first, and the rowid of the oldest one if older rows exist
+		rows = cursor.execute("SELECT rowid, command FROM command_history WHERE username=? ORDER BY rowid DESC LIMIT ?", (username, limit + 1)).fetchall()
+		oldest_rowid = rows[limit - 1][0] if len(rows) > limit else None
+		return [command for _, command in reversed(rows[:limit])], oldest_rowid
+
+	@database_access()
+	def save_command(self, username, command):
+		cursor.execute("INSERT INTO command_history (username, command) VALUES (?, ?)", (username, command))
+
+	@database_access()
+	def trim_command_history(self, username, oldest_rowid):
+		cursor.execute("DELETE FROM command_history WHERE username=? AND rowid < ?", (username, oldest_rowid))
+
+	@database_access(read_only=True)
+	def get_users_page(self, after_rowid, limit):
+		return cursor.execute("SELECT rowid, username, password FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?", (after_rowid, limit)).fetchall()
+
+	def iterate_users(self, page_size=TABLE_CHUNK_ROWS):
+		# Yields (username, password_hash) one page per query, so no connection is held while a client reads the pager
+		after_rowid = 0
+		while True:
+			page = self.get_users_page(after_rowid, page_size)
+			for _, username, password_hash in page:
+				yield username, password_hash
+			if len(page) < page_size:
+				return
+			after_rowid = page[-1][0]
 
 	def log_login(self, username, ip, port):
 		log_to_file(f"User logged in: '{username}' from {ip}:{port}", "logins.log")
 
-	# Use this function for external calls that have not already locked all threads
-	@database_access()
+	# Use this function for calls from outside of other database functions. It is answered from user_cache when possible.
 	def user_exists(self, username):
-		return self.__user_exists(username)
+		return not self.get_password_hash(username) == None
 
 	# Use this function strictly for internal database calls from functions that have the @database_access() decorator
 	def __user_exists(self, username):
@@ -217,6 +1963,8 @@ class SSHServerEmulator(paramiko.ServerInterface):
 	def __init__(self):
 		self.username, self.password = None, None
 		self.event = threading.Event()
+		self.term, self.term_size = None, (80, 24)
+		self.recording = None
 
 	def check_channel_request(self, kind, _):
 		if kind == "session":
@@ -236,11 +1984,400 @@ class SSHServerEmulator(paramiko.ServerInterface):
 		return True
 
 	def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+		self.term, self.term_size = term.decode(ENCODING, "replace") if isinstance(term, bytes) else term, (width, height)
+		return True
+
+	def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
+		self.term_size = (width, height)
+		if not self.recording == None:
+			self.recording.resize(width, height)
+		return True
+
+class AdmissionControl:
+	# Bounds the number of sockets waiting for a thread, the number of SSH handshakes in progress and the
+	# number of logged-in sessions. Every rejected connection is counted under the stage that refused it.
+
+	def __init__(self, max_handshakes, max_sessions, pending_size, pending_timeout):
+		self.pending = queue.Queue(pending_size)
+		self.pending_timeout = pending_timeout
+		self.handshake_slots = threading.BoundedSemaphore(max_handshakes)
+		self.session_slots = threading.BoundedSemaphore(max_sessions)
+		self.counter_lock = threading.Lock()
+		self.rejections = {"pending_full": 0, "pending_timeout": 0, "handshakes_full": 0, "sessions_full": 0}
+		self.active_handshakes = 0
+		self.active_clients = 0
+
+	def reject(self, stage):
+		with self.counter_lock:
+			self.rejections[stage] += 1
+
+	def get_rejection_counts(self):
+		with self.counter_lock:
+			return dict(self.rejections)
+
+	def submit(self, sock, address):
+		try:
+			self.pending.put_nowait((sock, address, time.monotonic()))
+			return True
+		except queue.Full:
+			self.reject("pending_full")
+			sock.close()
+			return False
+
+	def next_connection(self):
+		# Blocks until a handshake slot is free, discarding connections that waited in the queue for too long
+		while True:
+			sock, address, queued_at = self.pending.get()
+			self.handshake_slots.acquire()
+			if time.monotonic() - queued_at > self.pending_timeout:
+				self.handshake_slots.release()
+				self.reject("pending_timeout")
+				sock.close()
+				continue
+			self.count("active_handshakes", 1)
+			return sock, address
+
+	def try_begin_handshake(self):
+		if self.handshake_slots.acquire(blocking=False):
+			self.count("active_handshakes", 1)
+			return True
+		self.reject("handshakes_full")
+		return False
+
+	def end_handshake(self):
+		self.count("active_handshakes", -1)
+		self.handshake_slots.release()
+
+	def count(self, counter, amount):
+		with self.counter_lock:
+			setattr(self, counter, getattr(self, counter) + amount)
+
+	def busy(self):
+		# True while any connection is waiting, in its handshake or owned by a client thread
+		return not self.pending.empty() or self.active_handshakes > 0 or self.active_clients > 0
+
+	def try_begin_session(self):
+		if self.session_slots.acquire(blocking=False):
+			return True
+		self.reject("sessions_full")
+		return False
+
+	def end_session(self):
+		self.session_slots.release()
+
+admission = AdmissionControl(MAX_CONCURRENT_HANDSHAKES, MAX_CONCURRENT_SESSIONS, PENDING_QUEUE_SIZE, PENDING_QUEUE_TIMEOUT)
+
+class ConnectionLimiter:
+	# A token bucket for every source of connections, checked right after accept() so that a source that connects too
+	# often is refused before it costs a thread or a key exchange. Addresses are grouped into subnets by their first
+	# `ipv4_prefix` or `ipv6_prefix` bits. After `penalty_after` failed logins in a row, a source is refused for
+	# `penalty_base` seconds, doubling with every further failure up to `penalty_max`. Sources are kept in least recently
+	# used order and forgotten once their bucket is full again and their penalty is over, and at most `size` are kept,
+	# so that a scan from many addresses cannot grow the table without bound.
+
+	# Entries are lists of [tokens, updated, failures, last_failure, blocked_until]
+	TOKENS, UPDATED, FAILURES, LAST_FAILURE, BLOCKED_UNTIL = range(5)
+
+	def __init__(self, rate, burst, size, ipv4_prefix, ipv6_prefix, penalty_after, penalty_base, penalty_max):
+		self.rate = rate
+		self.burst = burst
+		self.size = size
+		# By the length of the packed address
+		self.prefixes = {4: ipv4_prefix, 16: ipv6_prefix}
+		self.penalty_after = penalty_after
+		self.penalty_base = penalty_base
+		self.penalty_max = penalty_max
+		self.sources = OrderedDict()
+		self.lock = threading.Lock()
+		self.rejections = {"rate": 0, "penalty": 0}
+		self.penalties = 0
+		self.evictions = 0
+
+	def source_key(self, host):
+		# The subnet of `host` as (address length, leading bits). IPv4 addresses mapped into IPv6 count as IPv4.
+		try:
+			packed = socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host.partition("%")[0])
+		except (OSError, ValueError):
+			return host
+		if packed[:12] == b"\0" * 10 + b"\xff\xff":
+			packed = packed[12:]
+		return (len(packed), int.from_bytes(packed, "big") >> (len(packed) * 8 - self.prefixes[len(packed)]))
+
+	def entry(self, key, now):
+		# Returns the entry of `key` with its tokens refilled up to `now`, creating it if needed. Must hold the lock.
+		entry = self.sources.get(key)
+		if entry == None:
+			self.expire(now)
+			entry = self.sources[key] = [self.burst, now, 0, 0, 0]
+		else:
+			entry[self.TOKENS] = min(self.burst, entry[self.TOKENS] + (now - entry[self.UPDATED]) * self.rate)
+			entry[self.UPDATED] = now
+			self.sources.move_to_end(key)
+		return entry
+
+	def expire(self, now):
+		# The least recently used entries are at the front, so this stops at the first one that is still needed
+		while self.sources:
+			key, entry = next(iter(self.sources.items()))
+			needed = (entry[self.TOKENS] + (now - entry[self.UPDATED]) * self.rate < self.burst or entry[self.BLOCKED_UNTIL] > now
+				or (entry[self.FAILURES] > 0 and now - entry[self.LAST_FAILURE] <= self.penalty_max))
+			if needed and len(self.sources) < self.size:
+				return
+			if needed:
+				self.evictions += 1
+			del self.sources[key]
+
+	def allow(self, host):
+		if self.rate <= 0 and self.penalty_after <= 0:
+			return True
+		now = time.monotonic()
+		key = self.source_key(host)
+		with self.lock:
+			entry = self.entry(key, now)
+			if entry[self.BLOCKED_UNTIL] > now:
+				self.rejections["penalty"] += 1
+				return False
+			if self.rate > 0:
+				if entry[self.TOKENS] < 1:
+					self.rejections["rate"] += 1
+					return False
+				entry[self.TOKENS] -= 1
+			return True
+
+	def record_login_failure(self, host):
+		# Returns the number of seconds that the source is now refused for, or 0
+		if self.penalty_after <= 0:
+			return 0
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entry(self.source_key(host), now)
+			if now - entry[self.LAST_FAILURE] > self.penalty_max:
+				entry[self.FAILURES] = 0
+			entry[self.FAILURES] += 1
+			entry[self.LAST_FAILURE] = now
+			if entry[self.FAILURES] < self.penalty_after:
+				return 0
+			self.penalties += 1
+			duration = min(self.penalty_base * 2 ** min(entry[self.FAILURES] - self.penalty_after, 32), self.penalty_max)
+			entry[self.BLOCKED_UNTIL] = now + duration
+			return duration
+
+	def record_login_success(self, host):
+		with self.lock:
+			entry = self.sources.get(self.source_key(host))
+			if not entry == None:
+				entry[self.FAILURES] = 0
+
+	def get_rejection_counts(self):
+		with self.lock:
+			return dict(self.rejections)
+
+connection_limiter = ConnectionLimiter(CONNECTION_RATE_LIMIT, CONNECTION_RATE_BURST, RATE_LIMIT_TABLE_SIZE, RATE_LIMIT_IPV4_PREFIX, RATE_LIMIT_IPV6_PREFIX, LOGIN_PENALTY_AFTER, LOGIN_PENALTY_BASE, LOGIN_PENALTY_MAX)
+
+class MessageQueue:
+	# The messages waiting to be written to one session. Any thread can put() a message, but only the session's own
+	# thread takes them, so that they never interleave with its output and a slow client only holds up its own thread.
+	# When MESSAGE_QUEUE_SIZE messages are waiting, "drop_oldest" makes room by dropping the oldest one, and
+	# "disconnect" refuses every further message and calls `on_overflow` once.
+
+	def __init__(self, size, policy, on_overflow):
+		self.lock = threading.Lock()
+		self.messages = deque()
+		self.size = size
+		self.policy = policy
+		self.on_overflow = on_overflow
+		self.dropped = 0
+		self.overflowed = False
+
+	def put(self, data):
+		# Returns whether the message was queued
+		with self.lock:
+			if self.overflowed:
+				return False
+			if len(self.messages) < self.size or self.policy == "drop_oldest":
+				if len(self.messages) >= self.size:
+					self.messages.popleft()
+					self.dropped += 1
+					messages_dropped_total.inc(1, ("drop_oldest",))
+				self.messages.append(data)
+				return True
+			self.overflowed = True
+			messages_dropped_total.inc(len(self.messages) + 1, ("disconnect",))
+			self.messages.clear()
+		self.on_overflow()
+		return False
+
+	def take(self):
+		# Returns the waiting messages and how many were dropped since the last call
+		with self.lock:
+			messages, dropped = list(self.messages), self.dropped
+			self.messages.clear()
+			self.dropped = 0
+			return messages, dropped
+
+	def __len__(self):
+		return len(self.messages)
+
+class SessionRegistry:
+	# Thread-safe registry of logged-in clients keyed by session ID, with indexes by username and by IP address.
+	# snapshot() returns an immutable tuple that is only rebuilt after the registry changes, so commands can
+	# iterate over every session without holding the lock.
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.sessions = {}
+		self.by_username = {}
+		self.by_ip = {}
+		self.cached_snapshot = ()
+		self.reaped = {"idle": 0, "lifetime": 0}
+		self.throttled_reads = 0
+		# Set in worker processes, which also record their sessions in the active_sessions table for each other
+		self.shared = False
+
+	def register(self, client):
+		with self.lock:
+			self.sessions[client.session_id] = client
+			self.by_username.setdefault(client.database.user, set()).add(client.session_id)
+			self.by_ip.setdefault(client.address[0], set()).add(client.session_id)
+			self.cached_snapshot = None
+		if self.shared:
+			add_shared_session(client.session_id, os.getpid(), client.database.user, client.ip, client.login_time)
+
+	def unregister(self, session_id):
+		# Safe to call more than once for the same session
+		with self.lock:
+			client = self.sessions.pop(session_id, None)
+			if client == None:
+				return False
+			for index, key in ((self.by_username, client.database.user), (self.by_ip, client.address[0])):
+				index[key].discard(session_id)
+				if len(index[key]) == 0:
+					del index[key]
+			self.cached_snapshot = None
+		if self.shared:
+			remove_shared_session(session_id)
 		return True
 
+	def get(self, session_id):
+		return self.sessions.get(session_id)
+
+	def snapshot(self):
+		with self.lock:
+			if self.cached_snapshot == None:
+				self.cached_snapshot = tuple(self.sessions.values())
+			return self.cached_snapshot
+
+	def describe_all(self):
+		# Rows of (session_id, username, ip, login_time) for every session, including those of other worker processes
+		if self.shared:
+			return get_shared_sessions()
+		return [(client.session_id, client.database.user, client.ip, client.login_time) for client in self.snapshot()]
+
+	def for_user(self, username):
+		with self.lock:
+			return tuple(self.sessions[session_id] for session_id in self.by_username.get(username, ()))
+
+	def for_ip(self, ip):
+		with self.lock:
+			return tuple(self.sessions[session_id] for session_id in self.by_ip.get(ip, ()))
+
+	def count(self):
+		return len(self.sessions)
+
+	def count_for_user(self, username):
+		with self.lock:
+			return len(self.by_username.get(username, ()))
+
+	def record_reap(self, reason):
+		with self.lock:
+			self.reaped[reason] += 1
+
+	def record_throttle(self):
+		with self.lock:
+			self.throttled_reads += 1
+
+sessions = SessionRegistry()
+
+@database_access(node=True)
+def add_shared_session(session_id, pid, username, ip, login_time):
+	cursor.execute("INSERT OR REPLACE INTO active_sessions VALUES (?, ?, ?, ?, ?, 0)", (session_id, pid, username, ip, login_time))
+
+@database_access(node=True)
+def remove_shared_session(session_id):
+	cursor.execute("DELETE FROM active_sessions WHERE session_id=?", (session_id,))
+
+@database_access(node=True)
+def remove_worker_sessions(pid=None):
+	if pid == None:
+		cursor.execute("DELETE FROM active_sessions")
+	else:
+		cursor.execute("DELETE FROM active_sessions WHERE pid=?", (pid,))
+
+@database_access(read_only=True, node=True)
+def get_shared_sessions():
+	return cursor.execute("SELECT session_id, username, ip, login_time FROM active_sessions ORDER BY session_id").fetchall()
+
+@database_access(node=True)
+def request_kick(session_id):
+	return cursor.execute("UPDATE active_sessions SET kick_requested=1 WHERE session_id=?", (session_id,)).rowcount > 0
+
+@database_access(read_only=True, node=True)
+def get_kick_requests(pid):
+	return [row[0] for row in cursor.execute("SELECT session_id FROM active_sessions WHERE pid=? AND kick_requested=1", (pid,)).fetchall()]
+
+def watch_kick_requests():
+	# Sessions are owned by the worker that accepted them, so a kick from another worker is passed on through the database
+	while True:
+		time.sleep(1)
+		try:
+			for requested_session_id in get_kick_requests(os.getpid()):
+				client = sessions.get(requested_session_id)
+				if client == None:
+					remove_shared_session(requested_session_id)
+				else:
+					client.force_disconnect()
+		except:
+			if DEBUG_RAISE_ERRORS:
+				raise
+
+def broadcast(message, exclude=None):
+	# Queues `message` for every logged-in session of this process except the one with the Session ID `exclude`, and
+	# returns how many sessions it was queued for. Only the queues are touched, so a slow client never holds it up.
+	queued = 0
+	for client in sessions.snapshot():
+		if not client.session_id == exclude and client.notify(message):
+			queued += 1
+	return queued
+
+@database_access(node=True)
+def publish_broadcast(message):
+	# Broadcasts are only kept long enough for every worker to have read them
+	cursor.execute("DELETE FROM broadcasts WHERE created<?", (time.time() - 60,))
+	cursor.execute("INSERT INTO broadcasts (pid, message, created) VALUES (?, ?, ?)", (os.getpid(), message, time.time()))
+
+@database_access(read_only=True, node=True)
+def get_broadcasts(after):
+	return cursor.execute("SELECT broadcast_id, pid, message FROM broadcasts WHERE broadcast_id>? ORDER BY broadcast_id", (after,)).fetchall()
+
+def watch_broadcasts():
+	# Passes on the broadcasts made in other worker processes to the sessions of this one, like watch_kick_requests()
+	rows = get_broadcasts(0)
+	last_seen = rows[-1][0] if rows else 0
+	while True:
+		time.sleep(1)
+		try:
+			for broadcast_id, pid, message in get_broadcasts(last_seen):
+				last_seen = broadcast_id
+				if not pid == os.getpid():
+					broadcast(message)
+		except:
+			if DEBUG_RAISE_ERRORS:
+				raise
+
 class SSHControlPanelClient(threading.Thread):
+	CANCEL_CHECK_INTERVAL = 0.1
 
-	def __init__(self, sock: socket.socket, address, session_id):
+	def __init__(self, sock: socket.socket, address, session_id, chan=None, server=None, holds_handshake_slot=False):
 		threading.Thread.__init__(self, daemon=True)
 		self.sock = sock
 		self.address = address
@@ -249,10 +2386,60 @@ class SSHControlPanelClient(threading.Thread):
 		self.kill_socket_immediately = True
 		self.session_id = session_id
 		self.transport = None
+		# The asyncio engine performs the SSH handshake itself and hands over a ready channel
+		self.chan = chan
+		self.server = server
+		self.holds_handshake_slot = holds_handshake_slot
+		self.holds_session_slot = False
+		self.output_buffer = []
+		self.writes_sent = 0
+		self.bytes_sent = 0
+		self.connected_at = time.monotonic()
+		self.input_tokens = INPUT_RATE_BURST
+		self.input_tokens_updated = self.connected_at
+		self.input_decoder = InputDecoder()
+		# Keys that were decoded but not yet used, such as the rest of a paste after the enter key
+		self.pending_keys = deque()
+		self.recording = None
+		self.output_lock = threading.Lock()
+		self.jobs = {}
+		self.next_job_id = 1
+		self.last_cancel_check = 0
+		self.messages = MessageQueue(MESSAGE_QUEUE_SIZE, MESSAGE_QUEUE_POLICY, self.message_queue_overflowed)
+		# The LineEditor of the line being typed on the session thread and the prompt in front of it, so that the line
+		# can be drawn again after deliver_messages()
+		self.line_editor = None
+		self.input_prompt = b""
 
 	def run(self):
 		try:
-			self.process_ssh_client()
+			self.run_client()
+		finally:
+			admission.count("active_clients", -1)
+			for job in self.jobs.values():
+				job.cancelled.set()
+			if not self.recording == None:
+				self.recording.close()
+			self.release_handshake_slot()
+			if self.writes_sent:
+				session_bytes_sent.observe(self.bytes_sent)
+				session_writes_sent.observe(self.writes_sent)
+			if self.holds_session_slot:
+				self.holds_session_slot = False
+				admission.end_session()
+
+	def release_handshake_slot(self):
+		if self.holds_handshake_slot:
+			self.holds_handshake_slot = False
+			admission.end_handshake()
+
+	def run_client(self):
+		try:
+			if self.chan is None:
+				self.process_ssh_client()
+			else:
+				self.transport = self.chan
+				self.client_login_sequence()
 		except Exception as e:
 			if not isinstance(e, ModuleNotFoundError):
 				username = "Not Logged In" if not self.database else self.database.user
@@ -268,22 +2455,26 @@ class SSHControlPanelClient(threading.Thread):
 
 	def process_ssh_client(self):
 		self.transport = paramiko.Transport(self.sock)
-		self.transport.add_server_key(HOST_KEY)
+		configure_transport(self.transport)
 		self.transport.local_version = PUBLIC_SSH_BANNER
+		self.transport.banner_timeout = self.transport.handshake_timeout = self.transport.auth_timeout = HANDSHAKE_TIMEOUT
 		self.server = SSHServerEmulator()
+		deadline = time.monotonic() + HANDSHAKE_TIMEOUT
 		try:
 			self.transport.start_server(server=self.server)
 		except paramiko.SSHException:
 			log(f"Failed to negotiate SSH connection from {self.ip}")
 			raise ModuleNotFoundError()
-		self.chan = self.transport.accept(20)
+		self.chan = self.transport.accept(max(deadline - time.monotonic(), 0))
 		if self.chan is None:
 			log(f"Error with SSH Connection from {self.ip}: No channel")
 			raise ModuleNotFoundError()
-		self.server.event.wait(10)
+		self.server.event.wait(max(deadline - time.monotonic(), 0))
 		if not self.server.event.is_set():
 			log(f"Client at {self.ip} never requested a shell")
 			raise ModuleNotFoundError()
+		handshake_seconds.observe(time.monotonic() - self.connected_at)
+		self.release_handshake_slot()
 		self.client_login_sequence()
 
 	def client_login_sequence(self):
@@ -291,141 +2482,390 @@ class SSHControlPanelClient(threading.Thread):
 		self.database = SSHPanelDatabase(username)
 		login_success = self.database.check_login_credentials(username, password)
 
-		if login_success == True:
+		if login_success == None:
+			log("Refused login because the login verifier is overloaded", username, self.ip, type=LogType.WARNING)
+			self.send(LOGIN_BUSY)
+			time.sleep(2)
+		elif login_success == True and not admission.try_begin_session():
+			log("Refused login because MAX_CONCURRENT_SESSIONS has been reached", username, self.ip, type=LogType.WARNING)
+			self.send(SERVER_FULL)
+			time.sleep(2)
+		elif login_success == True:
+			connection_limiter.record_login_success(self.address[0])
+			self.holds_session_slot = True
 			self.database.log_login(username, self.address[0], self.address[1])
+			if SESSION_RECORDING == "all" or (SESSION_RECORDING == "root" and username == "root"):
+				self.start_recording(username)
 			self.clear_terminal()
 			self.kill_socket_immediately = False
 			self.send(f" Welcome, {username}!")
-			time.sleep(2)
+			time.sleep(WELCOME_MESSAGE_DURATION)
 			self.clear_terminal()
 			log("User logged into their account successfully", username, self.ip)
-			connected_clients.append([self.session_id, username, self.ip, self.sock])
+			self.login_time = time.time()
+			sessions.register(self)
+			if not draining_deadline == None:
+				self.notify(SERVER_RELOADING.replace("$seconds", str(max(int(draining_deadline - time.monotonic()), 0))))
 			self.main_loop(username)
-			connected_clients.remove([self.session_id, username, self.ip, self.sock])
+			sessions.unregister(self.session_id)
 			self.kill_socket_immediately = True
 		else:
+			penalty = connection_limiter.record_login_failure(self.address[0])
+			if penalty:
+				log(f"Refusing connections from this address for {penalty} seconds after repeated failed logins", username, self.ip, type=LogType.WARNING)
 			self.send(LOGIN_FAILED)
 			time.sleep(2)
 
-		log("Connection was aborted properly", username, self.ip)
+		log(f"Connection was aborted properly after sending {self.bytes_sent} bytes in {self.writes_sent} writes", username, self.ip)
 		self.clear_terminal()
 		self.kill_connection()
 
-	def main_loop(self, username):
-		self.command_history = []
-		permissions_level = PermissionsLevel.NORMAL if not username == "root" else PermissionsLevel.ROOT
-
-		command_functions = {}
-
-		def command(description, names, permissions_level=PermissionsLevel.NORMAL):
-			def command_func_inner(func):
-				for name in names:
-					command_functions[name] = (func, description, permissions_level)
-			return command_func_inner
+	def start_recording(self, username):
+		self.recording = session_recorder.open(self.session_id, username, self.ip, *self.server.term_size, term=self.server.term)
+		self.server.recording = self.recording
+		log(f"Recording session to {RECORDING_FOLDER}/{self.recording.name}.cast.gz", username, self.ip)
 
-		@command("Clear the terminal window", ["clear", "cls", "c"])
-		def _clear():
-			self.clear_terminal()
+	@command("Clear the terminal window", ["clear", "cls", "c"])
+	def _clear(self):
+		self.clear_terminal()
 
-		@command("Add a new user to the system", ["adduser", "useradd", "newuser"], PermissionsLevel.ROOT)
-		def _adduser():
-			new_username = self.prompt("\r Username: ")
-			new_password = self.prompt("\r Password: ")
-			if self.database.user_exists(new_username):
-				self.send(" That username is already in use.\r\n")
+	@command("Add a new user to the system", ["adduser", "useradd", "newuser"], PermissionsLevel.ROOT)
+	def _adduser(self):
+		new_username = self.prompt("\r Username: ")
+		new_password = self.prompt("\r Password: ")
+		if self.database.user_exists(new_username):
+			self.send(" That username is already in use.\r\n")
+		else:
+			self.database.add_new_user(new_username, new_password)
+			self.send(" New user created successfully!\r\n")
+
+	@command("Delete an existing user from the system", ["removeuser", "userremove", "remove", "deluser"], PermissionsLevel.ROOT)
+	def _removeuser(self):
+		target_username = self.prompt("\r Username: ")
+		if self.database.user_exists(target_username):
+			if target_username == "root":
+				self.send(" You cannot delete the root user. To regenerate the password for root, use the command 'rootpassword'.\r\n")
 			else:
-				self.database.add_new_user(new_username, new_password)
-				self.send(" New user created successfully!\r\n")
+				self.database.remove_user(target_username)
+				self.send(" Removed user successfully!\r\n")
+		else:
+			self.send(" That user does not exist.\r\n")
 
-		@command("Delete an existing user from the system", ["removeuser", "userremove", "remove", "deluser"], PermissionsLevel.ROOT)
-		def _removeuser():
-			target_username = self.prompt("\r Username: ")
-			if self.database.user_exists(target_username):
-				if target_username == "root":
-					self.send(" You cannot delete the root user. To regenerate the password for root, use the command 'rootpassword'.\r\n")
-				else:
-					self.database.remove_user(target_username)
-					self.send(" Removed user successfully!\r\n")
+	@command("Regenerate the password for the root account", ["rootpassword", "rootpass", "rootregen"], PermissionsLevel.ROOT)
+	def _rootpassword(self):
+		try:
+			confirmation = self.yes_no_prompt(" Are you sure you want to do this? You will be logged out and have to retrieve the new password from logs/root_passwords.log (Y/N): ")
+			if confirmation:
+				self.database.regenerate_root_password()
+				return CommandReturnAction.BREAK
+		except Exception:
+			self.send(" Please give either 'y' or 'n' as a choice.\r\n")
+
+	@command("Change the password of a user", ["updatepassword", "userpassword"], PermissionsLevel.ROOT)
+	def _updatepassword(self):
+		target_username = self.prompt("\r Username: ")
+		new_password = self.prompt("\r Password: ")
+		c_new_password = self.prompt("\r Confirm Password: ")
+		if self.database.user_exists(target_username):
+			if not new_password == c_new_password:
+				self.send(" Passwords do not match, please try again.\r\n")
 			else:
-				self.send(" That user does not exist.\r\n")
-
-		@command("Regenerate the password for the root account", ["rootpassword", "rootpass", "rootregen"], PermissionsLevel.ROOT)
-		def _rootpassword():
-			try:
-				confirmation = self.yes_no_prompt(" Are you sure you want to do this? You will be logged out and have to retrieve the new password from logs/root_passwords.log (Y/N): ")
-				if confirmation:
-					self.database.regenerate_root_password()
-					return CommandReturnAction.BREAK
-			except:
-				self.send(" Please give either 'y' or 'n' as a choice.\r\n")
-
-		@command("Change the password of a user", ["updatepassword", "userpassword"], PermissionsLevel.ROOT)
-		def _updatepassword():
-			target_username = self.prompt("\r Username: ")
-			new_password = self.prompt("\r Password: ")
-			c_new_password = self.prompt("\r Confirm Password: ")
-			if self.database.user_exists(target_username):
-				if not new_password == c_new_password:
-					self.send(" Passwords do not match, please try again.\r\n")
+				if target_username == "root":
+					self.send(" You cannot update the root password. Please regenerate it using 'rootpassword'.\r\n")
 				else:
-					if target_username == "root":
-						self.send(" You cannot update the root password. Please regenerate it using 'rootpassword'.\r\n")
-					else:
-						self.database.set_user_password(target_username, new_password)
-						self.send(" Password updated successfully.\r\n")
-			else:
-				self.send(" That user does not exist.\r\n")
-
-		@command("Log out of your current session", ["logout", "exit", "disconnect", "dc"])
-		def _logout():
-			return CommandReturnAction.BREAK
-
-		# ----- START OF CUSTOM COMMANDS ----- #
-
-
-
-
+					self.database.set_user_password(target_username, new_password)
+					self.send(" Password updated successfully.\r\n")
+		else:
+			self.send(" That user does not exist.\r\n")
+
+	@command("List the users who are currently logged in", ["who", "sessions"])
+	def _who(self):
+		rows = [
+			(other_session_id, username, ip, format_seconds_to_time(int(time.time() - login_time)))
+			for other_session_id, username, ip, login_time in sorted(sessions.describe_all())
+		]
+		self.send_table(["Session ID", "User", "Address", "Connected For"], rows)
+		self.send(f"\n\n {len(rows)} session(s) connected\n")
+
+	@command("Disconnect a session by its Session ID", ["kick"], PermissionsLevel.ROOT, completer=lambda client, arguments: [str(row[0]) for row in sessions.describe_all()] if len(arguments) == 0 else [])
+	def _kick(self):
+		target = self.command_arguments[0] if self.command_arguments else self.prompt("\r Session ID: ")
+		target_client = sessions.get(int(target)) if target.isdigit() else None
+		if target_client == None and sessions.shared and target.isdigit() and request_kick(int(target)):
+			log(f"Requested another worker to kick session {target}", self.database.user, self.ip)
+			self.send(" Session will be disconnected within a second.\r\n")
+		elif target_client == None:
+			self.send(" That session does not exist.\r\n")
+		elif target_client == self:
+			self.send(" You cannot kick your own session. Use 'logout' instead.\r\n")
+		else:
+			log(f"Kicked session {target} of user '{target_client.database.user}'", self.database.user, self.ip)
+			target_client.force_disconnect()
+			self.send(" Session disconnected.\r\n")
+
+	@command("Send a message to every logged-in session", ["broadcast", "wall"], PermissionsLevel.ROOT)
+	def _broadcast(self):
+		text = " ".join(self.command_arguments) if self.command_arguments else self.prompt("\r Message: ")
+		if len(text.strip()) == 0:
+			return
+		message = BROADCAST_MESSAGE.replace("$user", self.database.user).replace("$message", text)
+		queued = broadcast(message, exclude=self.session_id)
+		if sessions.shared:
+			publish_broadcast(message)
+		log(f"Broadcast a message to {queued} session(s): {text}", self.database.user, self.ip)
+		self.send(f" Message sent to {queued} session(s)" + (" of this worker, and to the other workers" if sessions.shared else "") + ".\r\n")
+
+	@command("Show server statistics", ["stats", "metrics"], PermissionsLevel.ROOT)
+	def _stats(self):
+		rows = []
+		for metric in metrics.metrics:
+			for labels, value in sorted(metric.samples()):
+				name = metric.name + metric.format_labels(labels)
+				if isinstance(metric, Histogram):
+					bucket_counts, total, count = value
+					value = f"count {count}, average {round(total / count, 4) if count else 0}"
+				rows.append((name, value))
+		self.send_table(["Metric", "Value"], rows)
+		self.send("\n\n")
+
+	@command("List every user and the algorithm of their password hash", ["users"], PermissionsLevel.ROOT)
+	def _users(self):
+		rows = ((username, password_hash.split("$")[0] if "$" in password_hash else "sha512 (unsalted)") for username, password_hash in self.database.iterate_users())
+		shown = self.send_table(["User", "Password Hash"], rows, width_hint=[16, 17])
+		self.send(f"\n\n {shown} user(s) shown\n")
+
+	@command("List the commands started in the background with '&'", ["jobs"])
+	def _jobs(self):
+		rows = [(f"[{job.job_id}]", job.describe(), format_seconds_to_time(int(time.monotonic() - job.started)), job.line) for job in list(self.jobs.values())]
+		self.send_table(["Job", "State", "Started", "Command"], rows)
+		self.send(f"\n\n {len(rows)} job(s)\n")
+
+	@command("Bring a background command to the foreground", ["fg"], completer=lambda client, arguments: list(map(str, client.jobs)) if len(arguments) == 0 else [])
+	def _fg(self):
+		if self.current_job().detached:
+			self.send(" 'fg' cannot run in the background.\r\n")
+			return
+		job = self.find_job()
+		if not job == None:
+			return self.bring_to_foreground(job)
+
+	@command("Cancel a background command", ["cancel"], completer=lambda client, arguments: list(map(str, client.jobs)) if len(arguments) == 0 else [])
+	def _cancel(self):
+		job = self.find_job()
+		if not job == None:
+			job.cancelled.set()
+			self.send(f" Cancelling [{job.job_id}] {job.line}\r\n")
+
+	@command("Log out of your current session", ["logout", "exit", "disconnect", "dc"])
+	def _logout(self):
+		return CommandReturnAction.BREAK
+
+	# ----- START OF CUSTOM COMMANDS ----- #
+
+
+
+
+
+	# -----  END OF CUSTOM COMMANDS  ----- #
 
-		# -----  END OF CUSTOM COMMANDS  ----- #
+	def main_loop(self, username):
+		self.command_history = CommandHistory(COMMAND_HISTORY_SIZE, self.load_command_history if PERSIST_COMMAND_HISTORY else None)
+		permissions_level = PermissionsLevel.NORMAL if not username == "root" else PermissionsLevel.ROOT
 
 		while True:
+			if self.report_finished_jobs() == CommandReturnAction.BREAK:
+				break
 			title = TERMINAL_TITLE_BAR.replace("$user", username).replace("$ip", self.ip).replace("$sid", str(self.session_id))
-			self.send(f'\x1b]0;{title}\x07 [{username}@{self.ip}] > ')
+			self.send(f'\x1b]0;{title}\x07 [{username}@{self.ip}] > ', flush=False)
 
-			command_parts, self.command_history = self.get_input(self.command_history, [n for n in command_functions.keys()], return_updated_history=True)
-			self.command_history.insert(0, command_parts)
-			log(f"Command dispatched: {command_parts}", username, self.ip)
-			log_to_file(f"Command dispatched by '{username}': {command_parts}", "commands.log")
-			command_parts = command_parts.split(" ")
+			try:
+				command_line = self.get_input(self.command_history, self.complete_command_line)
+			except CommandCancelled:
+				continue
+			if self.command_history.append(command_line) and PERSIST_COMMAND_HISTORY:
+				self.database.save_command(username, command_line)
+			log(f"Command dispatched: {command_line}", username, self.ip)
+			log_to_file(f"Command dispatched by '{username}': {command_line}", "commands.log")
+			# A command ending with "&" runs in the background, see start_job()
+			detached = command_line.rstrip().endswith("&")
+			if detached:
+				command_line = command_line.rstrip()[:-1].rstrip()
+			command_parts = command_line.split(" ")
 			command_item = command_parts[0].lower()
 
-			done_executing = False
 			action = None
+			entry = command_registry.commands.get(command_item)
+
+			if entry == None:
+				self.send(COMMAND_UNKNOWN.replace("$command", command_item))
+			elif entry.permissions_level == PermissionsLevel.ROOT and not permissions_level == PermissionsLevel.ROOT:
+				self.send(COMMAND_PROHIBITED.replace("$command", command_item))
+			elif detached:
+				self.start_job(command_line, entry, command_parts[1:])
+			else:
+				job = Job(None, self, command_line, entry, command_parts[1:])
+				job_local.job = job
+				try:
+					self.run_command(job)
+				finally:
+					job_local.job = None
+				if job.status == "Cancelled":
+					self.send(COMMAND_CANCELLED)
+				action = job.action
 
-			for name, data in command_functions.items():
-				if done_executing:
-					break
-				if name == command_item:
-					func, description, required_permissions_level = data
-					if required_permissions_level == PermissionsLevel.ROOT and not permissions_level == PermissionsLevel.ROOT:
-						self.send(COMMAND_PROHIBITED.replace("$command", name))
-					else:
-						try:
-							action = func()
-						except Exception as e:
-							log(f"Non-fatal error in Client Thread: {type(e).__name__}", username, self.ip, type=LogType.WARNING)
-							for line in traceback.format_exc().strip().split("\n"):
-								log(line, username, self.ip, type=LogType.WARNING)
-							self.send(COMMAND_FAILED)
-					done_executing = True
-			
 			if action == CommandReturnAction.BREAK:
 				break
-			if not done_executing:
-				self.send(COMMAND_UNKNOWN.replace("$command", command_item))
+
+	@property
+	def command_arguments(self):
+		# The arguments of the command that the current thread is running, which may be a background command
+		job = self.current_job()
+		return job.arguments if not job == None else []
+
+	def current_job(self):
+		job = getattr(job_local, "job", None)
+		return job if not job == None and job.client is self else None
+
+	def run_command(self, job):
+		command_start = time.perf_counter()
+		try:
+			job.action = job.entry.func(self)
+			job.status = "Done"
+		except CommandCancelled:
+			job.status = "Cancelled"
+		except Exception as e:
+			job.status = "Failed"
+			log(f"Non-fatal error in Client Thread: {type(e).__name__}", self.database.user, self.ip, type=LogType.WARNING)
+			for line in traceback.format_exc().strip().split("\n"):
+				log(line, self.database.user, self.ip, type=LogType.WARNING)
+			try:
+				self.send(COMMAND_FAILED)
+			except CommandCancelled:
+				pass
+		command_seconds.observe(time.perf_counter() - command_start, (job.entry.name,))
+
+	def start_job(self, command_line, entry, arguments):
+		if len(self.jobs) >= MAX_JOBS_PER_SESSION:
+			self.send(JOB_LIMIT_REACHED.replace("$count", str(len(self.jobs))))
+			return
+		job = Job(self.next_job_id, self, command_line, entry, arguments, detached=True)
+		if command_executor.submit(self.run_job, job) == None:
+			self.send(COMMANDS_BUSY)
+			return
+		self.jobs[job.job_id] = job
+		self.next_job_id += 1
+		self.send(f" [{job.job_id}] {command_line}\r\n")
+
+	def run_job(self, job):
+		# Runs on a thread of command_executor
+		job_local.job = job
+		try:
+			self.run_command(job)
+		finally:
+			job_local.job = None
+			job.done.set()
+
+	def find_job(self):
+		# The job named by the first argument, or the most recent one
+		if self.command_arguments:
+			job_id = self.command_arguments[0].lstrip("%")
+			job = self.jobs.get(int(job_id)) if job_id.isdigit() else None
+		else:
+			job = self.jobs[max(self.jobs)] if self.jobs else None
+		if job == None:
+			self.send(" That job does not exist. Use 'jobs' to list your background commands.\r\n")
+		return job
+
+	def bring_to_foreground(self, job):
+		# Hands the terminal to a background command until it ends. Ctrl-C cancels it and Ctrl-Z sends it back to the
+		# background. The keys it reads are passed on by this thread, which is the only one that reads from the client.
+		output, dropped = job.take_output()
+		if dropped:
+			self.send(f" ({dropped} bytes of earlier output were not kept)\r\n", flush=False)
+		self.write(output)
+		self.flush()
+		while self.pending_keys:
+			job.keys.put(self.pending_keys.popleft())
+		job.foreground = True
+		try:
+			while not job.done.wait(0):
+				key = self.next_key(ESCAPE_KEY_TIMEOUT)
+				if key == b"\x03":
+					job.cancelled.set()
+				elif key == b"\x1a":
+					break
+				elif not key == None:
+					job.keys.put(key)
+		except BaseException as error:
+			job.cancelled.set()
+			self.handle_input_failure(error)
+		finally:
+			job.foreground = False
+		if not job.done.is_set():
+			self.send(f"\r\n [{job.job_id}] Running in the background  {job.line}\r\n")
+			return
+		# Keys typed ahead that the job did not read belong to the next prompt
+		while not job.keys.empty():
+			self.pending_keys.append(job.keys.get())
+		return self.report_finished_jobs()
+
+	def report_finished_jobs(self):
+		# Shows the status and the remaining output of every background command that has ended since the last prompt
+		action = None
+		for job in [job for job in self.jobs.values() if job.done.is_set()]:
+			del self.jobs[job.job_id]
+			output, dropped = job.take_output()
+			self.write(output)
+			if dropped:
+				self.send(f" ({dropped} bytes of earlier output were not kept)\r\n", flush=False)
+			self.send(f" [{job.job_id}] {job.status}  {job.line}\r\n")
+			if job.action == CommandReturnAction.BREAK:
+				action = CommandReturnAction.BREAK
+		return action
+
+	def check_cancelled(self):
+		# Raises CommandCancelled once the command running on this thread has been cancelled. For a foreground command
+		# on the session thread, this is also where a Ctrl-C sent by the client is noticed, by looking at the input that
+		# has arrived at most every CANCEL_CHECK_INTERVAL seconds. Long commands that send no output should call it.
+		job = self.current_job()
+		if job == None:
+			return
+		if not job.detached and not job.cancelled.is_set() and time.monotonic() - self.last_cancel_check >= self.CANCEL_CHECK_INTERVAL:
+			self.last_cancel_check = time.monotonic()
+			try:
+				data = self.receive_input(0)
+			except SessionReaped:
+				data = None
+			if not data == None:
+				self.pending_keys.extend(self.input_decoder.feed(data) if data else [b"\x03"])
+			if b"\x03" in self.pending_keys:
+				# Like a terminal, Ctrl-C discards what was typed ahead of it
+				while not self.pending_keys.popleft() == b"\x03":
+					pass
+				job.cancelled.set()
+		if job.cancelled.is_set():
+			raise CommandCancelled()
+
+	def load_command_history(self):
+		commands, oldest_rowid = self.database.load_command_history(self.database.user, COMMAND_HISTORY_SIZE)
+		if not oldest_rowid == None:
+			self.database.trim_command_history(self.database.user, oldest_rowid)
+		return commands
+
+	def complete_command_line(self, line):
+		# Completes the command name for the first word, and arguments using the command's completer after that
+		if not " " in line:
+			return command_registry.index.matches(line)
+		name, _, arguments = line.partition(" ")
+		entry = command_registry.commands.get(name.lower())
+		if entry == None or entry.completer == None:
+			return []
+		arguments = arguments.split(" ")
+		head = line[:len(line) - len(arguments[-1])]
+		return [head + option for option in self.get_matching_autocomplete_options(arguments[-1], entry.completer(self, arguments[:-1]))]
 
 	def yes_no_prompt(self, prompt_text):
-		self.send(prompt_text)
+		self.send(prompt_text, flush=False)
 		resp = self.get_input(["y", "n"], ["y", "n"], empty_response_allowed=True).lower()
 		if resp == "y" or resp == "yes":
 			return True
@@ -435,203 +2875,740 @@ class SSHControlPanelClient(threading.Thread):
 			raise Exception()
 
 	def prompt(self, prompt_text, auto_complete_options=None):
-		self.send(prompt_text)
+		self.send(prompt_text, flush=False)
+		if isinstance(auto_complete_options, list):
+			auto_complete_options = CompletionIndex(auto_complete_options)
 		return self.get_input([], auto_complete_options if not auto_complete_options == None else [], empty_response_allowed=True)
 
-	def get_input(self, scroll_history, auto_complete_options, return_updated_history=False, empty_response_allowed=False):
-		username = "Nog Logged In" if not self.database else self.database.user
-		try:
-			char_pos, history_pos = 0, 0
-			currently_viewing_autocomplete, currently_showing_autocomplete_preview, = False, False
-			auto_complete_index, auto_complete_start_buf = 0, ""
-			# Scroll history is the list of editable lines, and we always insert a new blank line at the front
-			scroll_history.insert(0, "")
-			while not scroll_history[history_pos].endswith("\r"):
-
-				def check_and_clear_invalid_characters(showing_autocomplete_preview):
-					if showing_autocomplete_preview:
-						showing_autocomplete_preview = False
-						self.chan.send("\x1b[0K")
-					if buffer_len > 0:
-						self.chan.send(f"\x1b[{buffer_len}D\x1b[0K")
-					return showing_autocomplete_preview
-
-				# \/\/\/ Start pre-character rendering portion \/\/\/
-				buffer_len = len(scroll_history[history_pos])
-				# If we are showing more than one letter of the first word of an input
-				if buffer_len > 0 and len(scroll_history[history_pos].split(" ")) == 1:
-					preview_autocomplete_options = self.get_matching_autocomplete_options(scroll_history[history_pos], auto_complete_options)
-					# If there is a valid item to show, render it. Do not render if the user's input perfectly matches the first command
-					if len(preview_autocomplete_options) > 0 and not preview_autocomplete_options[0] == scroll_history[history_pos]:
-						currently_showing_autocomplete_preview = True
-						option_to_display = preview_autocomplete_options[0][len(scroll_history[history_pos]):]
-						self.chan.send(f"\x1b[0K\x1b[90m{option_to_display}\x1b[0m\x1b[{len(option_to_display)}D")
-					# If there is a perfect match or the command no longer matches any option
-					elif currently_showing_autocomplete_preview:
-						currently_showing_autocomplete_preview = False
-						self.chan.send("\x1b[0K")
-				# If the user deletes everything, disable previewing
-				elif currently_showing_autocomplete_preview:
-					currently_showing_autocomplete_preview = False
-				# Only clear the line of no previews are being shown
-				if not currently_showing_autocomplete_preview:
-					self.chan.send("\x1b[0K")
-				# /\/\/\ End of the pre-character rendering portion /\/\/\
-
-				# Recieve the current character from the buffer
-				char = self.chan.recv(1024)
-				if char in [b"\x03", b"\x1a"]:
-					self.clear_terminal()
-					raise ModuleNotFoundError("This is here to close the connection.")
-
-				# Backspace
-				elif char == b"\x7f":
-					# Backspace turns off autocomplete
-					currently_viewing_autocomplete = False
-					# Take away a character from the current line and clear it in the terminal
-					if char_pos > 0:
-						scroll_history[history_pos] = scroll_history[history_pos][:-1]
-						self.chan.send("\x1b[1D \x1b[1D")
-						char_pos -= 1
-					continue
-
-				# Tab
-				elif char == b"\t":
-					# If we are not showing autocomplete
-					if not currently_viewing_autocomplete:
-						currently_viewing_autocomplete = True
-						auto_complete_start_buf = scroll_history[history_pos]
-						auto_complete_index = -1
-					# Get a list of all of the options for matches of the currently selected buffer
-					valid_auto_complete_options = self.get_matching_autocomplete_options(auto_complete_start_buf, auto_complete_options)
-					# Move through the list of valid options infinitely (increment by 1 or reset to 0)
-					auto_complete_index = auto_complete_index + 1 if not auto_complete_index + 1 == len(valid_auto_complete_options) else 0
-					selected_word = valid_auto_complete_options[auto_complete_index][len(auto_complete_start_buf):]
-					# The place that we need to delete characters to (If the user gives 'sev' and we want to autocomplete to 'seventeen',
-					# we keep track of 'sev' in `auto_complete_start_buf` and then to move on to the next autocomplete suggestion, we delete
-					# everything after 'sev'.)
-					chars_to_remove = buffer_len - len(auto_complete_start_buf)
-					if chars_to_remove > 0:
-						self.chan.send(f"\x1b[{chars_to_remove}D\x1b[0K")
-					self.chan.send(selected_word)
-					# Edit the current line and set the character position to the end of the current autocomplete word
-					scroll_history[history_pos] = auto_complete_start_buf + selected_word
-					char_pos = len(scroll_history[history_pos])
-					continue
+	def send_table(self, headings, rows, width_hint=None):
+		# Streams a table from an iterable or a cursor, reading rows only as they are sent. With TABLE_PAGE_SIZE, the client
+		# is asked whether to continue after every page. Returns the number of rows that were shown.
+		table = TableStream(headings, rows, width_hint)
+		count = TABLE_PAGE_SIZE or TABLE_CHUNK_ROWS
+		self.send("\033[0m", flush=False)
+		while True:
+			self.send(table.render(count))
+			if not table.has_more():
+				break
+			count = self.ask_table_pager() if TABLE_PAGE_SIZE else TABLE_CHUNK_ROWS
+			if count == 0:
+				break
+		self.send("\033[0m", flush=False)
+		return table.rows_rendered
 
-				# Up Arrow
-				elif char == b"\x1b[A":
-					# If we can move to the next item in the history list
-					if len(scroll_history) > history_pos + 1:   
-						currently_showing_autocomplete_preview = check_and_clear_invalid_characters(currently_showing_autocomplete_preview)
-						# Move forward in the history, set the character position, and send the history item
-						history_pos += 1
-						char_pos = len(scroll_history[history_pos])
-						self.chan.send(scroll_history[history_pos])
-
-				# Down Arrow
-				elif (char == b"\x1b[B" or char == b"\x1b"):
-					# If we are not at the very first item
-					if not history_pos == 0:
-						currently_showing_autocomplete_preview = check_and_clear_invalid_characters(currently_showing_autocomplete_preview)
-						# Move backwards in the history. If escape is pressed when you are at a non-zero history
-						# index, return to the very first item.
-						history_pos -= history_pos if char == b"\x1b" else 1
-						char_pos = len(scroll_history[history_pos])
-						self.chan.send(scroll_history[history_pos])
-					elif char == b"\x1b":
-						currently_showing_autocomplete_preview = check_and_clear_invalid_characters(currently_showing_autocomplete_preview)
-						# Since we are already at index 0, make the line blank
-						scroll_history[0] = ""
-						history_pos = 0
-						char_pos = 0
-
-				if b"\x1b" in char or char == b"\n":
-					# All escape characters of any kind end autocomplete and are also not buffered
-					currently_viewing_autocomplete = False
-					continue
+	def ask_table_pager(self):
+		# Returns how many more rows to show: a page for space, one row for enter, and none for q, Ctrl-C or Ctrl-D
+		self.send(TABLE_PAGER_PROMPT)
+		try:
+			while True:
+				key = self.next_key()
+				count = {" ": TABLE_PAGE_SIZE, b"\r": 1, "q": 0, "Q": 0, b"\x03": 0, b"\x04": 0}.get(key[:1] if isinstance(key, str) else key)
+				if not count == None:
+					# Erases the prompt and returns to the end of the last row
+					self.send("\r\033[2K\033[A", flush=False)
+					return count
+		except BaseException as error:
+			self.handle_input_failure(error)
+			return 0
 
-				currently_viewing_autocomplete = False
-				# Clear autocomplete preview when the user presses enter
-				if char == b"\r" and currently_showing_autocomplete_preview:
-					self.chan.send("\x1b[0K")
-				# Do not add the character if the user is pressing enter with a blank input
-				if char == b"\r" and len(scroll_history[history_pos]) == 0:
-					if not empty_response_allowed:
-						continue
-
-				self.chan.send(char)
-				scroll_history[history_pos] += char.decode(ENCODING)
-				# Add the length of the character
-				char_pos += len(char)
-				
-			# Take away the '\r' and clean everything up
-			scroll_history[history_pos] = scroll_history[history_pos][:-1]
-			self.chan.send("\r\n")
-			user_input = scroll_history[history_pos].strip("\r\n")
-			return (user_input, scroll_history[1:]) if return_updated_history else user_input
-		except:
-			if DEBUG_RAISE_ERRORS:
-				raise
-			if not self.kill_socket_immediately:
-				log("Recieved invalid data, removing the user from 'connected_clients' and aborting connection", username, self.ip, type=LogType.WARNING)
-				self.abort_connection()
+	def get_input(self, scroll_history, auto_complete_options, return_updated_history=False, empty_response_allowed=False):
+		try:
+			editor = LineEditor(scroll_history, lambda prefix: self.get_matching_autocomplete_options(prefix, auto_complete_options), empty_response_allowed)
+			job = self.current_job()
+			if job == None or not job.detached:
+				# The prompt is what was written on the current line but not yet flushed, see prompt()
+				self.input_prompt = b"".join(self.output_buffer).rpartition(b"\n")[2]
+				self.line_editor = editor
+			while not editor.submitted:
+				# Keys that arrived together, such as a paste, are all handled before the line is rendered once
+				if (job.keys.empty() if not job == None and job.detached else not self.pending_keys):
+					self.write(editor.render())
+					self.flush()
+				key = self.next_key()
+				if key == b"\x03":
+					# Ctrl-C abandons the line and cancels the command that asked for it, if any
+					editor.submitted = True
+					editor.cursor = len(editor.line)
+					self.write(editor.render() + "^C\r\n")
+					self.flush()
+					raise CommandCancelled()
+				editor.handle_key(key)
+			# Rendering once more removes the completion preview before moving to the next line
+			self.write(editor.render() + "\r\n")
+			self.flush()
+			return (editor.line, scroll_history) if return_updated_history else editor.line
+		except BaseException as error:
+			self.handle_input_failure(error)
+		finally:
+			if self.line_editor is editor:
+				self.line_editor = None
+
+	def handle_input_failure(self, error):
+		if isinstance(error, CommandCancelled):
+			raise error
+		username = "Nog Logged In" if not self.database else self.database.user
+		if isinstance(error, SessionReaped):
+			sessions.record_reap(error.reason)
+			log(f"Disconnecting session because of its {error.reason} limit", username, self.ip)
+			self.send(SESSION_IDLE if error.reason == "idle" else SESSION_EXPIRED)
+			self.abort_connection()
+			return
+		if DEBUG_RAISE_ERRORS:
+			raise error
+		if not self.kill_socket_immediately:
+			log("Recieved invalid data, removing the user from 'sessions' and aborting connection", username, self.ip, type=LogType.WARNING)
+			self.abort_connection()
+		else:
+			log("Recieved invalid data, aborting connection", username, self.ip, type=LogType.WARNING)
+			self.kill_connection()
+
+	def next_key(self, wait=None):
+		# Returns the next key from the client, reading more input when no decoded key is left, or None after `wait`
+		# seconds without a key. An escape byte on its own is only returned as the escape key once nothing else has
+		# followed it for ESCAPE_KEY_TIMEOUT seconds. Background commands get their keys from bring_to_foreground().
+		job = self.current_job()
+		if not job == None and job.detached:
+			return self.next_job_key(job)
+		while not self.pending_keys:
+			data = self.receive_input(ESCAPE_KEY_TIMEOUT if self.input_decoder.pending() else wait)
+			if data == None:
+				self.pending_keys.extend(self.input_decoder.flush())
+				if not self.pending_keys and not wait == None:
+					return None
+			elif len(data) == 0:
+				raise EOFError("The client closed the channel")
 			else:
-				log("Recieved invalid data, aborting connection", username, self.ip, type=LogType.WARNING)
-				self.kill_connection()
+				self.pending_keys.extend(self.input_decoder.feed(data))
+		return self.pending_keys.popleft()
 
-	def send(self, message):
+	def next_job_key(self, job):
+		# A background command waits here until it is brought to the foreground and a key is typed
+		job.waiting_for_input = True
+		try:
+			while True:
+				if job.cancelled.is_set():
+					raise CommandCancelled()
+				try:
+					return job.keys.get(timeout=self.CANCEL_CHECK_INTERVAL)
+				except queue.Empty:
+					pass
+		finally:
+			job.waiting_for_input = False
+
+	def receive_input(self, wait=None):
+		# Waits for the next input from the client, or returns None after `wait` seconds without any. Each read is limited
+		# by a token bucket that refills at INPUT_RATE_LIMIT bytes per second; a client sending faster is made to wait
+		# here, which holds back its SSH window.
+		now = time.monotonic()
+		self.input_tokens = min(INPUT_RATE_BURST, self.input_tokens + (now - self.input_tokens_updated) * INPUT_RATE_LIMIT)
+		self.input_tokens_updated = now
+		if self.input_tokens < 1:
+			sessions.record_throttle()
+			time.sleep((1 - self.input_tokens) / INPUT_RATE_LIMIT)
+		timeout, reason = SESSION_IDLE_TIMEOUT or None, "idle"
+		if SESSION_MAX_LIFETIME:
+			remaining = self.connected_at + SESSION_MAX_LIFETIME - time.monotonic()
+			if timeout == None or remaining < timeout:
+				timeout, reason = max(remaining, 0), "lifetime"
+		if not wait == None and (timeout == None or wait < timeout):
+			timeout, reason = wait, None
+		# A blocked read cannot be woken up by another thread, so messages queued with notify() are delivered between
+		# reads of at most MESSAGE_POLL_INTERVAL seconds
+		deadline = None if timeout == None else time.monotonic() + timeout
+		while True:
+			self.deliver_messages()
+			remaining = None if deadline == None else max(deadline - time.monotonic(), 0)
+			polling = MESSAGE_POLL_INTERVAL > 0 and (remaining == None or remaining > MESSAGE_POLL_INTERVAL)
+			self.chan.settimeout(MESSAGE_POLL_INTERVAL if polling else remaining)
+			try:
+				data = self.chan.recv(4096)
+				break
+			except socket.timeout:
+				if polling:
+					continue
+				if reason == None:
+					return None
+				raise SessionReaped(reason)
+		self.input_tokens -= len(data)
+		if RECORDING_INPUT and data and not self.recording == None:
+			self.recording.input(data)
+		return data
+
+	def send(self, message, flush=True):
 		username = "Not Logged In" if not self.database else self.database.user
+		self.check_cancelled()
 		try:
-			for index, line in enumerate(message.replace("\n", "\r\n").split("\n")):
-				self.chan.send(line) if index == 0 else self.chan.send("\n" + line)
+			self.write(message.replace("\n", "\r\n"))
+			if flush:
+				self.flush()
 		except:
 			if DEBUG_RAISE_ERRORS: 
 				raise
 			if not self.kill_socket_immediately:
-				log("Failed to send data, removing the user from 'connected_clients' and aborting connection", username, self.ip, type=LogType.WARNING)
+				log("Failed to send data, removing the user from 'sessions' and aborting connection", username, self.ip, type=LogType.WARNING)
 				self.abort_connection()
 			else:
 				log("Failed to send data, aborting connection", username, self.ip, type=LogType.WARNING)
 				self.kill_connection()
 
+	# Output is collected with write() and sent with one channel write by flush(), so that everything rendered for
+	# one keystroke or one send() call leaves in as few SSH packets as possible. Output of a command in the background
+	# is kept by its Job instead.
+	def write(self, data):
+		data = data.encode(ENCODING) if isinstance(data, str) else data
+		job = self.current_job()
+		if not job == None and not job.foreground:
+			job.capture(data)
+			return
+		with self.output_lock:
+			self.output_buffer.append(data)
+
+	def flush(self):
+		job = self.current_job()
+		if not job == None and not job.foreground:
+			return
+		with self.output_lock:
+			if not self.output_buffer:
+				return
+			data = b"".join(self.output_buffer)
+			self.output_buffer = []
+			self.chan.sendall(data)
+		if data and not self.recording == None:
+			self.recording.output(data)
+		self.writes_sent += 1
+		self.bytes_sent += len(data)
+		writes_sent_total.inc()
+		bytes_sent_total.inc(len(data))
+
 	def clear_terminal(self):
 		self.send("\033c\033[3J\033[0m")
 	
 	def get_matching_autocomplete_options(self, current_buffer, options):
-		matches = []
-		for option in options:
-			if option.find(current_buffer) == 0:
-				matches.append(option)
-		return matches
+		if callable(options):
+			return options(current_buffer)
+		if isinstance(options, CompletionIndex):
+			return options.matches(current_buffer)
+		return [option for option in options if option.startswith(current_buffer)]
 
 	def abort_connection(self):
-		connected_clients.remove([self.session_id, self.database.user, self.ip, self.sock])
+		sessions.unregister(self.session_id)
 		self.kill_connection()
 
+	# Queues a message for this session's own thread to write with deliver_messages(). Unlike send(), this is safe to call
+	# from another thread, and it never waits for the client. Returns False if the message was not queued because the
+	# session is being disconnected by the "disconnect" MESSAGE_QUEUE_POLICY.
+	def notify(self, message):
+		if not self.messages.put(message.replace("\r\n", "\n").replace("\n", "\r\n").encode(ENCODING)):
+			return False
+		messages_queued_total.inc()
+		return True
+
+	def message_queue_overflowed(self):
+		log(f"Disconnecting session {self.session_id} because it did not read its messages in time", self.database.user if self.database else "Not Logged In", self.ip, type=LogType.WARNING)
+		self.force_disconnect()
+
+	def deliver_messages(self):
+		# Writes the messages queued with notify(). Called on the session thread while it waits for input. A line that is
+		# being typed is erased first and drawn again below the messages.
+		if len(self.messages) == 0:
+			return
+		messages, dropped = self.messages.take()
+		if dropped:
+			messages.insert(0, MESSAGES_DROPPED.replace("$count", str(dropped)).encode(ENCODING))
+		editor = self.line_editor
+		if editor == None:
+			self.write(b"".join(messages))
+		else:
+			self.write(b"\r\033[2K" + b"".join(messages) + self.input_prompt)
+			editor.reset_display()
+			self.write(editor.render())
+		self.flush()
+
+	# Used to end a session from another client's thread; the session's own thread notices the closed channel and cleans up
+	def force_disconnect(self):
+		try:
+			self.transport.close()
+		except:
+			pass
+
 	def kill_connection(self):
 		try:
 			self.transport.close()
-			self.sock.close()
+			if self.sock:
+				self.sock.close()
 		except:
 			pass
 		sys.exit()
 
-def main():
-	check_and_create_files()
+class AsyncSSHChannel:
+	# Blocking facade over an asyncssh channel so that the client thread can keep using chan.send() and chan.recv()
+
+	MAX_BUFFERED_INPUT = 65536
+	MAX_UNSENT_OUTPUT = 65536
+
+	def __init__(self, loop):
+		self.loop = loop
+		self.chan = None
+		self.incoming = queue.Queue()
+		# Guards the counters and flags below, which are changed by both the event loop and the client thread
+		self.lock = threading.Lock()
+		self.buffered = 0
+		self.paused = False
+		# Bytes handed to the event loop that it has not written to the channel yet
+		self.unsent = 0
+		self.write_paused = False
+		# Cleared while asyncssh asks for writing to pause or too much output is on its way to the event loop
+		self.writable = threading.Event()
+		self.writable.set()
+		self.remainder = b""
+		self.closed = False
+		self.timeout = None
+
+	def feed(self, data):
+		# Called from the event loop; pause the SSH window instead of buffering unbounded input
+		if data is None:
+			self.writable.set()
+			self.incoming.put(None)
+			return
+		self.incoming.put(data)
+		with self.lock:
+			self.buffered += len(data)
+			pause = self.buffered > self.MAX_BUFFERED_INPUT and not self.paused
+			if pause:
+				self.paused = True
+		if pause:
+			self.chan.pause_reading()
+
+	def settimeout(self, timeout):
+		self.timeout = timeout
+
+	def recv(self, nbytes):
+		if not self.remainder:
+			try:
+				data = self.incoming.get(timeout=self.timeout)
+			except queue.Empty:
+				raise socket.timeout("timed out")
+			if data is None:
+				self.closed = True
+				self.incoming.put(None)
+				return b""
+			with self.lock:
+				self.buffered -= len(data)
+				resume = self.paused and self.buffered <= self.MAX_BUFFERED_INPUT // 2
+				if resume:
+					self.paused = False
+			if resume:
+				self.loop.call_soon_threadsafe(self.chan.resume_reading)
+			self.remainder = data
+		data, self.remainder = self.remainder[:nbytes], self.remainder[nbytes:]
+		return data
+
+	def send(self, data):
+		if self.closed:
+			raise EOFError("Channel is closed")
+		if isinstance(data, str):
+			data = data.encode(ENCODING)
+		# Waits like a paramiko channel with a full window, so a client that does not read cannot make asyncssh buffer
+		# output without bound
+		if not self.writable.wait(self.timeout):
+			raise socket.timeout("timed out")
+		if self.closed:
+			raise EOFError("Channel is closed")
+		with self.lock:
+			self.unsent += len(data)
+			self.update_writable()
+		self.loop.call_soon_threadsafe(self.write, data)
+		return len(data)
+
+	sendall = send
+
+	def update_writable(self):
+		# Must hold the lock
+		if self.closed or (not self.write_paused and self.unsent <= self.MAX_UNSENT_OUTPUT):
+			self.writable.set()
+		else:
+			self.writable.clear()
+
+	def write(self, data):
+		# Called from the event loop. asyncssh calls pause_writing() from chan.write() once its buffer is full.
+		try:
+			self.chan.write(data)
+		except OSError:
+			self.closed = True
+		with self.lock:
+			self.unsent -= len(data)
+			self.update_writable()
+
+	def pause_writing(self):
+		with self.lock:
+			self.write_paused = True
+			self.update_writable()
+
+	def resume_writing(self):
+		with self.lock:
+			self.write_paused = False
+			self.update_writable()
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			self.loop.call_soon_threadsafe(self.chan.close)
+		self.writable.set()
+		self.incoming.put(None)
+
+if asyncssh:
+
+	class AsyncSSHServerEmulator(asyncssh.SSHServer):
+		# Counterpart of SSHServerEmulator for the asyncio engine. No thread exists until a shell has been requested.
+
+		def __init__(self):
+			self.username, self.password = None, None
+			self.address = None
+			self.holds_handshake_slot = False
+			self.term, self.term_size = None, (80, 24)
+			self.recording = None
+
+		def connection_made(self, conn):
+			self.connected_at = time.monotonic()
+			self.address = conn.get_extra_info("peername")[:2]
+			if not connection_limiter.allow(self.address[0]):
+				conn.abort()
+				return
+			self.holds_handshake_slot = admission.try_begin_handshake()
+			if not self.holds_handshake_slot:
+				conn.abort()
+
+		def release_handshake_slot(self):
+			if self.holds_handshake_slot:
+				self.holds_handshake_slot = False
+				admission.end_handshake()
+
+		def connection_lost(self, exc):
+			self.release_handshake_slot()
+
+		def begin_auth(self, username):
+			return True
+
+		def password_auth_supported(self):
+			return True
+
+		def validate_password(self, username, password):
+			self.username = username
+			self.password = password
+			return True
+
+		def session_requested(self):
+			return AsyncSSHSession(self)
 
-	log("Loading SSH Host Key")
-	if not os.path.exists("keys/private.key"):
-		log("No SSH Host Key file was found, regenerated file at keys/private.key", type=LogType.WARNING)
-		open("keys/private.key", "a+").close()
-	global HOST_KEY
+	class AsyncSSHSession(asyncssh.SSHServerSession):
+
+		def __init__(self, server):
+			self.server = server
+			self.channel = None
+
+		def connection_made(self, chan):
+			self.channel = AsyncSSHChannel(asyncio.get_running_loop())
+			self.channel.chan = chan
+
+		def pty_requested(self, term_type, term_size, term_modes):
+			self.server.term, self.server.term_size = term_type, term_size[:2]
+			return True
+
+		def terminal_size_changed(self, width, height, pixwidth, pixheight):
+			self.server.term_size = (width, height)
+			if not self.server.recording == None:
+				self.server.recording.resize(width, height)
+
+		def shell_requested(self):
+			return True
+
+		def session_started(self):
+			handshake_seconds.observe(time.monotonic() - self.server.connected_at)
+			admission.count("active_clients", 1)
+			self.server.release_handshake_slot()
+			address = self.server.address
+			local_session_id = allocate_session_id()
+			log(f"Accepted a connection from {address[0]}:{address[1]}, starting new session thread with Session ID {local_session_id}")
+			try:
+				SSHControlPanelClient(None, address, local_session_id, chan=self.channel, server=self.server).start()
+			except:
+				admission.count("active_clients", -1)
+				if DEBUG_RAISE_ERRORS:
+					raise
+				self.channel.close()
+
+		def data_received(self, data, datatype):
+			self.channel.feed(data)
+
+		def pause_writing(self):
+			self.channel.pause_writing()
+
+		def resume_writing(self):
+			self.channel.resume_writing()
+
+		def eof_received(self):
+			self.channel.feed(None)
+			return False
+
+		def connection_lost(self, exc):
+			self.channel.closed = True
+			self.channel.feed(None)
+
+async def run_asyncio_engine():
+	server_version = PUBLIC_SSH_BANNER[len("SSH-2.0-"):] if PUBLIC_SSH_BANNER.startswith("SSH-2.0-") else PUBLIC_SSH_BANNER
+	algorithms = {}
+	if SSH_CIPHERS:
+		algorithms["encryption_algs"] = SSH_CIPHERS
+	if SSH_KEX_ALGORITHMS:
+		algorithms["kex_algs"] = SSH_KEX_ALGORITHMS
+	server = await asyncssh.listen(
+		sock=s, server_factory=AsyncSSHServerEmulator, server_host_keys=HOST_KEY_FILES,
+		server_version=server_version, encoding=None, login_timeout=HANDSHAKE_TIMEOUT, **algorithms
+	)
+	loop = asyncio.get_running_loop()
+	reload_event = asyncio.Event()
+	if hasattr(signal, "SIGHUP"):
+		loop.add_signal_handler(signal.SIGHUP, reload_event.set)
+	while True:
+		await reload_event.wait()
+		reload_event.clear()
+		if await loop.run_in_executor(None, hand_over_listener):
+			break
+	server.close()
+	# Client threads still use the event loop through their channels, so it keeps running while they drain
+	await loop.run_in_executor(None, drain_sessions)
+
+def allocate_session_id():
+	with session_id.get_lock():
+		local_session_id = session_id.value
+		session_id.value += 1
+	return local_session_id
+
+metrics.gauge("controlpanel_threads", "Threads in the server process", function=threading.active_count)
+metrics.gauge("controlpanel_sessions", "Logged-in sessions", function=lambda: sessions.count())
+metrics.gauge("controlpanel_pending_connections", "Accepted sockets waiting for a handshake slot", function=lambda: admission.pending.qsize())
+metrics.gauge("controlpanel_log_queue_length", "Records waiting for the log writer", function=lambda: log_writer.records.qsize())
+metrics.counter("controlpanel_admission_rejections_total", "Connections refused by admission control", ("stage",), function=lambda: {(stage,): count for stage, count in admission.get_rejection_counts().items()})
+metrics.counter("controlpanel_connections_limited_total", "Connections closed right after accept by connection_limiter", ("reason",), function=lambda: {(reason,): count for reason, count in connection_limiter.get_rejection_counts().items()})
+metrics.counter("controlpanel_login_penalties_total", "Times a source was refused for a while after failed logins", function=lambda: connection_limiter.penalties)
+metrics.gauge("controlpanel_limiter_sources", "Sources tracked by connection_limiter", function=lambda: len(connection_limiter.sources))
+metrics.counter("controlpanel_limiter_evictions_total", "Sources forgotten early because RATE_LIMIT_TABLE_SIZE was reached", function=lambda: connection_limiter.evictions)
+metrics.counter("controlpanel_login_verifier_rejections_total", "Logins refused because the verifier queue was full", function=lambda: login_verifier.rejected)
+metrics.counter("controlpanel_sessions_reaped_total", "Sessions disconnected by a limit", ("reason",), function=lambda: {(reason,): count for reason, count in sessions.reaped.items()})
+metrics.counter("controlpanel_input_throttled_total", "Reads delayed by INPUT_RATE_LIMIT", function=lambda: sessions.throttled_reads)
+metrics.counter("controlpanel_user_cache_lookups_total", "User lookups by whether user_cache could answer them", ("result",), function=lambda: {("hit",): user_cache.hits, ("miss",): user_cache.misses})
+metrics.counter("controlpanel_recording_events_dropped_total", "Session recording events dropped because the recording queue was full", function=lambda: session_recorder.dropped)
+metrics.counter("controlpanel_recording_bytes_written_total", "Compressed bytes written to session recordings", function=lambda: session_recorder.bytes_written)
+metrics.gauge("controlpanel_background_commands", "Background commands running or waiting for a worker", function=lambda: command_executor.active)
+metrics.counter("controlpanel_background_commands_rejected_total", "Background commands refused because COMMAND_QUEUE_SIZE was reached", function=lambda: command_executor.rejected)
+metrics.counter("controlpanel_log_records_dropped_total", "Log records dropped because the log queue was full", function=lambda: log_writer.dropped)
+
+def open_metrics_sockets():
+	# One port for a single process, or one for every worker. Sockets of the previous server generation are taken over
+	# like the SSH socket, as it keeps serving its own metrics until this generation is ready.
+	if not METRICS_PORT:
+		return
+	inherited = {}
+	if not inherited_metrics_fds == None:
+		for pair in inherited_metrics_fds.split(","):
+			port, fd = pair.split(":")
+			inherited[int(port)] = socket.socket(fileno=int(fd))
+	ports = [METRICS_PORT + index for index in range(WORKER_PROCESSES)] if uses_worker_processes() else [METRICS_PORT]
+	for port in ports:
+		if port in inherited and inherited[port].getsockname()[0] == socket.gethostbyname(METRICS_ADDRESS):
+			metrics_sockets[port] = inherited.pop(port)
+			continue
+		metrics_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		metrics_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		try:
+			metrics_socket.bind((METRICS_ADDRESS, port))
+		except OSError as e:
+			metrics_socket.close()
+			log(f"Could not bind the metrics endpoint to {METRICS_ADDRESS}:{port}: {e}", type=LogType.ERROR)
+			raise KeyboardInterrupt
+		metrics_socket.listen(MAX_CONNECTIONS)
+		metrics_sockets[port] = metrics_socket
+	for unused_socket in inherited.values():
+		unused_socket.close()
+
+def start_metrics_server(port):
+	global metrics_server
+	metrics_server = ThreadingHTTPServer((METRICS_ADDRESS, port), MetricsRequestHandler, bind_and_activate=False)
+	metrics_server.socket.close()
+	metrics_server.socket = metrics_sockets[port]
+	metrics_server.daemon_threads = True
+	threading.Thread(target=metrics_server.serve_forever, name="MetricsServer", daemon=True).start()
+	log(f"Serving metrics at http://{METRICS_ADDRESS}:{port}/metrics")
+
+def stop_metrics_server():
+	# Leaves the metrics ports to the next server generation, which holds the same sockets
+	if not metrics_server == None:
+		metrics_server.shutdown()
+	for metrics_socket in metrics_sockets.values():
+		metrics_socket.close()
+	metrics_sockets.clear()
+
+def load_host_key(path):
+	for key_class in (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey):
+		try:
+			return key_class(filename=path)
+		except (paramiko.SSHException, ValueError):
+			pass
+	raise paramiko.SSHException(f"{path} is not an Ed25519, ECDSA or RSA private key")
+
+def get_host_key_types(key):
+	# RSA keys sign with SHA-2 under their own algorithm names, the other key types only have one
+	if isinstance(key, paramiko.RSAKey):
+		return ["rsa-sha2-512", "rsa-sha2-256"]
+	return [key.get_name()]
+
+def configure_transport(transport):
+	# The host keys are loaded and parsed once in main() and the same objects are shared by every Transport
+	for key in HOST_KEYS:
+		transport.add_server_key(key)
+	options = transport.get_security_options()
+	options.key_types = HOST_KEY_TYPES
+	if SSH_CIPHERS:
+		options.ciphers = SSH_CIPHERS
+	if SSH_KEX_ALGORITHMS:
+		options.kex = SSH_KEX_ALGORITHMS
+
+def load_host_keys():
+	log("Loading SSH Host Keys")
+	for path in HOST_KEY_FILES:
+		if not os.path.exists(path):
+			log(f"No SSH Host Key file was found, regenerated file at {path}", type=LogType.WARNING)
+			open(path, "a+").close()
+		try:
+			key = load_host_key(path)
+		except:
+			log(f"Your SSH Host Key is invalid, please add a valid key to {path}", type=LogType.ERROR)
+			log(f"You can regenerate one (On MacOS and Linux) using: [ssh-keygen -t ed25519 -f {path}]")
+			raise KeyboardInterrupt
+		if any(key.get_name() == loaded_key.get_name() for loaded_key in HOST_KEYS):
+			log(f"Ignoring {path} because a {key.get_name()} host key was already loaded", type=LogType.WARNING)
+			continue
+		HOST_KEYS.append(key)
+		HOST_KEY_TYPES.extend(get_host_key_types(key))
+		log(f"Loaded {key.get_name()} host key from {path} ({key.get_bits()} bits)")
+	check_socket = socket.socket()
+	try:
+		configure_transport(paramiko.Transport(check_socket))
+	except ValueError as e:
+		log(f"Invalid value in SSH_CIPHERS or SSH_KEX_ALGORITHMS: {e}", type=LogType.ERROR)
+		raise KeyboardInterrupt
+	finally:
+		check_socket.close()
+
+def request_reload(signum, frame):
+	reload_requested.set()
+	if not reload_wakeup == None:
+		reload_wakeup[1].send(b"\0")
+
+def start_next_generation():
+	# Starts the server again from the files on disk, handing it the listening socket (servers using WORKER_REUSE_PORT
+	# bind their own). Returns True once the new server reports that it is ready, or False if it failed to start.
+	ready_read, ready_write = os.pipe()
+	environment = dict(os.environ)
+	environment["CONTROLPANEL_READY_FD"] = str(ready_write)
+	# Connections that this generation accepted but has not yet given a Session ID keep IDs below the new generation's first
+	environment["CONTROLPANEL_FIRST_SESSION_ID"] = str(session_id.value + (PENDING_QUEUE_SIZE + MAX_CONCURRENT_HANDSHAKES) * max(WORKER_PROCESSES, 1))
+	pass_fds = [ready_write]
+	if not s == None:
+		environment["CONTROLPANEL_LISTEN_FD"] = str(s.fileno())
+		pass_fds.append(s.fileno())
+	if metrics_sockets:
+		environment["CONTROLPANEL_METRICS_FDS"] = ",".join(f"{port}:{metrics_socket.fileno()}" for port, metrics_socket in metrics_sockets.items())
+		pass_fds.extend(metrics_socket.fileno() for metrics_socket in metrics_sockets.values())
 	try:
-		HOST_KEY = paramiko.RSAKey(filename="keys/private.key")
-	except:
-		log("Your SSH Host Key is invalid, please add a valid key to keys/private.key", type=LogType.ERROR)
-		log("You can regenerate one (On MacOS and Linux) using: [ssh-keygen -t rsa -m PEM -f keys/private.key]")
+		process = subprocess.Popen([sys.executable] + sys.argv, env=environment, pass_fds=pass_fds)
+	finally:
+		os.close(ready_write)
+	try:
+		readable, _, _ = select.select([ready_read], [], [], RELOAD_START_TIMEOUT)
+		ready = len(readable) > 0 and os.read(ready_read, 1) == b"1"
+	finally:
+		os.close(ready_read)
+	if not ready:
+		if process.poll() == None:
+			process.terminate()
+		log("The new server generation failed to start, this one keeps running", type=LogType.ERROR)
+		return False
+	log(f"The new server generation is running with PID {process.pid}")
+	return True
+
+def hand_over_listener():
+	# Called after SIGHUP. Returns True once this process should stop accepting connections and drain its sessions.
+	if not worker_index == None:
+		log(f"Worker {worker_index} stopped accepting connections for a reload")
+		stop_metrics_server()
+		return True
+	log("Reload requested, starting a new server generation")
+	if not start_next_generation():
+		return False
+	stop_metrics_server()
+	return True
+
+def drain_sessions():
+	global draining_deadline
+	draining_deadline = time.monotonic() + RELOAD_DRAIN_TIMEOUT
+	clients = sessions.snapshot()
+	log(f"Waiting up to {RELOAD_DRAIN_TIMEOUT} seconds for {len(clients)} session(s) to end")
+	for client in clients:
+		client.notify(SERVER_RELOADING.replace("$seconds", str(RELOAD_DRAIN_TIMEOUT)))
+	while admission.busy() and time.monotonic() < draining_deadline:
+		time.sleep(0.5)
+	remaining = sessions.snapshot()
+	for client in remaining:
+		client.force_disconnect()
+	if remaining:
+		log(f"Disconnected {len(remaining)} session(s) that were still active at the drain deadline", type=LogType.WARNING)
+		time.sleep(1)
+	log("Finished draining, shutting down this server generation")
+
+def signal_ready():
+	# Tells the previous server generation that this one has taken over and it can begin to drain
+	if not ready_fd == None:
+		os.write(int(ready_fd), b"1")
+		os.close(int(ready_fd))
+
+def clear_console():
+	if os.name == "nt":
+		os.system("cls")
+	else:
+		sys.stdout.write("\033[H\033[2J\033[3J")
+		sys.stdout.flush()
+
+def check_configuration():
+	if DEBUG_RAISE_ERRORS:
+		log("!!! Working in development mode, raising errors when they come up !!!", type=LogType.WARNING)
+		log("!!!        > Do not use this in a production environment. <       !!!", type=LogType.WARNING)
+	if THREAD_STACK_SIZE:
+		threading.stack_size(THREAD_STACK_SIZE)
+	if CONNECTION_ENGINE == "asyncio" and asyncssh == None:
+		log("CONNECTION_ENGINE is set to 'asyncio' but the asyncssh package is not installed", type=LogType.ERROR)
+		raise KeyboardInterrupt
+	if not SESSION_RECORDING in ["none", "root", "all"]:
+		log("SESSION_RECORDING must be 'none', 'root' or 'all'", type=LogType.ERROR)
+		raise KeyboardInterrupt
+	if not DATABASE_BACKEND in ["sqlite", "dbapi"]:
+		log("DATABASE_BACKEND must be 'sqlite' or 'dbapi'", type=LogType.ERROR)
+		raise KeyboardInterrupt
+	if storage == None:
+		log(f"DATABASE_BACKEND is set to 'dbapi' but the {DATABASE_DRIVER} package is not installed", type=LogType.ERROR)
+		raise KeyboardInterrupt
+	if not storage is node_storage:
+		log(f"Storing users in {storage}, and the state shared by worker processes in {node_storage}")
+	if not MESSAGE_QUEUE_POLICY in ["drop_oldest", "disconnect"]:
+		log("MESSAGE_QUEUE_POLICY must be 'drop_oldest' or 'disconnect'", type=LogType.ERROR)
 		raise KeyboardInterrupt
+	if not 0 <= RATE_LIMIT_IPV4_PREFIX <= 32 or not 0 <= RATE_LIMIT_IPV6_PREFIX <= 128:
+		log("RATE_LIMIT_IPV4_PREFIX must be between 0 and 32, and RATE_LIMIT_IPV6_PREFIX between 0 and 128", type=LogType.ERROR)
+		raise KeyboardInterrupt
+	if not SESSION_RECORDING == "none":
+		log(f"Recording {'every session' if SESSION_RECORDING == 'all' else 'root sessions'} to {RECORDING_FOLDER}/")
 
+def custom_initialization():
 	# ----- START OF CUSTOM INITIALIZATION CODE ----- #
 
 
@@ -639,29 +3616,275 @@ def main():
 
 
 	# -----  END OF CUSTOM INITIALIZATION CODE  ----- #
+	pass
+
+def warm_up():
+	# Does the work that the first clients would otherwise wait for: opening database connections,
+	# starting a password verification thread and the first signature with every host key
+	storage.warm_up(min(DATABASE_POOL_SIZE, 2))
+	login_verifier.warm_up()
+	for key in HOST_KEYS:
+		key.sign_ssh_data(b"warm up", "rsa-sha2-256" if isinstance(key, paramiko.RSAKey) else None)
+
+def uses_worker_processes():
+	return WORKER_PROCESSES > 1 and hasattr(os, "fork")
+
+def open_server_socket():
+	global s
+	if reloaded:
+		log(f"Continuing from the previous server generation with Session ID {session_id.value}")
+	if not inherited_listen_fd == None:
+		s = socket.socket(fileno=int(inherited_listen_fd))
+		log("Took over the listening socket of the previous server generation")
+	elif uses_worker_processes() and WORKER_REUSE_PORT:
+		# Every worker binds its own socket; this one only makes sure that the port is free and is never listened on.
+		# After a reload the previous generation's workers still hold the port, and must not be stopped.
+		if not reloaded:
+			bind_listen_socket(listen=False).close()
+	else:
+		s = bind_listen_socket()
+	open_metrics_sockets()
+
+def check_port():
+	if port_available():
+		log(f"Port {SSH_PORT} is free")
+	else:
+		log(f"Port {SSH_PORT} is in use, starting the server would stop the process that holds it", type=LogType.WARNING)
+
+class ControlPanelServer:
+	# Starts the server in named phases. Each phase runs at most once, when it or a later phase is first needed,
+	# and its duration is kept for the startup report. Importing this module does none of this work.
 
-	log(f"Server initialization completed in {round(time.perf_counter() - start_time, 3)} seconds")
+	def __init__(self):
+		self.created = time.perf_counter()
+		self.phase_durations = {}
+
+	def phase(self, name, function):
+		if name in self.phase_durations:
+			return
+		phase_start = time.perf_counter()
+		function()
+		self.phase_durations[name] = time.perf_counter() - phase_start
+
+	def initialize(self):
+		self.phase("configuration", check_configuration)
+		self.phase("files and database", check_and_create_files)
+		self.phase("host keys", load_host_keys)
+		self.phase("custom initialization", custom_initialization)
+
+	def warm_up(self):
+		self.initialize()
+		self.phase("warm up", warm_up)
+
+	def open_socket(self):
+		self.initialize()
+		self.phase("listening socket", open_server_socket)
+
+	def report(self):
+		phases = [("imports", self.created - start_time)] + list(self.phase_durations.items())
+		details = ", ".join(f"{name} {round(duration * 1000, 1)} ms" for name, duration in phases)
+		log(f"Server initialization completed in {round(time.perf_counter() - start_time, 3)} seconds ({details})")
+
+	def check(self):
+		# Runs every phase that has no effect on a running server, and reports instead of listening
+		self.warm_up()
+		self.phase("port check", check_port)
+		self.report()
+		log("Configuration check passed")
+
+	def run(self):
+		self.open_socket()
+		self.report()
+		signal_ready()
+		if uses_worker_processes():
+			run_workers()
+			return
+		if WORKER_PROCESSES > 1:
+			log("WORKER_PROCESSES requires os.fork(), which is not available on this platform; running a single process", type=LogType.WARNING)
+		if METRICS_PORT:
+			start_metrics_server(METRICS_PORT)
+		serve()
+
+def main(arguments):
+	if arguments.replay:
+		try:
+			replay_recording(arguments.replay, arguments.replay_from, arguments.replay_speed, arguments.replay_max_idle)
+		except KeyboardInterrupt:
+			pass
+		sys.stdout.write("\033[0m\n")
+		return
+	if not reloaded and not arguments.check:
+		clear_console()
+	server = ControlPanelServer()
+	if arguments.check:
+		server.check()
+		return
+	# A new generation warms up before it reports ready, as the previous one keeps serving in the meantime
+	if arguments.warm or reloaded:
+		server.warm_up()
+	server.run()
+
+def serve():
+	if CONNECTION_ENGINE == "asyncio":
+		log("Listening for connections from clients (asyncio engine)")
+		asyncio.run(run_asyncio_engine())
+		return
+
+	global reload_wakeup
+	reload_wakeup = socket.socketpair()
+	if hasattr(signal, "SIGHUP"):
+		signal.signal(signal.SIGHUP, request_reload)
+	if reload_requested.is_set():
+		reload_wakeup[1].send(b"\0")
 	log("Listening for connections from clients")
+	threading.Thread(target=dispatch_connections, daemon=True).start()
+	# Non-blocking, because worker processes share the socket and another one may accept a connection first
+	s.setblocking(False)
 	while True:
-		sock, addr = s.accept()
-		global session_id
-		db_access_lock.acquire()
-		log(f"Accepted a connection from {addr[0]}:{addr[1]}, starting new server thread with Session ID {session_id}")
-		session_id += 1
-		local_session_id = session_id
-		db_access_lock.release()
-		try:
-			SSHControlPanelClient(sock, addr, local_session_id - 1).start()
+		readable, _, _ = select.select([s, reload_wakeup[0]], [], [])
+		if reload_wakeup[0] in readable:
+			reload_wakeup[0].recv(64)
+			reload_requested.clear()
+			if hand_over_listener():
+				break
+			continue
+		try:
+			sock, addr = s.accept()
+		except BlockingIOError:
+			continue
+		if not connection_limiter.allow(addr[0]):
+			sock.close()
+			continue
+		sock.setblocking(True)
+		# Every flush() is a complete response, so waiting to combine it with later output only adds latency
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		admission.submit(sock, addr)
+	s.close()
+	drain_sessions()
+
+def run_workers():
+	# Supervisor of WORKER_PROCESSES forked workers that all accept connections on SSH_PORT. It serves no clients
+	# itself, and restarts a worker whenever one exits.
+	workers = {}
+	if not reloaded:
+		remove_worker_sessions()
+	if hasattr(signal, "SIGHUP"):
+		signal.signal(signal.SIGHUP, request_reload)
+
+	def start_worker(index):
+		log_writer.sync()
+		close_database_connections()
+		pid = os.fork()
+		if pid == 0:
+			exit_code = 0
+			try:
+				run_worker(index)
+			except KeyboardInterrupt:
+				pass
+			except:
+				traceback.print_exc()
+				exit_code = 1
+			finally:
+				close_database_connections()
+				log_writer.close()
+				os._exit(exit_code)
+		workers[pid] = (index, time.monotonic())
+		log(f"Started worker {index} with PID {pid}")
+
+	try:
+		for index in range(WORKER_PROCESSES):
+			start_worker(index)
+		reloading = False
+		while workers:
+			if reload_requested.is_set() and not reloading:
+				reload_requested.clear()
+				reloading = hand_over_listener()
+				if reloading:
+					if not s == None:
+						s.close()
+					for pid in workers:
+						os.kill(pid, signal.SIGHUP)
+			pid, status = os.waitpid(-1, os.WNOHANG)
+			if pid == 0:
+				reload_requested.wait(0.5)
+				continue
+			if not pid in workers:
+				continue
+			index, started_at = workers.pop(pid)
+			remove_worker_sessions(pid)
+			if reloading:
+				log(f"Worker {index} (PID {pid}) has finished draining")
+				continue
+			log(f"Worker {index} (PID {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting it", type=LogType.WARNING)
+			# Keeps a worker that fails right away from being restarted in a tight loop
+			if time.monotonic() - started_at < 1:
+				time.sleep(1)
+			start_worker(index)
+	except KeyboardInterrupt:
+		for pid in workers:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+		for pid in workers:
+			try:
+				os.waitpid(pid, 0)
+			except ChildProcessError:
+				pass
+		remove_worker_sessions()
+		raise
+
+def raise_keyboard_interrupt(signum, frame):
+	raise KeyboardInterrupt
+
+def run_worker(index):
+	global s, worker_index
+	worker_index = index
+	reload_requested.clear()
+	signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+	if WORKER_REUSE_PORT and s == None:
+		s = open_listen_socket(reuse_port=True)
+	if METRICS_PORT:
+		for port in list(metrics_sockets):
+			if not port == METRICS_PORT + index:
+				metrics_sockets.pop(port).close()
+		start_metrics_server(METRICS_PORT + index)
+	sessions.shared = True
+	threading.Thread(target=watch_kick_requests, name="KickWatcher", daemon=True).start()
+	threading.Thread(target=watch_broadcasts, name="BroadcastWatcher", daemon=True).start()
+	serve()
+
+def dispatch_connections():
+	while True:
+		sock, addr = admission.next_connection()
+		local_session_id = allocate_session_id()
+		log(f"Accepted a connection from {addr[0]}:{addr[1]}, starting new server thread with Session ID {local_session_id}")
+		admission.count("active_clients", 1)
+		try:
+			SSHControlPanelClient(sock, addr, local_session_id, holds_handshake_slot=True).start()
 		except:
+			admission.count("active_clients", -1)
+			admission.end_handshake()
+			sock.close()
 			if DEBUG_RAISE_ERRORS:
 				raise
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="SSH Control Panel server")
+	parser.add_argument("--check", action="store_true", help="check the configuration, host keys, database and port, then exit")
+	parser.add_argument("--warm", action="store_true", help="open database connections and start worker threads before accepting clients")
+	parser.add_argument("--replay", metavar="RECORDING", help="replay a session recording in this terminal instead of starting the server")
+	parser.add_argument("--replay-from", type=float, default=0, metavar="SECONDS", help="start the replay this many seconds into the recording")
+	parser.add_argument("--replay-speed", type=float, default=1, metavar="FACTOR", help="replay speed, where 0 writes the output without pauses")
+	parser.add_argument("--replay-max-idle", type=float, default=2, metavar="SECONDS", help="longest pause during the replay, where 0 keeps every pause")
+	arguments = parser.parse_args()
 	try:
-		main()
+		main(arguments)
 	except KeyboardInterrupt:
 		print("\033[F")
 		log("Interrupt detected, shutting down program")
-		connection.close()
+		close_database_connections()
 		log("Closed SSH listener connection")
-		log(f"Shutting down server after {format_seconds_to_time(round(time.perf_counter() - start_time))}")
\ No newline at end of file
+		log(f"Shutting down server after {format_seconds_to_time(round(time.perf_counter() - start_time))}")
+		if arguments.check:
+			sys.exit(1)
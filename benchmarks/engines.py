@@ -0,0 +1,140 @@
+# Compares the connection engines by how many idle sessions fit into memory and
+# how quickly a new connection is accepted while they are held open.
+#
+# For every engine a server is started like in loadtest.py. The benchmark then
+# logs in --sessions sessions, which stay at the prompt without typing, and
+# samples the memory and thread count of the server. From the growth over the
+# empty server it prints the memory per session and how many sessions one GB
+# holds. Accept latency is the time from connect() until the SSH banner of the
+# server arrives, measured with --probes connections on the empty server and
+# again while the idle sessions are held:
+#
+#     python benchmarks/engines.py --sessions 500
+#
+# Options can be changed for both engines with --set, for example to see what a
+# smaller thread stack saves the threaded engine:
+#
+#     python benchmarks/engines.py --set THREAD_STACK_SIZE=262144
+
+import argparse, json, logging, resource, shutil, socket, time
+from concurrent.futures import ThreadPoolExecutor
+
+import loadtest
+
+ENGINES = ["threaded", "asyncio"]
+
+def accept_latencies(port, probes, timeout):
+	latencies = []
+	for _ in range(probes):
+		started = time.perf_counter()
+		with socket.create_connection(("127.0.0.1", port), timeout) as sock:
+			received = b""
+			while not b"\n" in received:
+				data = sock.recv(256)
+				if not data:
+					raise EOFError("The server closed the connection before sending its banner")
+				received += data
+		latencies.append(time.perf_counter() - started)
+	return latencies
+
+def open_idle_session(port, password, timeout, results):
+	session = loadtest.Session("127.0.0.1", port, password, timeout, results)
+	try:
+		session.connect()
+		session.transport.auth_password("root", password)
+		session.open_shell()
+		session.read_prompt()
+	except Exception as error:
+		results.add_error("login", error)
+		if not session.transport == None:
+			session.transport.close()
+		return None
+	return session
+
+def measure(engine, args, overrides):
+	port = loadtest.free_port()
+	overrides = dict(overrides, SSH_PORT=port, CONNECTION_ENGINE=engine)
+	directory = loadtest.create_directory()
+	process, password = loadtest.start_server(directory, overrides)
+	sessions = []
+	try:
+		sampler = loadtest.ResourceSampler(process.pid)
+		sampler.sample()
+		empty_rss_kib, empty_threads = sampler.peak_rss_kib, sampler.peak_threads
+		empty_latencies = accept_latencies(port, args.probes, args.timeout)
+
+		results = loadtest.Results()
+		started = time.perf_counter()
+		with ThreadPoolExecutor(args.concurrency) as executor:
+			sessions = [session for session in executor.map(lambda _: open_idle_session(port, password, args.timeout, results), range(args.sessions)) if session]
+		login_seconds = time.perf_counter() - started
+		# Lets the sessions settle at the prompt before sampling
+		time.sleep(args.settle)
+		sampler = loadtest.ResourceSampler(process.pid)
+		sampler.sample()
+		held_latencies = accept_latencies(port, args.probes, args.timeout)
+	finally:
+		for session in sessions:
+			session.transport.close()
+		loadtest.stop_server(process)
+		shutil.rmtree(directory)
+
+	per_session_kib = (sampler.peak_rss_kib - empty_rss_kib) / len(sessions) if sessions else None
+	return {
+		"engine": engine,
+		"sessions": len(sessions),
+		"login_errors": sum(results.errors.values()),
+		"login_seconds": round(login_seconds, 3),
+		"empty_rss_kib": empty_rss_kib,
+		"held_rss_kib": sampler.peak_rss_kib,
+		"empty_threads": empty_threads,
+		"held_threads": sampler.peak_threads,
+		"kib_per_session": round(per_session_kib, 1) if per_session_kib else None,
+		"sessions_per_gb": int(2 ** 20 / per_session_kib) if per_session_kib else None,
+		"accept_empty_p50_ms": round(loadtest.percentile(empty_latencies, 50) * 1000, 3),
+		"accept_empty_p99_ms": round(loadtest.percentile(empty_latencies, 99) * 1000, 3),
+		"accept_held_p50_ms": round(loadtest.percentile(held_latencies, 50) * 1000, 3),
+		"accept_held_p99_ms": round(loadtest.percentile(held_latencies, 99) * 1000, 3),
+	}
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare memory per idle session and accept latency of the connection engines")
+	parser.add_argument("--sessions", type=int, default=300, help="Idle sessions held open per engine")
+	parser.add_argument("--concurrency", type=int, default=16, help="Sessions logging in at the same time")
+	parser.add_argument("--probes", type=int, default=50, help="Connections used to measure accept latency")
+	parser.add_argument("--settle", type=float, default=2, help="Seconds to wait after the last login before sampling")
+	parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for any response")
+	parser.add_argument("--engine", action="append", choices=ENGINES, help="Only measure this engine")
+	parser.add_argument("--set", action="append", default=[], metavar="NAME=JSON", help="Change a configuration option of both servers")
+	parser.add_argument("--output", help="Write the results to this JSON file")
+	args = parser.parse_args()
+	logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+	# Every session needs a socket on both ends
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (min(max(soft, args.sessions * 2 + 256), hard), hard))
+
+	overrides = {
+		"WELCOME_MESSAGE_DURATION": 0, "CONNECTION_RATE_LIMIT": 0, "SESSION_IDLE_TIMEOUT": 0,
+		"MAX_CONCURRENT_SESSIONS": args.sessions + 10, "MAX_CONNECTIONS": max(50, args.concurrency * 2),
+	}
+	options = loadtest.configuration_options()
+	for option in args.set:
+		name, _, value = option.partition("=")
+		if not name in options:
+			parser.error(f"{name} is not a configuration option of ControlPanel.py")
+		overrides[name] = json.loads(value)
+
+	results = [measure(engine, args, overrides) for engine in args.engine or ENGINES]
+	print(f"{'engine':10} {'sessions':>8} {'KiB/session':>12} {'sessions/GB':>12} {'threads':>8} {'accept p50/p99 ms, empty':>26} {'with sessions':>18}")
+	for result in results:
+		print(f"{result['engine']:10} {result['sessions']:8} {result['kib_per_session'] or 0:12.1f} {result['sessions_per_gb'] or 0:12} {result['held_threads']:8} "
+			f"{result['accept_empty_p50_ms']:16.2f} / {result['accept_empty_p99_ms']:<7.2f} {result['accept_held_p50_ms']:8.2f} / {result['accept_held_p99_ms']:<7.2f}")
+		if result["login_errors"]:
+			print(f"{'':10} {result['login_errors']} sessions failed to log in")
+	if args.output:
+		with open(args.output, "w") as output_file:
+			json.dump({"configuration": overrides, "results": results}, output_file, indent=2)
+
+if __name__ == "__main__":
+	main()
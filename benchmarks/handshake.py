@@ -0,0 +1,104 @@
+# Measures SSH handshakes per second so that HOST_KEY_FILES, SSH_CIPHERS and
+# SSH_KEX_ALGORITHMS can be chosen from numbers instead of guesses.
+#
+# Local mode (the default) runs a paramiko server and client in this process
+# over socket pairs, once for every combination of host key type and key
+# exchange algorithm, and needs nothing but paramiko:
+#
+#     python benchmarks/handshake.py --count 50
+#
+# Remote mode connects to a running ControlPanel.py and measures the full
+# network handshake, optionally forcing one host key type or algorithm:
+#
+#     python benchmarks/handshake.py --host 127.0.0.1 --port 13333 --count 200 --concurrency 8 --key-type ssh-ed25519
+
+import argparse, io, logging, socket, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+DEFAULT_KEX = ["curve25519-sha256@libssh.org", "ecdh-sha2-nistp256", "diffie-hellman-group14-sha256", "diffie-hellman-group16-sha512"]
+
+def generate_host_keys():
+	ed25519_pem = ed25519.Ed25519PrivateKey.generate().private_bytes(
+		serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, serialization.NoEncryption()
+	).decode()
+	return {
+		"ssh-ed25519": paramiko.Ed25519Key(file_obj=io.StringIO(ed25519_pem)),
+		"ecdsa-sha2-nistp256": paramiko.ECDSAKey.generate(bits=256),
+		"rsa-sha2-256 (2048 bits)": paramiko.RSAKey.generate(2048),
+		"rsa-sha2-256 (3072 bits)": paramiko.RSAKey.generate(3072),
+	}
+
+def key_type_of(key):
+	return "rsa-sha2-256" if isinstance(key, paramiko.RSAKey) else key.get_name()
+
+def set_options(transport, key_type=None, kex=None, cipher=None):
+	options = transport.get_security_options()
+	if key_type:
+		options.key_types = [key_type]
+	if kex:
+		options.kex = [kex]
+	if cipher:
+		options.ciphers = [cipher]
+
+def local_handshake(key, kex, cipher):
+	server_sock, client_sock = socket.socketpair()
+	server = paramiko.Transport(server_sock)
+	client = paramiko.Transport(client_sock)
+	try:
+		server.add_server_key(key)
+		set_options(server, key_type_of(key), kex, cipher)
+		set_options(client, key_type_of(key), kex, cipher)
+		server_thread = threading.Thread(target=server.start_server, kwargs={"server": paramiko.ServerInterface()})
+		server_thread.start()
+		client.start_client()
+		server_thread.join()
+	finally:
+		client.close()
+		server.close()
+
+def remote_handshake(host, port, key_type, kex, cipher):
+	client = paramiko.Transport(socket.create_connection((host, port)))
+	try:
+		set_options(client, key_type, kex, cipher)
+		client.start_client()
+	finally:
+		client.close()
+
+def measure(handshake, count, concurrency):
+	started = time.perf_counter()
+	with ThreadPoolExecutor(concurrency) as executor:
+		for future in [executor.submit(handshake) for _ in range(count)]:
+			future.result()
+	return count / (time.perf_counter() - started)
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure SSH handshakes per second")
+	parser.add_argument("--host", help="Benchmark a running server instead of an in-process one")
+	parser.add_argument("--port", type=int, default=13333)
+	parser.add_argument("--count", type=int, default=50, help="Handshakes per measurement")
+	parser.add_argument("--concurrency", type=int, default=1)
+	parser.add_argument("--key-type", help="Host key algorithm to offer, such as ssh-ed25519")
+	parser.add_argument("--kex", help="Key exchange algorithm to offer (all of DEFAULT_KEX in local mode)")
+	parser.add_argument("--cipher", help="Cipher to offer")
+	args = parser.parse_args()
+	logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+	if args.host:
+		rate = measure(lambda: remote_handshake(args.host, args.port, args.key_type, args.kex, args.cipher), args.count, args.concurrency)
+		print(f"{args.host}:{args.port}  {rate:8.1f} handshakes/s")
+		return
+
+	print("Generating host keys")
+	host_keys = generate_host_keys()
+	for name, key in host_keys.items():
+		if args.key_type and not key_type_of(key) == args.key_type:
+			continue
+		for kex in [args.kex] if args.kex else DEFAULT_KEX:
+			rate = measure(lambda: local_handshake(key, kex, args.cipher), args.count, args.concurrency)
+			print(f"{name:26} {kex:32} {rate:8.1f} handshakes/s")
+
+if __name__ == "__main__":
+	main()
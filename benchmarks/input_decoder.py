@@ -0,0 +1,106 @@
+# Fuzzes and measures ControlPanel.InputDecoder, which turns the bytes read
+# from a client into keys for the line editor.
+#
+# Every recorded keystroke stream is fed to the decoder split at random
+# places, down to one byte per read, and the keys must be the same as when the
+# stream arrives in a single read. Random bytes are fed as well, which must
+# never raise. The benchmark then reports how fast the streams are decoded,
+# and how fast they are decoded and applied to a LineEditor:
+#
+#     python benchmarks/input_decoder.py --rounds 2000
+#
+# Streams recorded from a real terminal (for example with `script -I file`,
+# or by saving what a client sends) can be added with --stream file.bin.
+
+import argparse, os, random, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ControlPanel
+
+RECORDED_STREAMS = {
+	"typing with arrows and completion": b"ad\tu\x7f\x7fser\rbob\rpw\r\x1b[A\x1b[A\x1b[B\x1b[D\x1b[D\x1b[3~x\x1b[H\x1b[F\r",
+	"xterm application cursor keys": b"who\x1bOD\x1bOD\x1bOC\x1bOH\x1bOF\x1b[1;5D\x1b[1;5C\x01\x05\r",
+	"alt and control editing": b"kick 12 34\x1bb\x1bf\x17\x15\x0b\x1b\x1b\x1b[A\r",
+	"paste of several commands": b"who\rstats\rkick 4\rlogout\r" * 20,
+	"utf-8 text": "héllo wörld 日本語 \U0001f600\r".encode() * 10,
+	"invalid utf-8 and nul bytes": b"a\xff\xfeb\xc3(\xe2\x82\r\x00\x80\x9f\r",
+	"unfinished and unknown sequences": b"\x1b[12\r\x1b[?25h\x1b[200~pasted\x1b[201~\x1b]0;x\x07\r",
+}
+
+def normalize(keys):
+	# Text can be split into several strings depending on the reads, so neighbouring strings are joined
+	result = []
+	for key in keys:
+		if isinstance(key, str) and result and isinstance(result[-1], str):
+			result[-1] += key
+		else:
+			result.append(key)
+	return result
+
+def decode(stream, boundaries=()):
+	decoder = ControlPanel.InputDecoder()
+	keys, start = [], 0
+	for end in list(boundaries) + [len(stream)]:
+		keys.extend(decoder.feed(stream[start:end]))
+		start = end
+	return normalize(keys + decoder.flush())
+
+def fuzz(streams, rounds, generator):
+	for name, stream in streams.items():
+		expected = decode(stream)
+		for _ in range(rounds):
+			boundaries = sorted(generator.sample(range(1, len(stream)), generator.randint(0, min(len(stream) - 1, 40)))) if len(stream) > 1 else []
+			actual = decode(stream, boundaries)
+			if not actual == expected:
+				raise AssertionError(f"{name}: split at {boundaries} gave {actual!r} instead of {expected!r}")
+		print(f"{name:36} {len(stream):6} bytes  {len(expected):5} keys  consistent over {rounds} splits")
+	for _ in range(rounds):
+		stream = bytes(generator.getrandbits(8) for _ in range(generator.randint(1, 200)))
+		decoder = ControlPanel.InputDecoder()
+		for index in range(0, len(stream), 7):
+			decoder.feed(stream[index:index + 7])
+			if len(decoder.sequence) > decoder.MAX_SEQUENCE_LENGTH + 1:
+				raise AssertionError(f"Held back {len(decoder.sequence)} bytes of {stream!r}")
+	print(f"{'random bytes':36} no errors over {rounds} streams")
+
+def benchmark(streams, read_size):
+	stream = b"".join(streams.values()) * 50
+	reads = [stream[index:index + read_size] for index in range(0, len(stream), read_size)]
+
+	started = time.perf_counter()
+	decoder, key_count = ControlPanel.InputDecoder(), 0
+	for data in reads:
+		key_count += len(decoder.feed(data))
+	decode_seconds = time.perf_counter() - started
+
+	# The same work that get_input() does: every key changes the line, and the line is rendered once per read
+	started = time.perf_counter()
+	decoder, editor, output_bytes = ControlPanel.InputDecoder(), None, 0
+	for data in reads:
+		for key in decoder.feed(data):
+			if editor == None or editor.submitted:
+				editor = ControlPanel.LineEditor([], ControlPanel.command_registry.index.matches, True)
+			editor.handle_key(key)
+		output_bytes += len(editor.render())
+	edit_seconds = time.perf_counter() - started
+
+	print(f"reads of {read_size:5} bytes: decoded {len(stream) / decode_seconds / 1e6:7.2f} MB/s ({decode_seconds / key_count * 1e6:6.2f} us per key), "
+		f"decoded and edited {len(stream) / edit_seconds / 1e6:7.2f} MB/s ({output_bytes} bytes rendered)")
+
+def main():
+	parser = argparse.ArgumentParser(description="Fuzz and benchmark the input decoder")
+	parser.add_argument("--rounds", type=int, default=500, help="Random splits per stream")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--stream", action="append", default=[], help="File with raw bytes recorded from a client")
+	args = parser.parse_args()
+
+	streams = dict(RECORDED_STREAMS)
+	for path in args.stream:
+		with open(path, "rb") as stream_file:
+			streams[os.path.basename(path)] = stream_file.read()
+	fuzz(streams, args.rounds, random.Random(args.seed))
+	for read_size in [1, 16, 4096]:
+		benchmark(streams, read_size)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,108 @@
+# Fuzzes and measures ControlPanel.LineEditor.render(), which redraws the line
+# being typed with the fewest escape sequences it can.
+#
+# Random keys are applied to LineEditors and everything that render() returns
+# is fed to a small terminal emulator, which understands just the output that
+# render() may produce. After every key the emulator must show the line
+# followed by its completion preview in grey, with the cursor where the editor
+# has it. Now and then the line is erased and reset_display() is called, as
+# deliver_messages() does when a message arrives while a line is typed:
+#
+#     python benchmarks/line_editor.py --rounds 3000
+#
+# The average number of bytes sent per key is printed at the end.
+
+import argparse, os, random, re, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ControlPanel
+
+COMMANDS = sorted(["adduser", "add", "addition", "clear", "cls", "kick", "kick 1", "kick 12", "who", "whoami", "exit"])
+HISTORY = ["kick 12", "who", "adduser"]
+KEYS = [
+	"a", "d", "k", "i", "c", " ", "1", "2", "w", "h", "o", "xy", "日本",
+	b"\x7f", b"\x1b[3~", b"\t", b"\x1b[A", b"\x1b[B", b"\x1b", b"\x1b[D", b"\x1b[C", b"\x1b[H", b"\x1b[F",
+	b"\x1b[1;5D", b"\x1b[1;5C", b"\x15", b"\x0b", b"\x17", b"\x1b[Z",
+]
+SEQUENCE_PATTERN = re.compile(r"\x1b\[(\d*)([A-Za-z])")
+
+class Terminal:
+	# One line of a terminal. `cells` maps a column to (character, grey), and `column` is the cursor.
+
+	def __init__(self):
+		self.cells = {}
+		self.column = 0
+		self.grey = False
+
+	def erase_line(self):
+		self.cells = {}
+		self.column = 0
+
+	def feed(self, output):
+		index = 0
+		while index < len(output):
+			character = output[index]
+			if character == "\b":
+				self.column = max(0, self.column - 1)
+			elif character == "\x1b":
+				match = SEQUENCE_PATTERN.match(output, index)
+				if match == None:
+					raise AssertionError(f"Unknown escape sequence in {output[index:]!r}")
+				count, command = int(match.group(1) or 1), match.group(2)
+				if command == "D":
+					self.column -= count
+				elif command == "C":
+					self.column += count
+				elif command == "K":
+					self.cells = {column: cell for column, cell in self.cells.items() if column < self.column}
+				elif command == "m":
+					self.grey = match.group(1) == "90"
+				index = match.end()
+				if self.column < 0:
+					raise AssertionError(f"The cursor moved left of the prompt with {output!r}")
+				continue
+			elif not character == "\x07":
+				self.cells[self.column] = (character, self.grey)
+				self.column += 1
+			index += 1
+
+	def shown(self):
+		# The text on the line with blanks for columns never written, and the columns shown in grey
+		text = "".join(self.cells.get(column, (" ", False))[0] for column in range(max(self.cells, default=-1) + 1))
+		return text, sorted(column for column, (_, grey) in self.cells.items() if grey)
+
+def fuzz(rounds, generator):
+	renders, output_bytes = 0, 0
+	for _ in range(rounds):
+		editor = ControlPanel.LineEditor(HISTORY, lambda prefix: [command for command in COMMANDS if command.startswith(prefix)], True)
+		terminal = Terminal()
+		for _ in range(generator.randint(1, 40)):
+			output = editor.render()
+			terminal.feed(output)
+			renders += 1
+			output_bytes += len(output.encode(ControlPanel.ENCODING))
+			text, grey = terminal.shown()
+			expected = editor.line + editor.get_preview()
+			if not text.rstrip(" ") == expected.rstrip(" "):
+				raise AssertionError(f"The terminal shows {text!r} instead of {expected!r}")
+			if not grey == list(range(len(editor.line), len(expected))):
+				raise AssertionError(f"Columns {grey} are grey for the line {editor.line!r} and {expected!r}")
+			if not terminal.column == editor.cursor:
+				raise AssertionError(f"The cursor is at {terminal.column} instead of {editor.cursor} in {editor.line!r}")
+			if generator.random() < 0.05:
+				terminal.erase_line()
+				editor.reset_display()
+			editor.handle_key(generator.choice(KEYS))
+			if editor.submitted:
+				break
+	print(f"consistent over {renders} renders in {rounds} lines, {output_bytes / renders:.2f} bytes per render")
+
+def main():
+	parser = argparse.ArgumentParser(description="Fuzz the line editor's renderer against a terminal emulator")
+	parser.add_argument("--rounds", type=int, default=1000, help="Lines typed with random keys")
+	parser.add_argument("--seed", type=int, default=1)
+	args = parser.parse_args()
+	fuzz(args.rounds, random.Random(args.seed))
+
+if __name__ == "__main__":
+	main()
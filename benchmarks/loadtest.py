@@ -0,0 +1,377 @@
+# Drives real SSH sessions against ControlPanel.py and reports how long every
+# stage of a session takes, so that a slower hot path shows up as a number.
+#
+# The server is started in a temporary directory with a new database and host
+# key, on a free port, with WELCOME_MESSAGE_DURATION set to 0. Every session
+# then goes through the full flow with paramiko:
+#
+#   handshake   TCP connection and SSH key exchange
+#   auth        password authentication
+#   shell       opening the channel and requesting a pty and shell
+#   login       client_login_sequence() until the first prompt
+#   keystroke   one typed character until its echo
+#   completion  Tab until the completed line is drawn
+#   history     the up arrow key until the previous command is drawn
+#   command     a command line until the next prompt
+#   logout      'logout' until the server closes the connection
+#
+# The median and 99th percentile of every stage, sessions per second, bytes
+# received per command, and the peak memory and thread count of the server
+# are printed, and written as JSON with --output. With --compare, the results
+# are checked against an earlier JSON file and the exit code is 1 if anything
+# became worse than --max-regression allows, for use in CI:
+#
+#     python benchmarks/loadtest.py --sessions 200 --concurrency 20 --output results.json
+#     python benchmarks/loadtest.py --compare results.json
+#
+# Any configuration option can be changed with --set, for example to compare
+# the connection engines:
+#
+#     python benchmarks/loadtest.py --set 'CONNECTION_ENGINE="asyncio"'
+
+import argparse, collections, json, logging, math, os, re, shutil, signal, socket, subprocess, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import paramiko
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ["handshake", "auth", "shell", "login", "keystroke", "completion", "history", "command", "logout"]
+PROMPT_END = b"] > "
+PAGER_PROMPT = b"-- More --"
+CONFIGURATION_END = "# -----  END OF CONFIGURATION  ----- #"
+
+# Runs the server with configuration options replaced, which a plain `python ControlPanel.py` cannot do. The
+# options are replaced right after the configuration block runs, so everything that the rest of the module creates
+# from them on import (the database backends, the log writer, the asyncssh import and so on) uses the new values.
+SERVER_BOOTSTRAP = f"""
+import argparse, importlib.util, json, sys, types
+path = importlib.util.find_spec("ControlPanel").origin
+with open(path) as source_file:
+	configuration, marker, rest = source_file.read().partition({CONFIGURATION_END!r})
+ControlPanel = sys.modules["ControlPanel"] = types.ModuleType("ControlPanel")
+ControlPanel.__file__ = path
+exec(compile(configuration, path, "exec"), ControlPanel.__dict__)
+ControlPanel.__dict__.update(json.loads(sys.argv[1]))
+# Padded so that tracebacks show the right line numbers
+exec(compile("\\n" * configuration.count("\\n") + marker + rest, path, "exec"), ControlPanel.__dict__)
+try:
+	ControlPanel.main(argparse.Namespace(check=False, warm=True, replay=None))
+except KeyboardInterrupt:
+	pass
+"""
+
+def configuration_options():
+	# The names assigned in the configuration block of ControlPanel.py, the only ones that --set can change
+	with open(os.path.join(REPOSITORY, "ControlPanel.py")) as source_file:
+		configuration = source_file.read().partition(CONFIGURATION_END)[0]
+	return set(re.findall(r"^([A-Za-z_]\w*)\s*=", configuration, re.M))
+
+class Results:
+
+	def __init__(self):
+		self.durations = collections.defaultdict(list)
+		self.errors = collections.Counter()
+		self.error_examples = {}
+		self.command_bytes = []
+		self.sessions = 0
+		self.lock = threading.Lock()
+
+	def add(self, stage, seconds):
+		with self.lock:
+			self.durations[stage].append(seconds)
+
+	def add_error(self, stage, error):
+		with self.lock:
+			self.errors[stage] += 1
+			self.error_examples.setdefault(stage, f"{type(error).__name__}: {error}")
+
+class Session:
+	# One client, which times every stage of its session into `results`
+
+	def __init__(self, host, port, password, timeout, results):
+		self.host, self.port, self.password = host, port, password
+		self.timeout = timeout
+		self.results = results
+		self.transport = None
+		self.chan = None
+
+	def timed(self, stage, function, *args):
+		started = time.perf_counter()
+		try:
+			result = function(*args)
+		except Exception as error:
+			self.results.add_error(stage, error)
+			raise
+		self.results.add(stage, time.perf_counter() - started)
+		return result
+
+	def read(self, done):
+		# Reads until `done(received)` is true and returns everything received. Table pages are all shown.
+		received, answered = b"", 0
+		while not done(received):
+			data = self.chan.recv(65536)
+			if not data:
+				raise EOFError(f"Connection closed after {received[-200:]!r}")
+			received += data
+			if PAGER_PROMPT in received[answered:]:
+				answered = len(received)
+				self.chan.sendall(b" ")
+		return received
+
+	def read_prompt(self):
+		return self.read(lambda received: received.endswith(PROMPT_END))
+
+	def key(self, stage, data):
+		# Sends keys and waits for the first response to them
+		self.chan.sendall(data)
+		return self.timed(stage, self.read, lambda received: len(received) > 0)
+
+	def command(self, line):
+		self.chan.sendall(line + b"\r")
+		received = self.timed("command", self.read_prompt)
+		with self.results.lock:
+			self.results.command_bytes.append(len(received))
+
+	def connect(self):
+		sock = socket.create_connection((self.host, self.port), self.timeout)
+		self.transport = paramiko.Transport(sock)
+		self.transport.start_client(timeout=self.timeout)
+
+	def open_shell(self):
+		self.chan = self.transport.open_session(timeout=self.timeout)
+		self.chan.settimeout(self.timeout)
+		self.chan.get_pty(width=120, height=40)
+		self.chan.invoke_shell()
+
+	def logout(self):
+		self.chan.sendall(b"logout\r")
+		while self.chan.recv(65536):
+			pass
+
+	def run(self, rounds):
+		try:
+			self.timed("handshake", self.connect)
+			self.timed("auth", self.transport.auth_password, "root", self.password)
+			self.timed("shell", self.open_shell)
+			self.timed("login", self.read_prompt)
+			for _ in range(rounds):
+				for character in b"who":
+					self.key("keystroke", bytes([character]))
+				self.command(b"")
+				self.chan.sendall(b"sta")
+				self.read(lambda received: len(received) > 0)
+				self.key("completion", b"\t")
+				self.command(b"")
+				self.key("history", b"\x1b[A")
+				self.key("history", b"\x1b[A")
+				self.command(b"")
+			self.timed("logout", self.logout)
+			with self.results.lock:
+				self.results.sessions += 1
+		except Exception:
+			pass
+		finally:
+			if not self.transport == None:
+				self.transport.close()
+
+class ResourceSampler(threading.Thread):
+	# Samples the memory and thread count of the server and its worker processes from /proc
+
+	def __init__(self, pid, interval=0.05):
+		threading.Thread.__init__(self, daemon=True)
+		self.pid = pid
+		self.interval = interval
+		self.peak_rss_kib = None
+		self.peak_threads = None
+		self.stopped = threading.Event()
+
+	def processes(self):
+		pids = [self.pid]
+		try:
+			with open(f"/proc/{self.pid}/task/{self.pid}/children") as children:
+				pids += [int(pid) for pid in children.read().split()]
+		except OSError:
+			pass
+		return pids
+
+	def sample(self):
+		rss, threads = 0, 0
+		for pid in self.processes():
+			try:
+				with open(f"/proc/{pid}/status") as status:
+					fields = dict(line.split(":", 1) for line in status if ":" in line)
+			except OSError:
+				continue
+			rss += int(fields["VmRSS"].split()[0])
+			threads += int(fields["Threads"])
+		if rss:
+			self.peak_rss_kib = max(self.peak_rss_kib or 0, rss)
+			self.peak_threads = max(self.peak_threads or 0, threads)
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.sample()
+
+def percentile(values, percent):
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, max(math.ceil(percent / 100 * len(ordered)) - 1, 0))]
+
+def create_directory():
+	directory = tempfile.mkdtemp(prefix="controlpanel-loadtest-")
+	os.mkdir(os.path.join(directory, "keys"))
+	with open(os.path.join(directory, "keys", "private.key"), "wb") as key_file:
+		key_file.write(ed25519.Ed25519PrivateKey.generate().private_bytes(
+			serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, serialization.NoEncryption()
+		))
+	return directory
+
+def free_port():
+	with socket.socket() as sock:
+		sock.bind(("127.0.0.1", 0))
+		return sock.getsockname()[1]
+
+def start_server(directory, overrides, timeout=60):
+	output = open(os.path.join(directory, "server.txt"), "w")
+	process = subprocess.Popen(
+		[sys.executable, "-c", SERVER_BOOTSTRAP, json.dumps(overrides)], cwd=directory,
+		env=dict(os.environ, PYTHONPATH=REPOSITORY), stdout=output, stderr=subprocess.STDOUT
+	)
+	# Waits for the log line instead of connecting, so that no unfinished handshake ends up in the results
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		with open(os.path.join(directory, "server.txt")) as server_output:
+			if "Listening for connections" in server_output.read():
+				break
+		if not process.poll() == None:
+			raise RuntimeError(f"The server exited with status {process.returncode}, see {directory}/server.txt")
+		time.sleep(0.05)
+	else:
+		raise RuntimeError(f"The server did not start within {timeout} seconds")
+	with open(os.path.join(directory, "logs", "root_passwords.log")) as passwords:
+		password = re.findall(r"root:(\w+)", passwords.read())[-1]
+	return process, password
+
+def stop_server(process):
+	process.send_signal(signal.SIGINT)
+	try:
+		process.wait(10)
+	except subprocess.TimeoutExpired:
+		process.kill()
+		process.wait()
+
+def run_load(args, port, password, pid):
+	results = Results()
+	sampler = ResourceSampler(pid)
+	sampler.sample()
+	idle_rss_kib, idle_threads = sampler.peak_rss_kib, sampler.peak_threads
+	sampler.start()
+	started = time.perf_counter()
+	with ThreadPoolExecutor(args.concurrency) as executor:
+		for _ in range(args.sessions):
+			executor.submit(Session("127.0.0.1", port, password, args.timeout, results).run, args.rounds)
+	duration = time.perf_counter() - started
+	sampler.stopped.set()
+	sampler.join()
+	sampler.sample()
+	return {
+		"sessions": results.sessions,
+		"concurrency": args.concurrency,
+		"seconds": round(duration, 3),
+		"sessions_per_second": round(results.sessions / duration, 2),
+		"stages": {
+			stage: {
+				"count": len(results.durations[stage]),
+				"p50_ms": round(percentile(results.durations[stage], 50) * 1000, 3),
+				"p99_ms": round(percentile(results.durations[stage], 99) * 1000, 3),
+			}
+			for stage in STAGES if results.durations[stage]
+		},
+		"bytes_per_command": round(sum(results.command_bytes) / len(results.command_bytes), 1) if results.command_bytes else None,
+		"idle_rss_kib": idle_rss_kib,
+		"peak_rss_kib": sampler.peak_rss_kib,
+		"idle_threads": idle_threads,
+		"peak_threads": sampler.peak_threads,
+		"errors": dict(results.errors),
+		"error_examples": results.error_examples,
+	}
+
+def print_results(results):
+	print(f"{results['sessions']} sessions with {results['concurrency']} at a time in {results['seconds']} s: {results['sessions_per_second']} sessions/s")
+	print(f"{'stage':12} {'count':>7} {'p50 ms':>10} {'p99 ms':>10} {'errors':>7}")
+	for stage, values in results["stages"].items():
+		print(f"{stage:12} {values['count']:7} {values['p50_ms']:10.2f} {values['p99_ms']:10.2f} {results['errors'].get(stage, 0):7}")
+	print(f"bytes per command {results['bytes_per_command']}")
+	print(f"server memory {results['idle_rss_kib']} KiB idle, {results['peak_rss_kib']} KiB peak; threads {results['idle_threads']} idle, {results['peak_threads']} peak")
+	for stage, example in results["error_examples"].items():
+		print(f"first {stage} error: {example}")
+
+def compare(results, baseline, max_regression, noise_ms):
+	# Returns a description of everything that became worse than the baseline by more than `max_regression`
+	regressions = []
+	for stage, values in baseline["stages"].items():
+		current = results["stages"].get(stage)
+		if current == None:
+			continue
+		for key in ["p50_ms", "p99_ms"]:
+			if current[key] > values[key] * (1 + max_regression) + noise_ms:
+				regressions.append(f"{stage} {key} {values[key]} -> {current[key]}")
+	if results["sessions_per_second"] < baseline["sessions_per_second"] * (1 - max_regression):
+		regressions.append(f"sessions_per_second {baseline['sessions_per_second']} -> {results['sessions_per_second']}")
+	for key in ["bytes_per_command", "peak_rss_kib", "peak_threads"]:
+		if not None in [results[key], baseline[key]] and results[key] > baseline[key] * (1 + max_regression):
+			regressions.append(f"{key} {baseline[key]} -> {results[key]}")
+	if sum(results["errors"].values()) > sum(baseline["errors"].values()):
+		regressions.append(f"errors {baseline['errors']} -> {results['errors']}")
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description="Drive concurrent SSH sessions against ControlPanel.py and report per-stage latency")
+	parser.add_argument("--sessions", type=int, default=100, help="Sessions to run in total")
+	parser.add_argument("--concurrency", type=int, default=10, help="Sessions running at the same time")
+	parser.add_argument("--rounds", type=int, default=3, help="Times every session runs its commands")
+	parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for any response")
+	parser.add_argument("--set", action="append", default=[], metavar="NAME=JSON", help="Change a configuration option of the server, such as WORKER_PROCESSES=2")
+	parser.add_argument("--output", help="Write the results to this JSON file")
+	parser.add_argument("--compare", metavar="BASELINE", help="Exit with status 1 if the results are worse than this JSON file")
+	parser.add_argument("--max-regression", type=float, default=0.25, help="Allowed relative regression for --compare")
+	parser.add_argument("--noise-ms", type=float, default=1, help="Latency differences below this many ms are never regressions")
+	parser.add_argument("--keep", action="store_true", help="Keep the server's directory with its logs")
+	args = parser.parse_args()
+	logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+	port = free_port()
+	overrides = {"SSH_PORT": port, "WELCOME_MESSAGE_DURATION": 0, "MAX_CONCURRENT_SESSIONS": max(200, args.concurrency), "CONNECTION_RATE_LIMIT": 0}
+	options = configuration_options()
+	for option in args.set:
+		name, _, value = option.partition("=")
+		if not name in options:
+			parser.error(f"{name} is not a configuration option of ControlPanel.py")
+		overrides[name] = json.loads(value)
+
+	directory = create_directory()
+	process, password = start_server(directory, overrides)
+	try:
+		results = run_load(args, port, password, process.pid)
+	finally:
+		stop_server(process)
+		if args.keep:
+			print(f"Server directory: {directory}")
+		else:
+			shutil.rmtree(directory)
+	results["configuration"] = overrides
+
+	print_results(results)
+	if args.output:
+		with open(args.output, "w") as output_file:
+			json.dump(results, output_file, indent=2)
+	if args.compare:
+		with open(args.compare) as baseline_file:
+			regressions = compare(results, json.load(baseline_file), args.max_regression, args.noise_ms)
+		for regression in regressions:
+			print(f"REGRESSION: {regression}")
+		if regressions:
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
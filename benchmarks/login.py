@@ -0,0 +1,100 @@
+# Measures logins per second with the password hashes of older versions and
+# with the current ones, on a fixed number of verification threads.
+#
+#   legacy    the path of older versions: an unsalted SHA-512 hash compared
+#             while holding one global lock, like check_login_credentials()
+#             did with the database lock
+#   scrypt    ControlPanel.LoginVerifier with LOGIN_VERIFY_WORKERS threads and
+#   pbkdf2    hashes created with SCRYPT_PARAMETERS or PBKDF2_ITERATIONS
+#   upgrade   LoginVerifier with legacy hashes, so that every login also
+#             creates a new hash, as the first login of every user after an
+#             upgrade does
+#
+# --clients threads log in as fast as they can for --seconds. Besides logins
+# per second and latency, the CPU time per login is printed, which is what
+# bounds logins per second on a busy server:
+#
+#     python benchmarks/login.py --workers 4 --clients 16
+#
+# Logins refused because LOGIN_VERIFY_QUEUE was full are counted separately.
+
+import argparse, hashlib, hmac, os, sys, threading, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ControlPanel
+
+PASSWORD = "correct horse battery staple"
+
+def legacy_path():
+	stored_hash = hashlib.sha512(PASSWORD.encode("utf-8")).hexdigest()
+	lock = threading.Lock()
+
+	def login():
+		with lock:
+			return hmac.compare_digest(hashlib.sha512(PASSWORD.encode("utf-8")).hexdigest(), stored_hash)
+	return login
+
+def verifier_path(verifier, algorithm, stored_hash=None):
+	ControlPanel.PASSWORD_HASH_ALGORITHM = algorithm
+	stored_hash = stored_hash or ControlPanel.create_password_hash(PASSWORD)
+
+	def login():
+		# None when the verifier refused the login, otherwise whether the password matched
+		result = verifier.verify(PASSWORD, stored_hash)
+		return None if result == None else result[0]
+	return login
+
+def run(name, login, clients, seconds):
+	latencies, refused, failed = [], [0], [0]
+	lock = threading.Lock()
+	deadline = time.perf_counter() + seconds
+
+	def client():
+		own_latencies = []
+		while time.perf_counter() < deadline:
+			started = time.perf_counter()
+			result = login()
+			if result == None:
+				with lock:
+					refused[0] += 1
+				continue
+			if not result:
+				with lock:
+					failed[0] += 1
+			own_latencies.append(time.perf_counter() - started)
+		with lock:
+			latencies.extend(own_latencies)
+
+	cpu_started, started = time.process_time(), time.perf_counter()
+	threads = [threading.Thread(target=client) for _ in range(clients)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	duration, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+	latencies.sort()
+	if not latencies:
+		print(f"{name:10} no logins finished")
+		return
+	print(f"{name:10} {len(latencies) / duration:12.1f} {latencies[len(latencies) // 2] * 1000:10.2f} {latencies[int(len(latencies) * 0.99)] * 1000:10.2f} "
+		f"{cpu / len(latencies) * 1000:12.3f} {refused[0]:8}" + (f"  {failed[0]} failed" if failed[0] else ""))
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure logins per second with the old and new password hashes")
+	parser.add_argument("--workers", type=int, default=ControlPanel.LOGIN_VERIFY_WORKERS, help="Verification threads (LOGIN_VERIFY_WORKERS)")
+	parser.add_argument("--queue", type=int, default=ControlPanel.LOGIN_VERIFY_QUEUE, help="Logins that may wait for a thread (LOGIN_VERIFY_QUEUE)")
+	parser.add_argument("--clients", type=int, default=16, help="Threads logging in at the same time")
+	parser.add_argument("--seconds", type=float, default=5, help="Duration of every measurement")
+	args = parser.parse_args()
+
+	legacy_hash = hashlib.sha512(PASSWORD.encode("utf-8")).hexdigest()
+	print(f"{args.workers} verification threads, {args.clients} clients, {os.cpu_count()} CPUs")
+	print(f"{'path':10} {'logins/s':>12} {'p50 ms':>10} {'p99 ms':>10} {'CPU ms/login':>12} {'refused':>8}")
+	run("legacy", legacy_path(), args.clients, args.seconds)
+	for name, algorithm, stored_hash in [("scrypt", "scrypt", None), ("pbkdf2", "pbkdf2_sha256", None), ("upgrade", "scrypt", legacy_hash)]:
+		verifier = ControlPanel.LoginVerifier(args.workers, args.queue)
+		run(name, verifier_path(verifier, algorithm, stored_hash), args.clients, args.seconds)
+		verifier.executor.shutdown()
+
+if __name__ == "__main__":
+	main()
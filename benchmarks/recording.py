@@ -0,0 +1,89 @@
+# Measures session recording: what it costs a session to record an event, how
+# fast the SessionRecorder thread writes them, how small the recordings are
+# compared to plain asciicast files, and how much faster a replay can start
+# late in a long recording with the index than by decompressing everything.
+#
+# A synthetic session of typed commands and long tables is recorded into a
+# temporary directory:
+#
+#     python benchmarks/recording.py --commands 2000
+#
+# Run it with different RECORDING_MEMBER_SIZE values to trade seek time
+# against compression.
+
+import argparse, gzip, json, os, random, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ControlPanel
+
+def synthetic_session(commands, generator):
+	# Yields (time, kind, data) events that resemble a root session: typed keys, their echo and occasional tables
+	prompt = b"\x1b]0;Project Name >> [root] - Connected from [127.0.0.1:50000] - Session ID [1]\x07 [root@127.0.0.1:50000] > "
+	elapsed = 0
+	for _ in range(commands):
+		yield elapsed, "o", prompt
+		elapsed += generator.uniform(0.5, 10)
+		command = generator.choice([b"who", b"stats", b"users", b"kick 12", b"clear"])
+		for key in command:
+			elapsed += generator.uniform(0.05, 0.3)
+			yield elapsed, "i", bytes([key])
+			yield elapsed, "o", bytes([key])
+		yield elapsed, "i", b"\r"
+		yield elapsed, "o", b"\r\n"
+		if command in [b"who", b"users", b"stats"]:
+			for row in range(generator.randint(5, 60)):
+				yield elapsed, "o", f" {row:<12} user{generator.randint(1, 500):<12} 10.0.{generator.randint(0, 255)}.{generator.randint(0, 255)}:{generator.randint(1024, 65535):<8} 0:{generator.randint(0, 59):02}:{generator.randint(0, 59):02}\r\n".encode()
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure session recording and replay")
+	parser.add_argument("--commands", type=int, default=2000, help="Commands in the synthetic session")
+	parser.add_argument("--seed", type=int, default=1)
+	args = parser.parse_args()
+
+	events = list(synthetic_session(args.commands, random.Random(args.seed)))
+	directory = tempfile.mkdtemp(prefix="controlpanel-recording-")
+	try:
+		# The cost for the session is measured with real timestamps, and the recording is then written with the
+		# timestamps of the synthetic session so that it spans hours like a real one
+		recorder = ControlPanel.SessionRecorder(directory, len(events) + 2, ControlPanel.RECORDING_FLUSH_INTERVAL, ControlPanel.RECORDING_MEMBER_SIZE)
+		recording = recorder.open(0, "timing", "127.0.0.1:50000", 80, 24)
+		started = time.perf_counter()
+		for elapsed, kind, data in events:
+			recording.event(kind, data)
+		queued = time.perf_counter() - started
+		recording.close()
+		recorder.close()
+		written = time.perf_counter() - started
+
+		recorder = ControlPanel.SessionRecorder(directory, len(events) + 2, ControlPanel.RECORDING_FLUSH_INTERVAL, ControlPanel.RECORDING_MEMBER_SIZE)
+		recording = recorder.open(1, "root", "127.0.0.1:50000", 80, 24)
+		for elapsed, kind, data in events:
+			recorder.put(("event", recording.name, elapsed, kind, data), block=True)
+		recording.close()
+		recorder.close()
+		if recorder.dropped or recorder.write_errors:
+			raise RuntimeError(f"{recorder.dropped} events dropped and {recorder.write_errors} write errors")
+
+		path = os.path.join(directory, recording.name + ".cast.gz")
+		with open(path, "rb") as recording_file:
+			plain = gzip.decompress(recording_file.read())
+		entries = ControlPanel.read_recording_index(path)
+		print(f"{len(events)} events: {queued / len(events) * 1e6:.2f} us per event on the session thread, all written after {written:.2f} s")
+		print(f"plain asciicast {len(plain) / 1024:9.1f} KiB")
+		print(f"recording       {os.path.getsize(path) / 1024:9.1f} KiB  ({len(plain) / os.path.getsize(path):.1f}x smaller, {len(entries)} members)")
+
+		last_time = entries[-1][1]
+		started = time.perf_counter()
+		for line in gzip.GzipFile(path):
+			json.loads(line)
+		full = time.perf_counter() - started
+		started = time.perf_counter()
+		header, replay_events = ControlPanel.read_recording(path, last_time)
+		next(replay_events)
+		seek = time.perf_counter() - started
+		print(f"reaching {last_time:.0f} s: {full * 1000:8.1f} ms by decompressing everything, {seek * 1000:8.1f} ms with the index")
+	finally:
+		shutil.rmtree(directory)
+
+if __name__ == "__main__":
+	main()
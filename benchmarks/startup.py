@@ -0,0 +1,74 @@
+# Measures how long ControlPanel.py takes to start, so that changes to startup
+# can be compared with numbers instead of guesses. Every run happens in a new
+# Python process inside a temporary directory with a generated host key:
+#
+#   import  python -c "import ControlPanel", which must not create files,
+#           open the port or touch the database
+#   check   ControlPanel.py --check, every startup phase including the warm up
+#           but without listening on SSH_PORT
+#
+# The startup report of every --check run is parsed, so the time of every
+# phase is printed next to the total:
+#
+#     python benchmarks/startup.py --runs 10
+
+import argparse, os, re, shutil, statistics, subprocess, sys, tempfile, time
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(REPOSITORY, "ControlPanel.py")
+PHASE_PATTERN = re.compile(r"(\w[\w ]*?) ([\d.]+) ms")
+
+def create_directory():
+	directory = tempfile.mkdtemp(prefix="controlpanel-startup-")
+	os.mkdir(os.path.join(directory, "keys"))
+	with open(os.path.join(directory, "keys", "private.key"), "wb") as key_file:
+		key_file.write(ed25519.Ed25519PrivateKey.generate().private_bytes(
+			serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, serialization.NoEncryption()
+		))
+	# Creates the database and root credentials, so the measured runs start like a server that has run before
+	subprocess.run([sys.executable, SERVER, "--check"], cwd=directory, capture_output=True, check=True)
+	return directory
+
+def measure_import(directory):
+	files_before = sorted(os.listdir(directory))
+	started = time.perf_counter()
+	subprocess.run([sys.executable, "-c", "import ControlPanel"], cwd=directory, env=dict(os.environ, PYTHONPATH=REPOSITORY), check=True)
+	duration = time.perf_counter() - started
+	if not sorted(os.listdir(directory)) == files_before:
+		raise RuntimeError(f"Importing ControlPanel changed the files in {directory}")
+	return duration, {}
+
+def measure_check(directory):
+	started = time.perf_counter()
+	output = subprocess.run([sys.executable, SERVER, "--check"], cwd=directory, capture_output=True, text=True, check=True).stdout
+	duration = time.perf_counter() - started
+	report = re.search(r"Server initialization completed in [\d.]+ seconds \((.*?)\)", re.sub(r"\033\[[\d;]*m", "", output))
+	return duration, {name: float(ms) for name, ms in PHASE_PATTERN.findall(report.group(1))}
+
+def run(name, measurement, directory, runs):
+	durations, phases = [], {}
+	for _ in range(runs):
+		duration, phase_durations = measurement(directory)
+		durations.append(duration)
+		for phase, ms in phase_durations.items():
+			phases.setdefault(phase, []).append(ms)
+	print(f"{name:12} median {statistics.median(durations) * 1000:8.1f} ms   min {min(durations) * 1000:8.1f} ms")
+	for phase, values in phases.items():
+		print(f"{'':12}   {phase:24} {statistics.median(values):8.1f} ms")
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure how long ControlPanel.py takes to start")
+	parser.add_argument("--runs", type=int, default=5, help="Processes started per measurement")
+	args = parser.parse_args()
+
+	directory = create_directory()
+	try:
+		run("import", measure_import, directory, args.runs)
+		run("check", measure_check, directory, args.runs)
+	finally:
+		shutil.rmtree(directory)
+
+if __name__ == "__main__":
+	main()
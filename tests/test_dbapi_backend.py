@@ -0,0 +1,42 @@
+# Runs the database functions that depend on rowid against the "dbapi" backend, with the sqlite3 driver standing in for
+# a database server.
+
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ControlPanel
+
+@pytest.fixture
+def dbapi_storage(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	os.mkdir("logs")
+	backend = ControlPanel.DBAPIBackend("sqlite3", {"database": str(tmp_path / "Data.db"), "check_same_thread": False}, 2)
+	monkeypatch.setattr(ControlPanel, "storage", backend)
+	return backend
+
+def test_users_are_paged(dbapi_storage):
+	ControlPanel.create_tables()
+	database = ControlPanel.SSHPanelDatabase("root")
+	for index in range(5):
+		database.add_new_user(f"user{index}", "password")
+	assert [username for username, _ in database.iterate_users(page_size=2)] == ["root"] + [f"user{index}" for index in range(5)]
+
+def test_command_history_is_trimmed(dbapi_storage):
+	ControlPanel.create_tables()
+	database = ControlPanel.SSHPanelDatabase("root")
+	for index in range(10):
+		database.save_command("root", f"command {index}")
+	database.save_command("other", "command")
+	history, oldest_rowid = database.load_command_history("root", 4)
+	assert history == [f"command {index}" for index in range(6, 10)]
+	assert not oldest_rowid == None
+	database.trim_command_history("root", oldest_rowid)
+	assert database.load_command_history("root", 4) == (history, None)
+	assert database.load_command_history("other", 4) == (["command"], None)
+
+def test_key_column_not_filled_in_stops_startup(dbapi_storage):
+	dbapi_storage.key_column_type = "SERIAL PRIMARY KEY"
+	with pytest.raises(KeyboardInterrupt):
+		ControlPanel.create_tables()